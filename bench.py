@@ -0,0 +1,478 @@
+# Micro-benchmarks for the jpeg module
+# Run as: python bench.py [repeat] [file.jpg ...] [--corpus] [--json PATH] [--compare PATH]
+#	every figure is the best of `repeat` timed runs
+#	any files given are also timed through entropy decoding and IDCT
+#	--corpus times a synthetic corpus generated on the spot (see CORPUS) from probing to
+#	full and scaled decoding, and --json saves those results, for --compare in a later run
+#	--save-corpus DIR writes the corpus out, to try on other decoders
+
+import argparse
+import array
+import json
+import math
+import platform
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+
+import jpeg
+
+# The example huffman tables from Annex K of the JPEG standard, as (counts, values)
+# Most encoders use these as-is, so they are what the decoder sees most often
+STANDARD_HUFFMAN_TABLES = {
+	'dc_luminance': (
+			[0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+			[
+				0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b,
+			]),
+	'dc_chrominance': (
+			[0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+			[
+				0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b,
+			]),
+	'ac_luminance': (
+			[0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 125],
+			[
+				0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06,
+				0x13, 0x51, 0x61, 0x07, 0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08,
+				0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0, 0x24, 0x33, 0x62, 0x72,
+				0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+				0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45,
+				0x46, 0x47, 0x48, 0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59,
+				0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69, 0x6a, 0x73, 0x74, 0x75,
+				0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+				0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3,
+				0xa4, 0xa5, 0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6,
+				0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9,
+				0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+				0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4,
+				0xf5, 0xf6, 0xf7, 0xf8, 0xf9, 0xfa,
+			]),
+	'ac_chrominance': (
+			[0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 119],
+			[
+				0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41,
+				0x51, 0x07, 0x61, 0x71, 0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91,
+				0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0, 0x15, 0x62, 0x72, 0xd1,
+				0x0a, 0x16, 0x24, 0x34, 0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+				0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44,
+				0x45, 0x46, 0x47, 0x48, 0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58,
+				0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69, 0x6a, 0x73, 0x74,
+				0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+				0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a,
+				0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4,
+				0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5, 0xc6, 0xc7,
+				0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+				0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf2, 0xf3, 0xf4,
+				0xf5, 0xf6, 0xf7, 0xf8, 0xf9, 0xfa,
+			]),
+}
+
+# Run func(arg) `number` times per run and return the best per-call time in seconds
+def best_time(func, arg, number, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		for j in range(number):
+			func(arg)
+		elapsed = (time.perf_counter() - start) / number
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+# List the canonical (code, length, symbol) triples defined by a (counts, values) pair
+def canonical_codes(counts, values):
+	codes = []
+	code = 0
+	k = 0
+	for length in range(1, 17):
+		for i in range(counts[length - 1]):
+			codes.append((code, length, values[k]))
+			code += 1
+			k += 1
+		code <<= 1
+	return codes
+
+# Build a stream of 16-bit lookaheads for a table, with symbols drawn according to the
+#	probabilities the code lengths imply (2 ** -length) and random bits after each code
+def lookahead_sample(counts, values, size):
+	rng = random.Random(0)
+	codes = canonical_codes(counts, values)
+	weights = [2.0 ** -length for code, length, symbol in codes]
+	sample = []
+	for code, length, symbol in rng.choices(codes, weights, k=size):
+		sample.append((code << (16 - length)) | rng.getrandbits(16 - length))
+	return sample
+
+def bench_huffman_build(repeat):
+	results = {}
+	for name, (counts, values) in sorted(STANDARD_HUFFMAN_TABLES.items()):
+		results[name] = best_time(jpeg.JpegHuffman, (counts, values), 200, repeat)
+		# the same table again, through the process-wide cache
+		results[name + ' cached'] = best_time(lambda table: jpeg.huffman_table(*table), (counts, values), 200, repeat)
+	return results
+
+def bench_huffman_lookup(repeat):
+	SAMPLE_SIZE = 10000
+
+	results = {}
+	for name, (counts, values) in sorted(STANDARD_HUFFMAN_TABLES.items()):
+		huffman = jpeg.JpegHuffman((counts, values))
+		sample = lookahead_sample(counts, values, SAMPLE_SIZE)
+		lookup = huffman.lookup
+		def run(sample):
+			for bits in sample:
+				lookup(bits)
+		results[name] = best_time(run, sample, 1, repeat) / SAMPLE_SIZE
+	return results
+
+# Entropy decode a file from memory, reporting throughput over the whole compressed file
+def bench_entropy_decode(path, repeat):
+	with open(path, 'rb') as f:
+		buf = f.read()
+	def run(buf):
+		jpeg.Jpeg(buf).decode_scans()
+	seconds = best_time(run, buf, 1, repeat)
+	return len(buf), seconds
+
+# Dequantize and IDCT an already entropy decoded file, reporting megapixels per second
+def bench_idct(path, backend, repeat):
+	with jpeg.Jpeg.from_path(path) as image:
+		image.decode_scans()
+		pixels = image.image_width * image.image_height
+		seconds = best_time(image.decode_planes, backend, 1, repeat)
+	return pixels, seconds
+
+# Decode a file from scratch at each scale, reporting milliseconds per image
+SCALES = (1, 0.5, 0.25, 0.125)
+
+def bench_scaled_decode(path, backend, repeat):
+	with open(path, 'rb') as f:
+		buf = f.read()
+	times = []
+	for scale in SCALES:
+		def run(buf):
+			jpeg.Jpeg(buf).decode(backend=backend, scale=scale)
+		times.append(best_time(run, buf, 1, repeat))
+	return times
+
+# Synthetic corpus
+# Images are generated straight as quantized DCT coefficients, which is all the decoder
+#	sees of an image: the DC drifts from block to block and AC coefficients get rarer and
+#	smaller with frequency, roughly as in a photograph
+# Everything comes from a random.Random seeded with the image's name, through random() and
+#	getrandbits() only, so the corpus is the same byte for byte on every run and every
+#	machine; each image's CRC-32 goes in the results to show that
+
+# The example quantization tables from Annex K, in natural order
+STANDARD_QUANTIZATION_TABLES = (
+	[
+		16, 11, 10, 16, 24, 40, 51, 61,
+		12, 12, 14, 19, 26, 58, 60, 55,
+		14, 13, 16, 24, 40, 57, 69, 56,
+		14, 17, 22, 29, 51, 87, 80, 62,
+		18, 22, 37, 56, 68, 109, 103, 77,
+		24, 35, 55, 64, 81, 104, 113, 92,
+		49, 64, 78, 87, 103, 121, 120, 101,
+		72, 92, 95, 98, 112, 100, 103, 99,
+	],
+	[
+		17, 18, 24, 47, 99, 99, 99, 99,
+		18, 21, 26, 66, 99, 99, 99, 99,
+		24, 26, 56, 99, 99, 99, 99, 99,
+		47, 66, 99, 99, 99, 99, 99, 99,
+		99, 99, 99, 99, 99, 99, 99, 99,
+		99, 99, 99, 99, 99, 99, 99, 99,
+		99, 99, 99, 99, 99, 99, 99, 99,
+		99, 99, 99, 99, 99, 99, 99, 99,
+	],
+)
+
+# (h_factor, v_factor) of each component for each subsampling mode
+SUBSAMPLING = {
+	'gray': [(1, 1)],
+	'444': [(1, 1), (1, 1), (1, 1)],
+	'422': [(2, 1), (1, 1), (1, 1)],
+	'420': [(2, 2), (1, 1), (1, 1)],
+	'411': [(4, 1), (1, 1), (1, 1)],
+}
+
+# The corpus, as (name, width, height, subsampling, progressive, restart interval, APPn bytes)
+#	a restart interval of -1 means one MCU row
+CORPUS = [
+	('gray-small', 160, 120, 'gray', False, 0, 0),
+	('gray-medium', 640, 480, 'gray', False, 0, 0),
+	('444-medium', 640, 480, '444', False, 0, 0),
+	('422-medium', 640, 480, '422', False, 0, 0),
+	('420-small', 160, 120, '420', False, 0, 0),
+	('420-medium', 640, 480, '420', False, 0, 0),
+	('420-large', 1280, 960, '420', False, 0, 0),
+	('411-medium', 640, 480, '411', False, 0, 0),
+	('420-medium-rst4', 640, 480, '420', False, 4, 0),
+	('420-medium-rstrow', 640, 480, '420', False, -1, 0),
+	('420-medium-progressive', 640, 480, '420', True, 0, 0),
+	('420-large-progressive', 1280, 960, '420', True, 0, 0),
+	('420-medium-progressive-rst', 640, 480, '420', True, -1, 0),
+	('420-small-app256k', 160, 120, '420', False, 0, 256 * 1024),
+	('420-medium-app1m', 640, 480, '420', False, 0, 1024 * 1024),
+]
+
+# The progressive scans, as (components, ss, se): the DC of every component interleaved,
+#	then bands of AC coefficients, with no successive approximation
+PROGRESSIVE_SCANS = [(None, 0, 0), ([0], 1, 5), ([0], 6, 63), ([1], 1, 63), ([2], 1, 63)]
+
+def segment(code, payload):
+	return bytes([0xff, code]) + struct.pack('>H', len(payload) + 2) + payload
+
+def noise(rng, size):
+	return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+# Quantized coefficients for blocks_w x blocks_h blocks, in zigzag order as Jpeg.blocks has them
+def synthetic_coefficients(rng, blocks_w, blocks_h):
+	random = rng.random
+	exp = math.exp
+	log = math.log
+	coefficients = array.array('h', bytes(128 * blocks_w * blocks_h))
+	dc = 0
+	for base in range(0, len(coefficients), 64):
+		dc = max(-100, min(100, dc + int((random() - 0.5) * 24)))
+		coefficients[base] = dc
+		# most blocks are smooth, a few very busy
+		detail = random() ** 2
+		for k in range(1, 64):
+			if random() < detail * exp(-k / 16.0):
+				magnitude = 1 + int(-log(1.0 - random()) * 24.0 / (k + 2))
+				coefficients[base + k] = magnitude if random() < 0.5 else -magnitude
+	return coefficients
+
+# Make one image of the corpus, see CORPUS
+def synthetic_jpeg(name, width, height, subsampling, progressive, restart_interval, app_bytes):
+	rng = random.Random(zlib.crc32(name.encode('ascii')))
+	factors = SUBSAMPLING[subsampling]
+
+	head = b'\xff\xd8' + segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+	# metadata as cameras write it: an EXIF header, then an ICC profile split over as many
+	#	APP2 segments as it takes
+	if app_bytes:
+		exif = b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x00\x00\x00\x00\x00'
+		size = min(app_bytes, 65533 - len(exif))
+		head += segment(0xe1, exif + noise(rng, size))
+		app_bytes -= size
+		chunk = 65533 - 14
+		count = (app_bytes + chunk - 1) // chunk
+		for i in range(count):
+			size = min(app_bytes, chunk)
+			head += segment(0xe2, b'ICC_PROFILE\x00' + bytes([i + 1, count]) + noise(rng, size))
+			app_bytes -= size
+	for table_id, table in enumerate(STANDARD_QUANTIZATION_TABLES[:len(factors)]):
+		head += segment(0xdb, bytes([table_id]) + bytes(table[i] for i in jpeg.ZIGZAG_NATURAL))
+	frame = struct.pack('>BHHB', 8, height, width, len(factors))
+	for i, (h, v) in enumerate(factors):
+		frame += bytes([i + 1, (h << 4) | v, min(i, 1)])
+	head += segment(0xc2 if progressive else 0xc0, frame)
+
+	# the headers so far give the image's layout
+	layout = jpeg.Jpeg(head + b'\xff\xd9')
+	blocks = [synthetic_coefficients(rng, c['blocks_w'], c['blocks_h']) for c in layout.components]
+	if restart_interval < 0:
+		restart_interval = layout.mcus_x
+	if restart_interval:
+		head += segment(0xdd, struct.pack('>H', restart_interval))
+
+	scans = PROGRESSIVE_SCANS if progressive else [(None, 0, 63)]
+	body = bytearray()
+	for components, ss, se in scans:
+		if components is None:
+			components = list(range(len(factors)))
+		if max(components) >= len(factors):
+			continue
+		scan = {'components': [{'component': c, 'dc_huffman': min(c, 1), 'ac_huffman': min(c, 1)} for c in components]}
+		units, mcus_per_row, mcu_count = layout.scan_units(scan)
+		units = [(blocks[u[0]],) + u[1:] for u in units]
+		dht, data = jpeg.encode_optimized_scan(units, mcus_per_row, mcu_count, len(components), restart_interval, ss, se)
+		header = bytes([len(components)])
+		for c in components:
+			header += bytes([c + 1, (min(c, 1) << 4) | min(c, 1)])
+		header += bytes([ss, se, 0])
+		body += dht + segment(0xda, header) + data
+	return head + bytes(body) + b'\xff\xd9'
+
+# The whole corpus, or the images whose names contain select, as (name, bytes)
+def synthetic_corpus(select=None):
+	for spec in CORPUS:
+		if select is None or select in spec[0]:
+			yield spec[0], synthetic_jpeg(*spec)
+
+# Run func(arg) once, tracing allocations, and return the peak traced memory in bytes
+def peak_memory(func, arg):
+	tracemalloc.start()
+	try:
+		func(arg)
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+# Time the corpus through probing, huffman table building, full decoding and scaled
+#	decoding with each backend, and return the results as a JSON-ready dict
+#	each result has the best time of `repeat` runs, throughput in MB of compressed input
+#	and Mpixel of output per second, and the peak memory of one more run with tracemalloc
+#	on (None with memory False: tracing makes the python backend some 30 times slower)
+#	the throughputs are None for probing and table building, which don't go through the
+#	compressed data or make pixels
+CORPUS_SCALES = (1, 0.25)
+
+def bench_corpus(repeat, select=None, memory=True):
+	images = []
+	results = []
+	def add(name, buf, operation, func, pixels=None, backend=None, scale=None, number=1):
+		seconds = best_time(func, buf, number, repeat)
+		results.append({
+			'image': name,
+			'operation': operation,
+			'backend': backend,
+			'scale': scale,
+			'seconds': seconds,
+			'mb_per_s': len(buf) / seconds / 1e6 if pixels else None,
+			'mpixels_per_s': pixels / seconds / 1e6 if pixels else None,
+			'peak_bytes': peak_memory(func, buf) if memory else None,
+		})
+
+	for name, buf in synthetic_corpus(select):
+		image = jpeg.Jpeg(buf)
+		images.append({
+			'name': name,
+			'bytes': len(buf),
+			'crc32': zlib.crc32(buf),
+			'width': image.image_width,
+			'height': image.image_height,
+			'components': len(image.components),
+			'progressive': bool(image.encoding_type.get('progressive')),
+			'scans': len(image.scans),
+		})
+
+		add(name, buf, 'probe', jpeg.Jpeg.probe, number=20)
+
+		tables = [table for pair in image.huffman_data for table in pair if table is not None]
+		def build(buf):
+			for table in tables:
+				jpeg.JpegHuffman(table)
+		add(name, buf, 'huffman_build', build, number=20)
+
+		for backend in jpeg.BACKENDS:
+			if backend == 'numpy' and jpeg.numpy is None:
+				continue
+			for scale in CORPUS_SCALES:
+				width, height = image.output_size(scale)
+				def decode(buf):
+					jpeg.Jpeg(buf).decode(backend=backend, scale=scale)
+				add(name, buf, 'decode', decode, width * height, backend, scale)
+
+	return {
+		'format': 1,
+		'python': platform.python_version(),
+		'numpy': jpeg.numpy.__version__ if jpeg.numpy is not None else None,
+		'repeat': repeat,
+		'memory': memory,
+		'images': images,
+		'results': results,
+	}
+
+# The key a corpus result is matched on between runs
+def result_key(result):
+	return (result['image'], result['operation'], result['backend'], result['scale'])
+
+# Print how the corpus results of this run compare with an earlier run's (from --json),
+#	as the ratio of the times: above 1 is slower now
+def print_comparison(before, after):
+	crcs = dict((image['name'], image['crc32']) for image in before['images'])
+	for image in after['images']:
+		if image['name'] in crcs and crcs[image['name']] != image['crc32']:
+			print('warning: %s is not the image it was' % image['name'])
+	seconds = dict((result_key(result), result['seconds']) for result in before['results'])
+	print('compared with the earlier run (time now / time then)')
+	for result in after['results']:
+		key = result_key(result)
+		if key in seconds:
+			print('\t%-28s %-14s %-7s %-6s %8.3f' % (key[0], key[1], key[2] or '', '' if key[3] is None else '%g' % key[3],
+					result['seconds'] / seconds[key]))
+
+def print_corpus(report):
+	print('synthetic corpus (ms, MB/s of compressed input, Mpixel/s, peak MB)')
+	for result in report['results']:
+		print('\t%-28s %-14s %-7s %-6s %9.2f %8s %8s %8s' % (result['image'], result['operation'],
+				result['backend'] or '', '' if result['scale'] is None else '%g' % result['scale'],
+				result['seconds'] * 1e3,
+				'' if result['mb_per_s'] is None else '%.2f' % result['mb_per_s'],
+				'' if result['mpixels_per_s'] is None else '%.2f' % result['mpixels_per_s'],
+				'' if result['peak_bytes'] is None else '%.2f' % (result['peak_bytes'] / 1e6)))
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the jpeg module')
+	parser.add_argument('repeat', nargs='?', type=int, default=5, help='timed runs per figure, the best is kept')
+	parser.add_argument('paths', nargs='*', help='files to time through entropy decoding and IDCT')
+	parser.add_argument('--corpus', action='store_true', help='time the synthetic corpus too')
+	parser.add_argument('--select', help='only the corpus images whose names contain this')
+	parser.add_argument('--json', metavar='PATH', help='write the corpus results to PATH as JSON (- for stdout, alone)')
+	parser.add_argument('--compare', metavar='PATH', help='compare the corpus results with an earlier --json file')
+	parser.add_argument('--no-memory', action='store_true', help='skip the traced runs that measure peak memory')
+	parser.add_argument('--save-corpus', metavar='DIR', help='write the corpus out as DIR/<name>.jpg and stop')
+	args = parser.parse_args()
+	repeat = args.repeat
+	paths = args.paths
+
+	if args.save_corpus:
+		for name, buf in synthetic_corpus(args.select):
+			with open('%s/%s.jpg' % (args.save_corpus, name), 'wb') as f:
+				f.write(buf)
+		return
+
+	corpus = args.corpus or args.json or args.compare
+	if args.json == '-':
+		json.dump(bench_corpus(repeat, args.select, not args.no_memory), sys.stdout, indent=1, sort_keys=True)
+		print()
+		return
+
+	print('huffman table build (us per table)')
+	for name, seconds in sorted(bench_huffman_build(repeat).items()):
+		print('\t%-24s %8.2f' % (name, seconds * 1e6))
+
+	print('huffman lookup (ns per symbol)')
+	for name, seconds in sorted(bench_huffman_lookup(repeat).items()):
+		print('\t%-16s %8.1f' % (name, seconds * 1e9))
+
+	if paths:
+		print('entropy decode (MB/s of compressed input)')
+	for path in paths:
+		size, seconds = bench_entropy_decode(path, repeat)
+		print('\t%-40s %8.2f' % (path, size / seconds / 1e6))
+
+	for backend in jpeg.BACKENDS:
+		if backend == 'numpy' and jpeg.numpy is None:
+			continue
+		if paths:
+			print('dequantize + IDCT, %s backend (Mpixel/s)' % backend)
+		for path in paths:
+			pixels, seconds = bench_idct(path, backend, repeat)
+			print('\t%-40s %8.2f' % (path, pixels / seconds / 1e6))
+
+		if paths:
+			print('full decode at scale %s, %s backend (ms)' % (' '.join('%g' % scale for scale in SCALES), backend))
+		for path in paths:
+			times = bench_scaled_decode(path, backend, repeat)
+			print('\t%-40s %s' % (path, ' '.join('%8.1f' % (seconds * 1e3) for seconds in times)))
+
+	if corpus:
+		report = bench_corpus(repeat, args.select, not args.no_memory)
+		print_corpus(report)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(report, f, indent=1, sort_keys=True)
+		if args.compare:
+			with open(args.compare) as f:
+				print_comparison(json.load(f), report)
+
+if __name__ == '__main__':
+	main()
@@ -1,5 +1,25 @@
-import struct
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import math
+import mmap
+import os
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# NumPy is optional; without it every stage runs in pure Python
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 class NotJpegFileError(Exception):
 	pass
@@ -16,96 +36,1996 @@ class BadFieldError(Exception):
 class BadHuffmanTreeError(Exception):
 	pass
 
+# Raised when the buffer ends before the headers we were asked for
+#	probing a short read of a file head should read more and retry
+class TruncatedFileError(Exception):
+	pass
+
+# Raised when a saved JpegIndex is malformed, or was made for another file
+class BadIndexError(Exception):
+	pass
+
+# Get a flat, unsigned byte view over anything supporting the buffer protocol
+#	memoryview slicing and struct.unpack_from both work on this without copying
+def as_byte_view(buf):
+	view = memoryview(buf)
+	if view.format != 'B' or view.ndim != 1:
+		view = view.cast('B')
+	return view
+
+# Lightweight record of the frame layout returned by Jpeg.probe()
+#	components holds one (id, h_factor, v_factor, quant_tbl_index) tuple per component
+#	header_size is how many bytes of the file were needed to fill it in
+class JpegInfo(object):
+	__slots__ = (
+			'image_width',
+			'image_height',
+			'sample_precision',
+			'encoding_type',
+			'components',
+			'is_jfif',
+			'header_size',
+	)
+
+	def __init__(self, jpeg):
+		self.image_width = jpeg.image_width
+		self.image_height = jpeg.image_height
+		self.sample_precision = jpeg.sample_precision
+		self.encoding_type = dict(jpeg.encoding_type)
+		self.components = tuple((c['id'], c['h_factor'], c['v_factor'], c['quant_tbl_index']) for c in jpeg.components)
+		self.is_jfif = jpeg.is_jfif
+		self.header_size = jpeg._index
+
+	def __repr__(self):
+		return '<JpegInfo %dx%d, %d components>' % (self.image_width, self.image_height, len(self.components))
+
+# Where a thumbnail embedded in the headers lives, see Jpeg.embedded_thumbnail()
+#	source is the header holding it: 'JFIF' (APP0), 'JFXX' (APP0 extension) or 'EXIF' (APP1)
+#	format is 'jpeg' (a complete JPEG file), 'rgb' (packed 8 bit RGB) or 'palette' (a 256
+#		entry RGB palette followed by one index byte per pixel)
+#	width and height are None for jpeg thumbnails, probe the data for them
+#	offset and length locate the data in the file; data is only set on the ones returned by
+#		embedded_thumbnail()
+class JpegThumbnail(object):
+	__slots__ = (
+			'source',
+			'format',
+			'width',
+			'height',
+			'offset',
+			'length',
+			'data',
+	)
+
+	def __init__(self, source, format, width, height, offset, length):
+		self.source = source
+		self.format = format
+		self.width = width
+		self.height = height
+		self.offset = offset
+		self.length = length
+		self.data = None
+
+	def __repr__(self):
+		return '<JpegThumbnail %s %s, %d bytes>' % (self.source, self.format, self.length)
+
+# Read the entries of a TIFF IFD, as found in EXIF data
+#	tiff is the TIFF data, starting at its byte order mark; endian is '<' or '>'
+#	returns ({tag: (type, count, value or offset field)}, offset of the next IFD)
+#	the value field is read as a 4 byte int, see ifd_value()
+def read_ifd(tiff, endian, offset):
+	count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+	entries = {}
+	for i in range(count):
+		tag, type, number, value = struct.unpack_from(endian + 'HHII', tiff, offset + 2 + i * 12)
+		entries[tag] = (type, number, value)
+	return entries, struct.unpack_from(endian + 'I', tiff, offset + 2 + count * 12)[0]
+
+# The value of a single SHORT (type 3) or LONG (type 4) IFD entry from read_ifd()
+#	a SHORT sits in the first 2 bytes of the value field
+def ifd_value(entry, endian):
+	type, count, value = entry
+	if type == 3:
+		return value >> 16 if endian == '>' else value & 0xffff
+	return value
+
+def ceil_div(a, b):
+	return -(-a // b)
+
+# MASKS[n] has the low n bits set
+MASKS = [(1 << i) - 1 for i in range(33)]
+
+# Zero bytes appended to entropy-coded data so the bit reader can always read ahead
+#	running past these means the data was truncated or corrupt
+ENTROPY_PADDING = 64
+
+# Remove the 0x00 stuffed after every 0xff data byte in one pass over the data, and
+#	return the result as big-endian 32 bit words, which is what the bit readers consume
+#	data must not contain any markers, so split restart intervals apart first
+def unstuff(data):
+	data = bytes(data).replace(b'\xff\x00', b'\xff')
+	words = array.array('I', data + bytes(ENTROPY_PADDING + (-len(data) % 4)))
+	if sys.byteorder == 'little':
+		words.byteswap()
+	return words
+
+# Unstuffs the entropy-coded data in buf a piece at a time, for decoders that only keep
+#	what the next few MCUs need, see Jpeg.strips()
+#	words holds the unstuffed data from the word a decoder's state[0] points at
+class EntropyWindow(object):
+	CHUNK_SIZE = 65536
+
+	def __init__(self, buf):
+		self.buf = buf
+		self.index = 0
+		self.tail = b''
+		self.done = False
+		self.words = array.array('I')
+
+	# Make words hold at least count words from state's position on, if the data has that
+	#	many, dropping the ones before it
+	def fill(self, state, count):
+		words = self.words
+		del words[:state[0]]
+		state[0] = 0
+		buf = self.buf
+		while len(words) < count and not self.done:
+			end = min(self.index + max(self.CHUNK_SIZE, 4 * count), len(buf))
+			# keep a stuffed 0xff 0x00 together
+			if end < len(buf) and buf[end - 1] == 0xff:
+				end += 1
+			data = self.tail + bytes(buf[self.index:end]).replace(b'\xff\x00', b'\xff')
+			self.index = end
+			if end == len(buf):
+				data += bytes(ENTROPY_PADDING + (-len(data) % 4))
+				self.done = True
+			cut = len(data) & ~3
+			self.tail = data[cut:]
+			more = array.array('I', data[:cut])
+			if sys.byteorder == 'little':
+				more.byteswap()
+			words.extend(more)
+
+# Decode MCUs [mcu_start, mcu_end) of a huffman coded sequential scan
+#	data is the unstuffed entropy-coded data starting at mcu_start, as words from unstuff()
+#	units lists the blocks making up one MCU in coding order, each as a tuple of
+#		(coefficients, dc JpegHuffman, ac JpegHuffman, predictor, stride, h_factor, v_factor, x, y)
+#	the block is written to coefficients at block row (mcu row * v_factor + y) and block
+#		column (mcu column * h_factor + x), with stride blocks to a row and 64 coefficients
+#		to a block in zigzag order
+#	units sharing a predictor (blocks of the same component) share a DC prediction
+#	state, if given, is a [pos, acc, nbits, predictions] list to carry on from and which is
+#		updated at the end, so a run of MCUs can be decoded in several calls
+#	keep, if given, says how many of each unit's coefficients to store, in zigzag order: the
+#		rest are read past without being sign extended or stored, for when only the low
+#		frequencies are wanted (see reduced_coefficients() and Jpeg.partial_blocks())
+# The bit reader is inlined since this loop is where decoding spends most of its time
+def decode_huffman_sequential(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, state=None, keep=None):
+	masks = MASKS
+	lookahead = JpegHuffman.LOOKAHEAD
+	look_mask = masks[lookahead]
+
+	if keep is None:
+		keep = [64] * len(units)
+	units = [(coefficients, dc.lookup_table, dc, ac.lookup_table, ac, predictor, stride, h, v, x, y, stored)
+			for (coefficients, dc, ac, predictor, stride, h, v, x, y), stored in zip(units, keep)]
+
+	# acc holds the next nbits bits of input in its low bits
+	if state:
+		pos, acc, nbits, predictions = state
+	else:
+		pos, acc, nbits, predictions = 0, 0, 0, [0] * num_predictors
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc_table, dc, ac_table, ac, predictor, stride, h, v, x, y, stored in units:
+			base = ((mcu_y * v + y) * stride + mcu_x * h + x) << 6
+
+			# DC coefficient: a huffman coded magnitude category, then that many bits of difference
+			if nbits < 16:
+				acc = ((acc & masks[nbits]) << 32) | data[pos]
+				pos += 1
+				nbits += 32
+			entry = dc_table[(acc >> (nbits - lookahead)) & look_mask]
+			if entry:
+				nbits -= entry & 0x0f
+				s = entry >> 4
+			else:
+				s, length = dc.lookup((acc >> (nbits - 16)) & 0xffff)
+				nbits -= length
+			if s:
+				if nbits < s:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				nbits -= s
+				r = (acc >> nbits) & masks[s]
+				if not r >> (s - 1):
+					r -= masks[s]
+				predictions[predictor] += r
+			coefficients[base] = predictions[predictor]
+
+			# AC coefficients: (run of zeros, magnitude category) symbols, then the magnitude bits
+			k = 1
+			while k < 64:
+				if nbits < 16:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				entry = ac_table[(acc >> (nbits - lookahead)) & look_mask]
+				if entry:
+					nbits -= entry & 0x0f
+					rs = entry >> 4
+				else:
+					rs, length = ac.lookup((acc >> (nbits - 16)) & 0xffff)
+					nbits -= length
+				s = rs & 0x0f
+				if s:
+					k += rs >> 4
+					if k > 63:
+						raise BadFieldError('SOS')
+					if nbits < s:
+						acc = ((acc & masks[nbits]) << 32) | data[pos]
+						pos += 1
+						nbits += 32
+					nbits -= s
+					if k < stored:
+						r = (acc >> nbits) & masks[s]
+						if not r >> (s - 1):
+							r -= masks[s]
+						coefficients[base + k] = r
+					k += 1
+				elif rs == 0xf0:
+					# ZRL, a run of 16 zeros
+					k += 16
+				else:
+					# EOB, the rest of the block is zero
+					break
+
+	if state is not None:
+		state[:] = [pos, acc, nbits, predictions]
+
+# Count the symbols huffman coding MCUs [mcu_start, mcu_end) of a sequential scan takes
+#	units are as for decode_huffman_sequential(), with lists of 256 symbol frequencies in
+#		place of the dc and ac tables, which the counts are added to
+#	predictions holds the DC predictions to carry on from, and is updated
+#	ss and se, if given, limit the scan to coefficients ss..se, as in the first scan of a
+#		progressive band with no successive approximation: the DC alone when se is 0,
+#		AC coefficients alone when ss isn't; each block's band ends with an EOB of its own,
+#		never a run of them
+def count_huffman_sequential(units, mcus_per_row, mcu_start, mcu_end, predictions, ss=0, se=63):
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc, ac, predictor, stride, h, v, x, y in units:
+			base = ((mcu_y * v + y) * stride + mcu_x * h + x) << 6
+			if not ss:
+				value = coefficients[base]
+				dc[(value - predictions[predictor]).bit_length()] += 1
+				predictions[predictor] = value
+
+			if se:
+				run = 0
+				for value in coefficients[base + (ss or 1):base + se + 1]:
+					if value:
+						while run > 15:
+							ac[0xf0] += 1
+							run -= 16
+						ac[(run << 4) | value.bit_length()] += 1
+						run = 0
+					else:
+						run += 1
+				if run:
+					ac[0] += 1
+
+# Huffman code MCUs [mcu_start, mcu_end) of a sequential scan, the reverse of
+#	decode_huffman_sequential()
+#	units are as for decode_huffman_sequential(), with JpegHuffman.encoding_table()s in
+#		place of the dc and ac tables
+#	state is an [acc, nbits, predictions] list to carry on from, updated at the end: the
+#		last nbits bits of acc have yet to be written
+#	whole bytes of output are appended to out, before byte stuffing
+#	ss and se are as for count_huffman_sequential()
+def encode_huffman_sequential(units, mcus_per_row, mcu_start, mcu_end, state, out, ss=0, se=63):
+	masks = MASKS
+	acc, nbits, predictions = state
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc, ac, predictor, stride, h, v, x, y in units:
+			base = ((mcu_y * v + y) * stride + mcu_x * h + x) << 6
+
+			if not ss:
+				value = coefficients[base]
+				r = value - predictions[predictor]
+				predictions[predictor] = value
+				s = r.bit_length()
+				code, length = dc[s]
+				acc = (((acc << length) | code) << s) | ((r if r > 0 else r - 1) & masks[s])
+				nbits += length + s
+
+			if se:
+				run = 0
+				for value in coefficients[base + (ss or 1):base + se + 1]:
+					if not value:
+						run += 1
+						continue
+					while run > 15:
+						code, length = ac[0xf0]
+						acc = (acc << length) | code
+						nbits += length
+						run -= 16
+					s = value.bit_length()
+					code, length = ac[(run << 4) | s]
+					acc = (((acc << length) | code) << s) | ((value if value > 0 else value - 1) & masks[s])
+					nbits += length + s
+					run = 0
+					if nbits >= 32:
+						out += (acc >> (nbits & 7)).to_bytes(nbits >> 3, 'big')
+						nbits &= 7
+						acc &= masks[nbits]
+				if run:
+					code, length = ac[0]
+					acc = (acc << length) | code
+					nbits += length
+			if nbits >= 32:
+				out += (acc >> (nbits & 7)).to_bytes(nbits >> 3, 'big')
+				nbits &= 7
+				acc &= masks[nbits]
+
+	state[:] = [acc, nbits, predictions]
+
+# Pad the bits an encoder state has left out to a whole byte with 1 bits, and append them to
+#	out, see encode_huffman_sequential()
+def flush_huffman_bits(state, out):
+	acc, nbits = state[:2]
+	pad = -nbits % 8
+	out += ((acc << pad) | MASKS[pad]).to_bytes((nbits + pad) // 8, 'big')
+	state[:2] = [0, 0]
+
+# The DHT segment holding the optimal tables for a scan's symbol frequencies, and the tables'
+#	encoding_table()s by (table class, table id)
+#	frequencies has a list of 256 symbol frequencies for each (table class, table id)
+def optimal_dht_segment(frequencies):
+	segment = bytearray()
+	codes = {}
+	for (table_class, table_id), counts in sorted(frequencies.items()):
+		bits, values = optimal_huffman_table(counts)
+		codes[table_class, table_id] = huffman_table(bits, values).encoding_table()
+		segment += bytes([(table_class << 4) | table_id]) + bytes(bits) + bytes(values)
+	return b'\xff\xc4' + struct.pack('>H', len(segment) + 2) + bytes(segment), codes
+
+# Huffman code a whole sequential scan, with the optimal tables for it
+#	units, mcus_per_row and mcu_count are as scan_units() returns them, but with the unit's
+#		coefficients in place of its component and its (dc, ac) table ids in place of the
+#		tables
+#	restart_interval, if given, puts a restart marker after every that many MCUs
+#	ss and se are as for count_huffman_sequential(), for a progressive band's first scan
+#	returns the DHT segment for the tables and the byte stuffed entropy-coded data
+def encode_optimized_scan(units, mcus_per_row, mcu_count, num_predictors, restart_interval=0, ss=0, se=63):
+	restart_interval = restart_interval or mcu_count
+	intervals = [(start, min(start + restart_interval, mcu_count)) for start in range(0, mcu_count, restart_interval)]
+	# a band without the DC, or without AC coefficients, leaves that table out
+	frequencies = {}
+	for u in units:
+		if not ss:
+			frequencies.setdefault((0, u[1]), [0] * 256)
+		if se:
+			frequencies.setdefault((1, u[2]), [0] * 256)
+	counting = [(u[0], frequencies.get((0, u[1])), frequencies.get((1, u[2]))) + u[3:] for u in units]
+	for start, end in intervals:
+		count_huffman_sequential(counting, mcus_per_row, start, end, [0] * num_predictors, ss, se)
+
+	segment, codes = optimal_dht_segment(frequencies)
+	coding = [(u[0], codes.get((0, u[1])), codes.get((1, u[2]))) + u[3:] for u in units]
+	data = bytearray()
+	for i, (start, end) in enumerate(intervals):
+		if i:
+			data += bytes([0xff, 0xd0 + (i - 1) % 8])
+		state = [0, 0, [0] * num_predictors]
+		out = bytearray()
+		encode_huffman_sequential(coding, mcus_per_row, start, end, state, out, ss, se)
+		flush_huffman_bits(state, out)
+		data += bytes(out).replace(b'\xff', b'\xff\x00')
+	return segment, bytes(data)
+
+# Decode the differences of MCUs [mcu_start, mcu_end) of a huffman coded lossless scan,
+#	spec H.1.2.2: each sample is coded as a DC coefficient is, with categories up to 16
+#	units lists the samples making up one MCU, as (differences, dc JpegHuffman, stride,
+#		h_factor, v_factor, x, y), placed as decode_huffman_sequential() places blocks
+#	the differences are stored as they are, lossless_samples() undoes the prediction
+def decode_huffman_lossless(data, units, mcus_per_row, mcu_start, mcu_end):
+	masks = MASKS
+	lookahead = JpegHuffman.LOOKAHEAD
+	look_mask = masks[lookahead]
+
+	units = [(differences, table.lookup_table, table, stride, h, v, x, y)
+			for differences, table, stride, h, v, x, y in units]
+	pos, acc, nbits = 0, 0, 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for differences, lookup_table, table, stride, h, v, x, y in units:
+			if nbits < 16:
+				acc = ((acc & masks[nbits]) << 32) | data[pos]
+				pos += 1
+				nbits += 32
+			entry = lookup_table[(acc >> (nbits - lookahead)) & look_mask]
+			if entry:
+				nbits -= entry & 0x0f
+				s = entry >> 4
+			else:
+				s, length = table.lookup((acc >> (nbits - 16)) & 0xffff)
+				nbits -= length
+			if s == 16:
+				# no extra bits for the one difference in this category
+				r = 32768
+			elif s:
+				if nbits < s:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				nbits -= s
+				r = (acc >> nbits) & masks[s]
+				if not r >> (s - 1):
+					r -= masks[s]
+			else:
+				r = 0
+			differences[(mcu_y * v + y) * stride + mcu_x * h + x] = r
+
+# Lossless predictors, spec table H.1, from the samples left (ra), above (rb) and above
+#	left (rc)
+LOSSLESS_PREDICTORS = {
+		1: lambda ra, rb, rc: ra,
+		2: lambda ra, rb, rc: rb,
+		3: lambda ra, rb, rc: rc,
+		4: lambda ra, rb, rc: ra + rb - rc,
+		5: lambda ra, rb, rc: ra + ((rb - rc) >> 1),
+		6: lambda ra, rb, rc: rb + ((ra - rc) >> 1),
+		7: lambda ra, rb, rc: (ra + rb) >> 1,
+}
+
+# Turn the differences of a lossless scan of one component into its samples, in place
+#	samples is width x height, stride to a row; first_rows are the rows that start a restart
+#		interval, which like the first are predicted from the left, and from 2 ** (precision -
+#		point_transform - 1) at their start; every other row starts from the sample above
+#	samples are modulo 2 ** (precision - point_transform), and shifted up by point_transform
+#		at the end; the spec reconstructs modulo 2 ** 16, which is the same for any
+#		difference an encoder can make, and this keeps corrupt ones inside the precision
+def lossless_samples_python(samples, width, height, stride, predictor, precision, point_transform, first_rows):
+	predict = LOSSLESS_PREDICTORS[predictor]
+	initial = 1 << (precision - point_transform - 1)
+	mask = (1 << (precision - point_transform)) - 1
+	above = None
+	for y in range(height):
+		start = y * stride
+		row = samples[start:start + width]
+		if above is None or y in first_rows:
+			ra = initial
+			for x in range(width):
+				ra = row[x] = (ra + row[x]) & mask
+		else:
+			ra = row[0] = (above[0] + row[0]) & mask
+			for x in range(1, width):
+				ra = row[x] = (predict(ra, above[x], above[x - 1]) + row[x]) & mask
+		samples[start:start + width] = row
+		above = row
+	if point_transform:
+		for y in range(height):
+			start = y * stride
+			samples[start:start + width] = array.array(samples.typecode, [s << point_transform for s in samples[start:start + width]])
+
+# The same with NumPy: every predictor but 6 and 7 makes each row a cumulative sum of its
+#	differences and something from the row above, so rows are done whole; 6 and 7 take the
+#	left sample other than as a plain sum and go a sample at a time
+def lossless_samples_numpy(samples, width, height, stride, predictor, precision, point_transform, first_rows):
+	plane = numpy.frombuffer(samples, dtype=numpy.int32).reshape(-1, stride)[:height, :width]
+	predict = LOSSLESS_PREDICTORS[predictor]
+	initial = 1 << (precision - point_transform - 1)
+	mask = (1 << (precision - point_transform)) - 1
+	above = None
+	for y in range(height):
+		row = plane[y].astype(numpy.int64)
+		if above is None or y in first_rows:
+			row[0] += initial
+			row = numpy.cumsum(row)
+		elif predictor == 2:
+			row += above
+		elif predictor == 3:
+			row[0] += above[0]
+			row[1:] += above[:-1]
+		elif predictor in (1, 4, 5):
+			row[0] += above[0]
+			if predictor == 4:
+				row[1:] += numpy.diff(above)
+			elif predictor == 5:
+				row[1:] += numpy.diff(above) >> 1
+			row = numpy.cumsum(row)
+		else:
+			values = row.tolist()
+			b = above.tolist()
+			ra = values[0] = (b[0] + values[0]) & mask
+			for x in range(1, width):
+				ra = values[x] = (predict(ra, b[x], b[x - 1]) + values[x]) & mask
+			row = numpy.array(values, dtype=numpy.int64)
+		row &= mask
+		plane[y] = row
+		above = row
+	if point_transform:
+		plane <<= point_transform
+
+# Progressive scans, spec G.1.2: each codes one band of coefficients [ss, se] of the blocks
+#	(either just the DC or a band of AC coefficients), less al low bits of precision, and
+#	later refinement scans add those bits one at a time
+# These all take the same arguments, with the same meaning as for decode_huffman_sequential(),
+#	and add this scan's part of every block to coefficients already holding the earlier scans'
+
+# First DC scan: the DC differences as for a sequential scan, scaled up by al bits
+def decode_huffman_dc_first(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	masks = MASKS
+	lookahead = JpegHuffman.LOOKAHEAD
+	look_mask = masks[lookahead]
+
+	units = [(coefficients, dc.lookup_table, dc, predictor, stride, h, v, x, y)
+			for coefficients, dc, ac, predictor, stride, h, v, x, y in units]
+	predictions = [0] * num_predictors
+
+	acc = 0
+	nbits = 0
+	pos = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc_table, dc, predictor, stride, h, v, x, y in units:
+			if nbits < 16:
+				acc = ((acc & masks[nbits]) << 32) | data[pos]
+				pos += 1
+				nbits += 32
+			entry = dc_table[(acc >> (nbits - lookahead)) & look_mask]
+			if entry:
+				nbits -= entry & 0x0f
+				s = entry >> 4
+			else:
+				s, length = dc.lookup((acc >> (nbits - 16)) & 0xffff)
+				nbits -= length
+			if s:
+				if nbits < s:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				nbits -= s
+				r = (acc >> nbits) & masks[s]
+				if not r >> (s - 1):
+					r -= masks[s]
+				predictions[predictor] += r
+			coefficients[((mcu_y * v + y) * stride + mcu_x * h + x) << 6] = predictions[predictor] << al
+
+# DC refinement: one more bit of every DC coefficient, no huffman coding involved
+def decode_huffman_dc_refine(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	masks = MASKS
+	bit = 1 << al
+
+	acc = 0
+	nbits = 0
+	pos = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc, ac, predictor, stride, h, v, x, y in units:
+			if not nbits:
+				acc = data[pos]
+				pos += 1
+				nbits = 32
+			nbits -= 1
+			if (acc >> nbits) & 1:
+				coefficients[((mcu_y * v + y) * stride + mcu_x * h + x) << 6] |= bit
+
+# First AC scan of a band: like the AC part of a sequential scan, except that an EOB symbol
+#	with run r ends this block and the next (2 ** r + r more bits) - 1 ones as well
+# AC scans always hold a single component, so there is one unit
+def decode_huffman_ac_first(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	masks = MASKS
+	lookahead = JpegHuffman.LOOKAHEAD
+	look_mask = masks[lookahead]
+	coefficients, dc, ac, predictor, stride, h, v, x, y = units[0]
+	ac_table = ac.lookup_table
+
+	acc = 0
+	nbits = 0
+	pos = 0
+	eob_run = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		if eob_run:
+			eob_run -= 1
+			continue
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		base = (mcu_y * stride + mcu_x) << 6
+
+		k = ss
+		while k <= se:
+			if nbits < 16:
+				acc = ((acc & masks[nbits]) << 32) | data[pos]
+				pos += 1
+				nbits += 32
+			entry = ac_table[(acc >> (nbits - lookahead)) & look_mask]
+			if entry:
+				nbits -= entry & 0x0f
+				rs = entry >> 4
+			else:
+				rs, length = ac.lookup((acc >> (nbits - 16)) & 0xffff)
+				nbits -= length
+			s = rs & 0x0f
+			r = rs >> 4
+			if s:
+				k += r
+				if k > se:
+					raise BadFieldError('SOS')
+				if nbits < s:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				nbits -= s
+				value = (acc >> nbits) & masks[s]
+				if not value >> (s - 1):
+					value -= masks[s]
+				coefficients[base + k] = value << al
+				k += 1
+			elif r == 15:
+				k += 16
+			else:
+				eob_run = 1 << r
+				if r:
+					if nbits < r:
+						acc = ((acc & masks[nbits]) << 32) | data[pos]
+						pos += 1
+						nbits += 32
+					nbits -= r
+					eob_run += (acc >> nbits) & masks[r]
+				eob_run -= 1
+				break
+
+# AC refinement: one more bit of every coefficient of the band
+#	coefficients that are already nonzero get a correction bit each, in order, wherever the
+#		coding of the rest happens to be
+#	newly nonzero ones (which can only be +-1 at this bit) are coded as a run of zero valued
+#		coefficients to skip, then a sign bit
+#	an EOB run covers the blocks where only correction bits are left
+# This follows libjpeg's decode_mcu_AC_refine()
+def decode_huffman_ac_refine(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	masks = MASKS
+	lookahead = JpegHuffman.LOOKAHEAD
+	look_mask = masks[lookahead]
+	coefficients, dc, ac, predictor, stride, h, v, x, y = units[0]
+	ac_table = ac.lookup_table
+	positive = 1 << al
+	negative = -1 << al
+
+	acc = 0
+	nbits = 0
+	pos = 0
+	eob_run = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		base = (mcu_y * stride + mcu_x) << 6
+
+		k = ss
+		if not eob_run:
+			while k <= se:
+				if nbits < 16:
+					acc = ((acc & masks[nbits]) << 32) | data[pos]
+					pos += 1
+					nbits += 32
+				entry = ac_table[(acc >> (nbits - lookahead)) & look_mask]
+				if entry:
+					nbits -= entry & 0x0f
+					rs = entry >> 4
+				else:
+					rs, length = ac.lookup((acc >> (nbits - 16)) & 0xffff)
+					nbits -= length
+				s = rs & 0x0f
+				r = rs >> 4
+				if s:
+					# the one new coefficient, and its sign
+					if s != 1:
+						raise BadFieldError('SOS')
+					if not nbits:
+						acc = data[pos]
+						pos += 1
+						nbits = 32
+					nbits -= 1
+					s = positive if (acc >> nbits) & 1 else negative
+				elif r != 15:
+					eob_run = 1 << r
+					if r:
+						if nbits < r:
+							acc = ((acc & masks[nbits]) << 32) | data[pos]
+							pos += 1
+							nbits += 32
+						nbits -= r
+						eob_run += (acc >> nbits) & masks[r]
+					break
+				# else ZRL: skip 16 zero valued coefficients, refining the nonzero ones on the way
+
+				# refine nonzero coefficients up to the r + 1'th zero valued one
+				while k <= se:
+					value = coefficients[base + k]
+					if value:
+						if not nbits:
+							acc = data[pos]
+							pos += 1
+							nbits = 32
+						nbits -= 1
+						if (acc >> nbits) & 1 and not value & positive:
+							coefficients[base + k] = value + (positive if value >= 0 else negative)
+					else:
+						r -= 1
+						if r < 0:
+							break
+					k += 1
+				if s:
+					if k > se:
+						raise BadFieldError('SOS')
+					coefficients[base + k] = s
+				k += 1
+
+		if eob_run:
+			# only correction bits for the rest of the band
+			while k <= se:
+				value = coefficients[base + k]
+				if value:
+					if not nbits:
+						acc = data[pos]
+						pos += 1
+						nbits = 32
+					nbits -= 1
+					if (acc >> nbits) & 1 and not value & positive:
+						coefficients[base + k] = value + (positive if value >= 0 else negative)
+				k += 1
+			eob_run -= 1
+
+# Arithmetic coded scans (spec annex D and F.1.4.4 / G.1.3.3) code every decision with the
+#	QM-coder, which keeps an adaptive probability estimate per context in a byte of statistics:
+#	the index of the estimate's state in QM_STATES and the more probable symbol in the top bit
+# QM_STATES is table D.2 as (Qe, Next_Index_LPS, Next_Index_MPS, Switch_MPS), plus a last
+#	state that keeps a fixed estimate of 0.5 for the sign bits and correction bits, like libjpeg
+QM_STATES = [
+		(0x5a1d, 1, 1, 1), (0x2586, 14, 2, 0), (0x1114, 16, 3, 0), (0x080b, 18, 4, 0),
+		(0x03d8, 20, 5, 0), (0x01da, 23, 6, 0), (0x00e5, 25, 7, 0), (0x006f, 28, 8, 0),
+		(0x0036, 30, 9, 0), (0x001a, 33, 10, 0), (0x000d, 35, 11, 0), (0x0006, 9, 12, 0),
+		(0x0003, 10, 13, 0), (0x0001, 12, 13, 0), (0x5a7f, 15, 15, 1), (0x3f25, 36, 16, 0),
+		(0x2cf2, 38, 17, 0), (0x207c, 39, 18, 0), (0x17b9, 40, 19, 0), (0x1182, 42, 20, 0),
+		(0x0cef, 43, 21, 0), (0x09a1, 45, 22, 0), (0x072f, 46, 23, 0), (0x055c, 48, 24, 0),
+		(0x0406, 49, 25, 0), (0x0303, 51, 26, 0), (0x0240, 52, 27, 0), (0x01b1, 54, 28, 0),
+		(0x0144, 56, 29, 0), (0x00f5, 57, 30, 0), (0x00b7, 59, 31, 0), (0x008a, 60, 32, 0),
+		(0x0068, 62, 33, 0), (0x004e, 63, 34, 0), (0x003b, 32, 35, 0), (0x002c, 33, 9, 0),
+		(0x5ae1, 37, 37, 1), (0x484c, 64, 38, 0), (0x3a0d, 65, 39, 0), (0x2ef1, 67, 40, 0),
+		(0x261f, 68, 41, 0), (0x1f33, 69, 42, 0), (0x19a8, 70, 43, 0), (0x1518, 72, 44, 0),
+		(0x1177, 73, 45, 0), (0x0e74, 74, 46, 0), (0x0bfb, 75, 47, 0), (0x09f8, 77, 48, 0),
+		(0x0861, 78, 49, 0), (0x0706, 79, 50, 0), (0x05cd, 48, 51, 0), (0x04de, 50, 52, 0),
+		(0x040f, 50, 53, 0), (0x0363, 51, 54, 0), (0x02d4, 52, 55, 0), (0x025c, 53, 56, 0),
+		(0x01f8, 54, 57, 0), (0x01a4, 55, 58, 0), (0x0160, 56, 59, 0), (0x0125, 57, 60, 0),
+		(0x00f6, 58, 61, 0), (0x00cb, 59, 62, 0), (0x00ab, 61, 63, 0), (0x008f, 61, 32, 0),
+		(0x5b12, 65, 65, 1), (0x4d04, 80, 66, 0), (0x412c, 81, 67, 0), (0x37d8, 82, 68, 0),
+		(0x2fe8, 83, 69, 0), (0x293c, 84, 70, 0), (0x2379, 86, 71, 0), (0x1edf, 87, 72, 0),
+		(0x1aa9, 87, 73, 0), (0x174e, 72, 74, 0), (0x1424, 72, 75, 0), (0x119c, 74, 76, 0),
+		(0x0f6b, 74, 77, 0), (0x0d51, 75, 78, 0), (0x0bb6, 77, 79, 0), (0x0a40, 77, 48, 0),
+		(0x5832, 80, 81, 1), (0x4d1c, 88, 82, 0), (0x438e, 89, 83, 0), (0x3bdd, 90, 84, 0),
+		(0x34ee, 91, 85, 0), (0x2eae, 92, 86, 0), (0x299a, 93, 87, 0), (0x2516, 86, 71, 0),
+		(0x5570, 88, 89, 1), (0x4ca9, 95, 90, 0), (0x44d9, 96, 91, 0), (0x3e22, 97, 92, 0),
+		(0x3824, 99, 93, 0), (0x32b4, 99, 94, 0), (0x2e17, 93, 86, 0), (0x56a8, 95, 96, 1),
+		(0x4f46, 101, 97, 0), (0x47e5, 102, 98, 0), (0x41cf, 103, 99, 0), (0x3c3d, 104, 100, 0),
+		(0x375e, 99, 93, 0), (0x5231, 105, 102, 0), (0x4c0f, 106, 103, 0), (0x4639, 107, 104, 0),
+		(0x415e, 103, 99, 0), (0x5627, 105, 106, 1), (0x50e7, 108, 107, 0), (0x4b85, 109, 103, 0),
+		(0x5597, 110, 109, 0), (0x504f, 111, 107, 0), (0x5a10, 110, 111, 1), (0x5522, 112, 109, 0),
+		(0x59eb, 112, 111, 1), (0x5a1d, 113, 113, 0)]
+QM_FIXED = len(QM_STATES) - 1
+# Qe, and the statistics byte after an LPS and after an MPS renormalization, for every value
+#	of the statistics byte; state numbers past QM_FIXED are never used and only pad them out
+QM_PADDING = [(0, 0, 0, 0)] * (128 - len(QM_STATES))
+QM_QE = [qe for mps in (0, 0x80) for qe, nlps, nmps, switch in QM_STATES + QM_PADDING]
+QM_NEXT_LPS = [(mps ^ (switch << 7)) | nlps for mps in (0, 0x80) for qe, nlps, nmps, switch in QM_STATES + QM_PADDING]
+QM_NEXT_MPS = [mps | nmps for mps in (0, 0x80) for qe, nlps, nmps, switch in QM_STATES + QM_PADDING]
+
+# Statistics bins per table, spec tables F.4 and F.5
+ARITHMETIC_DC_BINS = 64
+ARITHMETIC_AC_BINS = 256
+
+# The QM-coder decoders below decode one restart interval each
+#	data is its entropy-coded data with the stuffed 0x00 bytes removed; past its end the
+#	decoder reads zeros, the same as when it runs into a marker (spec D.2.6)
+#	units are as for the huffman decoders, except that they hold (table, L, U) as the DC and
+#	(table, Kx) as the AC item: the table number and its conditioning from DAC
+# The decoder (spec D.2) is inlined, like the huffman bit reader: each pass round a block's
+#	loop makes one decision with the estimate in stats[st], phase saying what it is for
+#	c is the code register, a the interval size and ct counts the bits left in c's input byte
+# Every restart interval starts from fresh statistics, so each call makes its own
+
+# Statistics arrays for the tables units use, and units with them in place of the tables:
+#	(coefficients, dc statistics, L, U, ac statistics, Kx, predictor, stride, h, v, x, y)
+def arithmetic_units(units):
+	dc_stats = {}
+	ac_stats = {}
+	prepared = []
+	for coefficients, dc, ac, predictor, stride, h, v, x, y in units:
+		dc_table, dc_l, dc_u = dc
+		ac_table, ac_k = ac
+		if dc_table not in dc_stats:
+			dc_stats[dc_table] = bytearray(ARITHMETIC_DC_BINS)
+		if ac_table not in ac_stats:
+			ac_stats[ac_table] = bytearray(ARITHMETIC_AC_BINS)
+		prepared.append((coefficients, dc_stats[dc_table], dc_l, dc_u, ac_stats[ac_table], ac_k,
+				predictor, stride, h, v, x, y))
+	return prepared
+
+# Decode MCUs [mcu_start, mcu_end) of an arithmetic coded sequential scan, or the first scan
+#	of a progressive band: coefficients ss..se of each block, scaled up by al bits
+#	the DC difference is decoded as in spec F.1.4.4.1 (figures F.19 to F.24), with the
+#		component's conditioning category as the statistics bin S0 it starts from
+#	the AC coefficients as in F.1.4.4.2 (figure F.20)
+# Each decision's phase is one of
+#	0 AC end of block		1 AC coefficient nonzero, then its sign with the fixed estimate
+#	2 AC magnitude category	3 AC magnitude bits
+#	4 DC difference nonzero	5 DC sign	6 DC magnitude category		7 DC magnitude bits
+#	the magnitude categories are decisions whether m, the magnitude's top bit, goes on up
+def decode_arithmetic_sequential(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss=0, se=63, al=0):
+	qm_qe = QM_QE
+	qm_next_lps = QM_NEXT_LPS
+	qm_next_mps = QM_NEXT_MPS
+	fixed_qe = QM_QE[QM_FIXED]
+	size = len(data)
+	units = arithmetic_units(units)
+	predictions = [0] * num_predictors
+	contexts = [0] * num_predictors
+	# INITDEC
+	c = int.from_bytes(data[:2].ljust(2, b'\x00'), 'big')
+	pos = 2
+	a = 0x10000
+	ct = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc_stats, dc_l, dc_u, ac_stats, ac_k, predictor, stride, h, v, x, y in units:
+			base = ((mcu_y * v + y) * stride + mcu_x * h + x) << 6
+			if ss:
+				k = ss - 1
+				stats = ac_stats
+				st = 3 * k
+				phase = 0
+			else:
+				stats = dc_stats
+				st = contexts[predictor]
+				phase = 4
+
+			while True:
+				# RENORMD, with BYTEIN reading zeros past the end
+				while a < 0x8000:
+					ct -= 1
+					if ct < 0:
+						c <<= 8
+						if pos < size:
+							c |= data[pos]
+							pos += 1
+						ct = 7
+					a <<= 1
+
+				sv = stats[st]
+				qe = qm_qe[sv]
+				a -= qe
+				scaled = a << ct
+				if c >= scaled:
+					# the lower, LPS subinterval, unless the conditional exchange applies
+					c -= scaled
+					if a < qe:
+						stats[st] = qm_next_mps[sv]
+					else:
+						stats[st] = qm_next_lps[sv]
+						sv ^= 0x80
+					a = qe
+				elif a < 0x8000:
+					if a < qe:
+						stats[st] = qm_next_lps[sv]
+						sv ^= 0x80
+					else:
+						stats[st] = qm_next_mps[sv]
+
+				# the AC phases, most common first
+				if phase == 2:
+					if sv >> 7:
+						if m > 1:
+							m <<= 1
+							if m == 0x8000:
+								raise BadFieldError('SOS')
+							st += 1
+						elif m:
+							m = 2
+							st = 189 if k <= ac_k else 217
+						else:
+							m = 1
+						continue
+				elif phase == 1:
+					if not sv >> 7:
+						if k >= se:
+							raise BadFieldError('SOS')
+						k += 1
+						st += 3
+						continue
+
+					# the sign: the fixed estimate never changes, so its decision is simpler
+					while a < 0x8000:
+						ct -= 1
+						if ct < 0:
+							c <<= 8
+							if pos < size:
+								c |= data[pos]
+								pos += 1
+							ct = 7
+						a <<= 1
+					a -= fixed_qe
+					scaled = a << ct
+					if c >= scaled:
+						c -= scaled
+						sign = a >= fixed_qe
+						a = fixed_qe
+					else:
+						sign = a < fixed_qe
+					m = 0
+					st += 1
+					phase = 2
+					continue
+				elif phase == 3:
+					if sv >> 7:
+						value |= m
+					m >>= 1
+					if m:
+						continue
+					coefficients[base + k] = (~value if sign else value + 1) << al
+					if k >= se:
+						break
+					st = 3 * k
+					phase = 0
+					continue
+				elif phase == 0:
+					if sv >> 7:
+						break
+					k += 1
+					st += 1
+					phase = 1
+					continue
+
+				# the DC phases
+				elif phase == 4:
+					if sv >> 7:
+						st += 1
+						phase = 5
+						continue
+					contexts[predictor] = 0
+				elif phase == 5:
+					sign = sv >> 7
+					st += 1 + sign
+					m = 0
+					phase = 6
+					continue
+				elif phase == 6:
+					if sv >> 7:
+						if m:
+							m <<= 1
+							if m == 0x8000:
+								raise BadFieldError('SOS')
+							st += 1
+						else:
+							m = 1
+							st = 20
+						continue
+					# the category for the component's next difference
+					if m < (1 << dc_l) >> 1:
+						contexts[predictor] = 0
+					elif m > (1 << dc_u) >> 1:
+						contexts[predictor] = 12 + sign * 4
+					else:
+						contexts[predictor] = 4 + sign * 4
+				else:
+					if sv >> 7:
+						value |= m
+					m >>= 1
+					if m:
+						continue
+
+				if phase >= 4:
+					# the end of a DC difference
+					if phase == 6:
+						value = m
+						m >>= 1
+						if m:
+							st += 14
+							phase = 7
+							continue
+					if phase != 4:
+						predictions[predictor] += ~value if sign else value + 1
+					coefficients[base] = predictions[predictor] << al
+					if se == 0:
+						break
+					k = 0
+					stats = ac_stats
+					st = 0
+					phase = 0
+					continue
+
+				# the end of an AC magnitude category
+				value = m
+				m >>= 1
+				if m:
+					st += 14
+					phase = 3
+					continue
+				coefficients[base + k] = (~value if sign else value + 1) << al
+				if k >= se:
+					break
+				st = 3 * k
+				phase = 0
+
+# DC refinement: one more bit of every DC coefficient, each with the fixed estimate
+def decode_arithmetic_dc_refine(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	qm_qe = QM_QE
+	qm_next_lps = QM_NEXT_LPS
+	qm_next_mps = QM_NEXT_MPS
+	size = len(data)
+	stats = bytearray([QM_FIXED])
+	st = 0
+	bit = 1 << al
+	# INITDEC
+	c = int.from_bytes(data[:2].ljust(2, b'\x00'), 'big')
+	pos = 2
+	a = 0x10000
+	ct = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		for coefficients, dc, ac, predictor, stride, h, v, x, y in units:
+			# RENORMD, with BYTEIN reading zeros past the end
+			while a < 0x8000:
+				ct -= 1
+				if ct < 0:
+					c <<= 8
+					if pos < size:
+						c |= data[pos]
+						pos += 1
+					ct = 7
+				a <<= 1
+
+			sv = stats[st]
+			qe = qm_qe[sv]
+			a -= qe
+			scaled = a << ct
+			if c >= scaled:
+				# the lower, LPS subinterval, unless the conditional exchange applies
+				c -= scaled
+				if a < qe:
+					stats[st] = qm_next_mps[sv]
+				else:
+					stats[st] = qm_next_lps[sv]
+					sv ^= 0x80
+				a = qe
+			elif a < 0x8000:
+				if a < qe:
+					stats[st] = qm_next_lps[sv]
+					sv ^= 0x80
+				else:
+					stats[st] = qm_next_mps[sv]
+
+			if sv >> 7:
+				coefficients[((mcu_y * v + y) * stride + mcu_x * h + x) << 6] |= bit
+
+# AC refinement, spec G.1.3.3.1: past the end of block of the earlier scans (eobx) an end of
+#	block decision comes first at each index; then coefficients that are already nonzero get
+#	a correction bit, and zero ones a decision whether they become +-1 at this bit
+# Each decision's phase is one of
+#	0 end of block		1 correction bit		2 coefficient becomes nonzero		3 its sign
+def decode_arithmetic_ac_refine(data, units, mcus_per_row, mcu_start, mcu_end, num_predictors, ss, se, al):
+	qm_qe = QM_QE
+	qm_next_lps = QM_NEXT_LPS
+	qm_next_mps = QM_NEXT_MPS
+	size = len(data)
+	fixed = bytearray([QM_FIXED])
+	(coefficients, dc_stats, dc_l, dc_u, ac_stats, ac_k, predictor, stride, h, v, x, y), = arithmetic_units(units)
+	positive = 1 << al
+	negative = -1 << al
+	# INITDEC
+	c = int.from_bytes(data[:2].ljust(2, b'\x00'), 'big')
+	pos = 2
+	a = 0x10000
+	ct = 0
+
+	for mcu in range(mcu_start, mcu_end):
+		mcu_y, mcu_x = divmod(mcu, mcus_per_row)
+		base = (mcu_y * stride + mcu_x) << 6
+
+		eobx = se
+		while eobx > 0 and not coefficients[base + eobx]:
+			eobx -= 1
+
+		stats = ac_stats
+		k = ss - 1
+		if k >= eobx:
+			st = 3 * k
+			phase = 0
+		else:
+			k += 1
+			value = coefficients[base + k]
+			st = 3 * k - (1 if value else 2)
+			phase = 1 if value else 2
+
+		while True:
+			# RENORMD, with BYTEIN reading zeros past the end
+			while a < 0x8000:
+				ct -= 1
+				if ct < 0:
+					c <<= 8
+					if pos < size:
+						c |= data[pos]
+						pos += 1
+					ct = 7
+				a <<= 1
+
+			sv = stats[st]
+			qe = qm_qe[sv]
+			a -= qe
+			scaled = a << ct
+			if c >= scaled:
+				# the lower, LPS subinterval, unless the conditional exchange applies
+				c -= scaled
+				if a < qe:
+					stats[st] = qm_next_mps[sv]
+				else:
+					stats[st] = qm_next_lps[sv]
+					sv ^= 0x80
+				a = qe
+			elif a < 0x8000:
+				if a < qe:
+					stats[st] = qm_next_lps[sv]
+					sv ^= 0x80
+				else:
+					stats[st] = qm_next_mps[sv]
+
+			if phase == 2:
+				if sv >> 7:
+					stats = fixed
+					st = 0
+					phase = 3
+					continue
+				if k >= se:
+					raise BadFieldError('SOS')
+			elif phase == 0:
+				if sv >> 7:
+					break
+			else:
+				if phase == 1:
+					if sv >> 7:
+						coefficients[base + k] = value + (negative if value < 0 else positive)
+				else:
+					coefficients[base + k] = negative if sv >> 7 else positive
+					stats = ac_stats
+				if k >= se:
+					break
+				if k >= eobx:
+					st = 3 * k
+					phase = 0
+					continue
+
+			# on to the next index
+			k += 1
+			value = coefficients[base + k]
+			st = 3 * k - (1 if value else 2)
+			phase = 1 if value else 2
+
+# Lossless transforms, see Jpeg.transform(), as (transpose, flip horizontally, flip
+#	vertically): the image is transposed first, and then flipped
+TRANSFORMS = {
+		'flip_horizontal': (False, True, False),
+		'flip_vertical': (False, False, True),
+		'rotate_180': (False, True, True),
+		'transpose': (True, False, False),
+		'rotate_90': (True, True, False),
+		'rotate_270': (True, False, True),
+		'transverse': (True, True, True),
+}
+
+# The transform that makes an image with each EXIF orientation upright
+EXIF_ORIENTATIONS = {
+		1: None,
+		2: 'flip_horizontal',
+		3: 'rotate_180',
+		4: 'flip_vertical',
+		5: 'transpose',
+		6: 'rotate_90',
+		7: 'transverse',
+		8: 'rotate_270',
+}
+
+# What a transform does inside a block, as a (zigzag index, sign) for each coefficient of
+#	the transformed block in zigzag order
+#	transposing swaps the horizontal and vertical frequencies, and flipping negates the
+#	coefficients odd in that direction
+def transform_block_order(transpose, flip_x, flip_y):
+	order = []
+	for n in ZIGZAG_NATURAL:
+		row, column = n >> 3, n & 7
+		source = (column << 3) | row if transpose else n
+		negate = (flip_x and column & 1) ^ (flip_y and row & 1)
+		order.append((NATURAL_ZIGZAG[source], -1 if negate else 1))
+	return order
+
+# Backends for the pixel reconstruction stages
+BACKENDS = ('python', 'numpy')
+DEFAULT_BACKEND = 'numpy' if numpy is not None else 'python'
+
+def check_backend(backend):
+	if backend is None:
+		return DEFAULT_BACKEND
+	if backend not in BACKENDS or (backend == 'numpy' and numpy is None):
+		raise ValueError(backend)
+	return backend
+
+# Decoding scales, as the IDCT size each needs: a block becomes size x size samples
+#	when decoding at size / 8 of full scale
+def scale_size(scale):
+	size = 8 * scale
+	if size not in (1, 2, 4, 8):
+		raise ValueError(scale)
+	return int(size)
+
+# Sample value clamping table for a sample precision, indexed by value + RANGE_LIMIT_OFFSET
+#	it covers whatever valid coefficients can give, but not all that corrupt ones can,
+#	see ClampedRangeLimit
+RANGE_LIMIT_OFFSET = 1 << 16
+range_limits = {}
+
+def range_limit(precision):
+	table = range_limits.get(precision)
+	if table is None:
+		maxval = (1 << precision) - 1
+		table = [0] * RANGE_LIMIT_OFFSET + list(range(maxval + 1)) + [maxval] * (RANGE_LIMIT_OFFSET + 1 - maxval)
+		range_limits[precision] = table
+	return table
+
+# Indexes like a range_limit() table, clamping indices past either end first
+#	list indexing raises past the end, and silently wraps below the start
+class ClampedRangeLimit(object):
+	def __init__(self, table):
+		self.table = table
+		self.last = len(table) - 1
+
+	def __getitem__(self, index):
+		return self.table[min(max(index, 0), self.last)]
+
+# The largest first pass output a block's IDCT can have for the second pass to stay inside
+#	range_limit(precision): that pass gains at most 11.4 times, the 8 point AAN one
+#	blocks past this, which only corrupt coefficients give, are clamped sample by sample
+def idct_pass_limit(precision):
+	return (RANGE_LIMIT_OFFSET - (1 << precision)) / 12.0
+
+# Scale factors of the AAN (Arai, Agui, Nakajima) IDCT, folded into the dequantization
+#	table so the python IDCT needs only 5 multiplies per row / column
+AAN_SCALE_FACTORS = [1.0, 1.387039845, 1.306562965, 1.175875602,
+		1.0, 0.785694958, 0.541196100, 0.275899379]
+
+# Quantization table (natural order) --> AAN scaled multipliers in natural order
+#	the 1/8 of the 2-D IDCT is folded in as well
+def aan_dequant_table(qtable):
+	return [qtable[i] * AAN_SCALE_FACTORS[i >> 3] * AAN_SCALE_FACTORS[i & 7] / 8.0 for i in range(64)]
+
+# Pure python dequantization and IDCT of a whole component
+#	blocks holds blocks_w * blocks_h blocks of zigzag ordered coefficients, see Jpeg.decode_scans()
+#	returns the samples as a bytearray (or an array('H') above 8 bit precision)
+#		with a row stride of blocks_w * size
+# At full size this is the floating point AAN IDCT used by libjpeg's jidctflt.c,
+#	see idct_plane_scaled_python() for the others
+def idct_plane_python(blocks, qtable, blocks_w, blocks_h, precision=8, size=8):
+	if size != 8:
+		return idct_plane_scaled_python(blocks, qtable, blocks_w, blocks_h, precision, size)
+	stride = blocks_w * 8
+	if precision > 8:
+		plane = array.array('H', bytes(2 * stride * blocks_h * 8))
+		make_row = lambda values: array.array('H', values)
+	else:
+		plane = bytearray(stride * blocks_h * 8)
+		make_row = bytes
+
+	limit = range_limit(precision)
+	clamped = ClampedRangeLimit(limit)
+	pass_limit = idct_pass_limit(precision)
+	# level shift and rounding, with the offset into the range limit table
+	center = RANGE_LIMIT_OFFSET + (1 << (precision - 1)) + 0.5
+	dequant = cached_aan_dequant_table(qtable)
+	# dequantize in natural order, straight from the zigzag ordered block
+	order = list(zip(NATURAL_ZIGZAG, dequant))
+	ws = [0.0] * 64
+
+	for by in range(blocks_h):
+		for bx in range(blocks_w):
+			base = (by * blocks_w + bx) << 6
+			block = blocks[base:base + 64]
+			out = (by * 8 * stride) + bx * 8
+
+			# flat blocks are common, and are just their DC value
+			if not any(block[1:]):
+				value = clamped[int(block[0] * dequant[0] + center)]
+				row = make_row([value]) * 8
+				for y in range(8):
+					plane[out:out + 8] = row
+					out += stride
+				continue
+
+			coef = [block[k] * q for k, q in order]
+
+			# pass 1: columns, into the work array
+			for c in range(8):
+				if not (coef[8 + c] or coef[16 + c] or coef[24 + c] or coef[32 + c] or coef[40 + c] or coef[48 + c] or coef[56 + c]):
+					dc = coef[c]
+					ws[c] = ws[8 + c] = ws[16 + c] = ws[24 + c] = ws[32 + c] = ws[40 + c] = ws[48 + c] = ws[56 + c] = dc
+					continue
+
+				# even part
+				tmp0 = coef[c]
+				tmp1 = coef[16 + c]
+				tmp2 = coef[32 + c]
+				tmp3 = coef[48 + c]
+				tmp10 = tmp0 + tmp2
+				tmp11 = tmp0 - tmp2
+				tmp13 = tmp1 + tmp3
+				tmp12 = (tmp1 - tmp3) * 1.414213562 - tmp13
+				tmp0 = tmp10 + tmp13
+				tmp3 = tmp10 - tmp13
+				tmp1 = tmp11 + tmp12
+				tmp2 = tmp11 - tmp12
+
+				# odd part
+				z13 = coef[40 + c] + coef[24 + c]
+				z10 = coef[40 + c] - coef[24 + c]
+				z11 = coef[8 + c] + coef[56 + c]
+				z12 = coef[8 + c] - coef[56 + c]
+				tmp7 = z11 + z13
+				tmp11 = (z11 - z13) * 1.414213562
+				z5 = (z10 + z12) * 1.847759065
+				tmp10 = 1.082392200 * z12 - z5
+				tmp12 = -2.613125930 * z10 + z5
+				tmp6 = tmp12 - tmp7
+				tmp5 = tmp11 - tmp6
+				tmp4 = tmp10 + tmp5
+
+				ws[c] = tmp0 + tmp7
+				ws[56 + c] = tmp0 - tmp7
+				ws[8 + c] = tmp1 + tmp6
+				ws[48 + c] = tmp1 - tmp6
+				ws[16 + c] = tmp2 + tmp5
+				ws[40 + c] = tmp2 - tmp5
+				ws[32 + c] = tmp3 + tmp4
+				ws[24 + c] = tmp3 - tmp4
+
+			# pass 2: rows, level shifted and clamped into the output
+			lookup = limit if -pass_limit <= min(ws) and max(ws) <= pass_limit else clamped
+			for r in range(0, 64, 8):
+				tmp10 = ws[r] + ws[r + 4]
+				tmp11 = ws[r] - ws[r + 4]
+				tmp13 = ws[r + 2] + ws[r + 6]
+				tmp12 = (ws[r + 2] - ws[r + 6]) * 1.414213562 - tmp13
+				tmp0 = tmp10 + tmp13
+				tmp3 = tmp10 - tmp13
+				tmp1 = tmp11 + tmp12
+				tmp2 = tmp11 - tmp12
+
+				z13 = ws[r + 5] + ws[r + 3]
+				z10 = ws[r + 5] - ws[r + 3]
+				z11 = ws[r + 1] + ws[r + 7]
+				z12 = ws[r + 1] - ws[r + 7]
+				tmp7 = z11 + z13
+				tmp11 = (z11 - z13) * 1.414213562
+				z5 = (z10 + z12) * 1.847759065
+				tmp10 = 1.082392200 * z12 - z5
+				tmp12 = -2.613125930 * z10 + z5
+				tmp6 = tmp12 - tmp7
+				tmp5 = tmp11 - tmp6
+				tmp4 = tmp10 + tmp5
+
+				plane[out:out + 8] = make_row([
+						lookup[int(tmp0 + tmp7 + center)],
+						lookup[int(tmp1 + tmp6 + center)],
+						lookup[int(tmp2 + tmp5 + center)],
+						lookup[int(tmp3 - tmp4 + center)],
+						lookup[int(tmp3 + tmp4 + center)],
+						lookup[int(tmp2 - tmp5 + center)],
+						lookup[int(tmp1 - tmp6 + center)],
+						lookup[int(tmp0 - tmp7 + center)]])
+				out += stride
+
+	return plane
+
+# The size point IDCT as a matrix: samples = idct_matrix(size) . coefficients
+#	M[x][u] = C(u) / 2 * cos((2x + 1) u pi / (2 size)), C(0) = 1 / sqrt(2), else 1
+# Below 8 points this reconstructs a block at a reduced size from its lowest size
+#	frequencies: each sample stands for 8 / size pixels and the block keeps its mean
+def idct_matrix(size):
+	return [[(math.sqrt(0.5) if u == 0 else 1.0) / 2 * math.cos((2 * x + 1) * u * math.pi / (2 * size))
+			for u in range(size)] for x in range(size)]
+
+IDCT_MATRIX = idct_matrix(8)
+
+# The coefficients a size point IDCT uses: their zigzag indices, and where each goes in the
+#	size x size natural order block
+def reduced_order(size):
+	natural = Jpeg.zigzag_natural[size] if size > 1 else [0]
+	return [NATURAL_ZIGZAG[n] for n in natural], [(n >> 3) * size + (n & 7) for n in natural]
+
+# How many coefficients, in zigzag order, entropy decoding has to store for a size point IDCT:
+#	up to the last one reduced_order() gives, 1 for the DC alone, 64 for a full block
+def reduced_coefficients(size):
+	return max(reduced_order(size)[0]) + 1
+
+# Reduced size dequantization and IDCT of a whole component in pure python, see
+#	idct_plane_python(); for scaled decoding, where size is 1, 2 or 4
+def idct_plane_scaled_python(blocks, qtable, blocks_w, blocks_h, precision=8, size=4):
+	stride = blocks_w * size
+	if precision > 8:
+		plane = array.array('H', bytes(2 * stride * blocks_h * size))
+		make_row = lambda values: array.array('H', values)
+	else:
+		plane = bytearray(stride * blocks_h * size)
+		make_row = bytes
+
+	limit = range_limit(precision)
+	clamped = ClampedRangeLimit(limit)
+	pass_limit = idct_pass_limit(precision)
+	center = RANGE_LIMIT_OFFSET + (1 << (precision - 1)) + 0.5
+	zigzag, positions = reduced_order(size)
+	order = [(k, qtable[ZIGZAG_NATURAL[k]], p) for k, p in zip(zigzag, positions)][1:]
+	# the DC term alone is the same at every size
+	dc_scale = qtable[0] / 8.0
+	transform = idct_1d(size)
+	points = range(size)
+	coef = [0.0] * (size * size)
+	ws = [0.0] * (size * size)
+
+	for by in range(blocks_h):
+		for bx in range(blocks_w):
+			base = (by * blocks_w + bx) << 6
+			out = (by * size * stride) + bx * size
+
+			flat = True
+			for k, q, p in order:
+				value = blocks[base + k]
+				coef[p] = value * q
+				if value:
+					flat = False
+			if flat:
+				row = make_row([clamped[int(blocks[base] * dc_scale + center)]]) * size
+				for y in points:
+					plane[out:out + size] = row
+					out += stride
+				continue
+			coef[0] = blocks[base] * qtable[0]
+
+			# pass 1: columns, into the work array
+			for c in points:
+				ws[c::size] = transform(coef[c::size])
+			# pass 2: rows, level shifted and clamped into the output
+			lookup = limit if -pass_limit <= min(ws) and max(ws) <= pass_limit else clamped
+			for r in range(0, size * size, size):
+				plane[out:out + size] = make_row([lookup[int(v + center)] for v in transform(ws[r:r + size])])
+				out += stride
+
+	return plane
+
+# A 1-D IDCT of size points, as a function of a list of coefficients
+#	this is exactly idct_matrix(size) applied to the lowest size frequencies, the 4 and 2
+#	point ones just written out with the even and odd halves shared; it is not libjpeg's
+#	jidctred.c, whose reduced IDCTs also fold in some of the higher frequencies
+def idct_1d(size):
+	half = 0.353553391
+	if size == 4:
+		c1 = 0.461939766
+		c3 = 0.191341716
+		def idct4(v):
+			even0 = (v[0] + v[2]) * half
+			even1 = (v[0] - v[2]) * half
+			odd0 = v[1] * c1 + v[3] * c3
+			odd1 = v[1] * c3 - v[3] * c1
+			return [even0 + odd0, even1 + odd1, even1 - odd1, even0 - odd0]
+		return idct4
+	if size == 2:
+		return lambda v: [(v[0] + v[1]) * half, (v[0] - v[1]) * half]
+	matrix = idct_matrix(size)
+	return lambda v: [sum(m * u for m, u in zip(row, v)) for row in matrix]
+
+# How many blocks the numpy backend works on at once, to bound its temporary arrays
+IDCT_BATCH_BLOCKS = 4096
+
+# Dequantize and IDCT a stack of zigzag ordered blocks with numpy
+#	coefficients is an (N, 64) int16 array, qmatrix the (8, 8) quantization matrix
+#	returns the (N, size, size) level shifted and clamped samples, see idct_matrix()
+def idct_blocks_numpy(coefficients, qmatrix, precision=8, size=8):
+	count = coefficients.shape[0]
+	matrix = numpy.array(idct_matrix(size), dtype=numpy.float32)
+
+	# dezigzag every block in one go, then dequantize
+	natural = numpy.empty((count, size * size), dtype=numpy.float32)
+	if size == 8:
+		natural[:, ZIGZAG_NATURAL] = coefficients
+	else:
+		zigzag, positions = reduced_order(size)
+		natural[:] = 0
+		natural[:, positions] = coefficients[:, zigzag]
+	blocks = natural.reshape(count, size, size)
+	blocks *= qmatrix[:size, :size]
+
+	# separable IDCT: transform the columns of every block, then the rows,
+	#	each as one (size N, size) x (size, size) matrix product
+	blocks = numpy.matmul(blocks.transpose(0, 2, 1).reshape(count * size, size), matrix.T)
+	blocks = numpy.matmul(blocks.reshape(count, size, size).transpose(0, 2, 1).reshape(count * size, size), matrix.T)
+	blocks = blocks.reshape(count, size, size)
+
+	# level shift, round and clamp
+	blocks += (1 << (precision - 1)) + 0.5
+	numpy.floor(blocks, out=blocks)
+	numpy.clip(blocks, 0, (1 << precision) - 1, out=blocks)
+	return blocks.astype(numpy.uint8 if precision <= 8 else numpy.uint16)
+
+# NumPy dequantization and IDCT of a whole component, a batch of MCU rows at a time
+#	returns a (blocks_h * size, blocks_w * size) array of samples, see idct_plane_python()
+def idct_plane_numpy(blocks, qtable, blocks_w, blocks_h, precision=8, v_factor=1, size=8):
+	dtype = numpy.uint8 if precision <= 8 else numpy.uint16
+	plane = numpy.empty((blocks_h * size, blocks_w * size), dtype=dtype)
+	coefficients = numpy.frombuffer(blocks, dtype=numpy.int16).reshape(blocks_h, blocks_w, 64)
+	qmatrix = cached_qmatrix_numpy(qtable)
+
+	rows = v_factor * max(1, IDCT_BATCH_BLOCKS // (blocks_w * v_factor))
+	for row in range(0, blocks_h, rows):
+		batch = coefficients[row:row + rows]
+		count = batch.shape[0]
+		samples = idct_blocks_numpy(batch.reshape(-1, 64), qmatrix, precision, size)
+		# (rows, blocks, y, x) --> (rows, y, blocks, x) lays the blocks out side by side
+		plane[row * size:(row + count) * size] = samples.reshape(count, blocks_w, size, size).transpose(0, 2, 1, 3).reshape(count * size, blocks_w * size)
+	return plane
+
+def idct_plane(blocks, qtable, blocks_w, blocks_h, precision=8, v_factor=1, backend=None, size=8):
+	if check_backend(backend) == 'numpy':
+		return idct_plane_numpy(blocks, qtable, blocks_w, blocks_h, precision, v_factor, size)
+	return idct_plane_python(blocks, qtable, blocks_w, blocks_h, precision, size)
+
+# An empty plane of samples, in the form idct_plane() returns for the backend
+def new_plane(width, height, precision=8, backend=None):
+	if check_backend(backend) == 'numpy':
+		return numpy.zeros((height, width), dtype=numpy.uint8 if precision <= 8 else numpy.uint16)
+	if precision > 8:
+		return array.array('H', bytes(2 * width * height))
+	return bytearray(width * height)
+
+# Worker side of Jpeg.decode_planes_parallel(): entropy decode a run of restart intervals,
+#	then dequantize and IDCT the MCU rows they touch
+#	data holds the stuffed entropy-coded data of the run, bounds where each interval lies in it
+#	geometry holds (blocks_w, h, v, qtable, size) per component, h and v being blocks per MCU
+#		in the scan and size its IDCT size
+#	returns (first mcu, end mcu, first mcu row, planes of the MCU rows from there on)
+def decode_restart_task(task):
+	data, bounds, first, units, mcus_per_row, mcu_count, restart_interval, geometry, precision, backend = task
+
+	mcu_start = first * restart_interval
+	mcu_end = min((first + len(bounds)) * restart_interval, mcu_count)
+	row0 = mcu_start // mcus_per_row
+	rows = (mcu_end - 1) // mcus_per_row + 1 - row0
+
+	blocks = [array.array('h', bytes(128 * blocks_w * rows * v)) for blocks_w, h, v, qtable, size in geometry]
+	# move the units up so that MCU row row0 lands on the first row of the local blocks
+	local_units = [(blocks[c], dc, ac, predictor, stride, h, v, x, y - row0 * v)
+			for c, dc, ac, predictor, stride, h, v, x, y in units]
+	keep = [reduced_coefficients(geometry[u[0]][4]) for u in units]
+	num_predictors = units[-1][3] + 1
+
+	for i, (start, end) in enumerate(bounds):
+		interval_start = mcu_start + i * restart_interval
+		try:
+			decode_huffman_sequential(unstuff(data[start:end]), local_units, mcus_per_row,
+					interval_start, min(interval_start + restart_interval, mcu_end), num_predictors, keep=keep)
+		except IndexError:
+			raise TruncatedFileError(end)
+
+	planes = []
+	for coefficients, (blocks_w, h, v, qtable, size) in zip(blocks, geometry):
+		planes.append(idct_plane(coefficients, qtable, blocks_w, rows * v, precision, v, backend, size))
+	return mcu_start, mcu_end, row0, planes
+
+# Copy the samples of MCUs [mcu_start, mcu_end) from local, whose first row is MCU row row0,
+#	into plane; both are stride samples wide and an MCU is h by v blocks of size x size
+def copy_mcus(plane, local, stride, mcus_per_row, mcu_start, mcu_end, row0, h, v, backend, size=8):
+	for mcu_row in range(mcu_start // mcus_per_row, (mcu_end - 1) // mcus_per_row + 1):
+		x0 = max(mcu_start - mcu_row * mcus_per_row, 0) * h * size
+		x1 = min(mcu_end - mcu_row * mcus_per_row, mcus_per_row) * h * size
+		y0 = mcu_row * v * size
+		local_y0 = (mcu_row - row0) * v * size
+		if backend == 'numpy':
+			plane[y0:y0 + v * size, x0:x1] = local[local_y0:local_y0 + v * size, x0:x1]
+			continue
+		for line in range(v * size):
+			to = (y0 + line) * stride
+			at = (local_y0 + line) * stride
+			plane[to + x0:to + x1] = local[at + x0:at + x1]
+
+# Output modes and how many samples each has per pixel
+MODE_CHANNELS = {
+		'L': 1,
+		'RGB': 3,
+		'RGBA': 4,
+		'CMYK': 4,
+}
+
+# Fixed point color conversion, as in libjpeg's jdcolor.c
+SCALEBITS = 16
+ONE_HALF = 1 << (SCALEBITS - 1)
+
+def fix(x):
+	return int(x * (1 << SCALEBITS) + 0.5)
+
+# Per-precision lookup tables for YCbCr --> RGB, indexed by the Cb / Cr sample
+#	cr_r and cb_b include RANGE_LIMIT_OFFSET, cb_g + cr_g has it included after the shift
+ycc_rgb_tables = {}
+
+def ycc_rgb_table(precision):
+	tables = ycc_rgb_tables.get(precision)
+	if tables is None:
+		center = 1 << (precision - 1)
+		values = [i - center for i in range(1 << precision)]
+		cr_r = [RANGE_LIMIT_OFFSET + ((fix(1.40200) * x + ONE_HALF) >> SCALEBITS) for x in values]
+		cb_b = [RANGE_LIMIT_OFFSET + ((fix(1.77200) * x + ONE_HALF) >> SCALEBITS) for x in values]
+		cr_g = [-fix(0.71414) * x for x in values]
+		cb_g = [-fix(0.34414) * x + ONE_HALF + (RANGE_LIMIT_OFFSET << SCALEBITS) for x in values]
+		tables = (cr_r, cb_b, cr_g, cb_g)
+		ycc_rgb_tables[precision] = tables
+	return tables
+
+# Upsample one row of a component to width samples by replication
+#	ratio is (component h_factor, max h_factor); whole ratios are done with
+#	one strided copy per replica, anything else by picking the nearest sample
+def upsample_row(row, ratio, width):
+	h, max_h = ratio
+	if h == max_h:
+		return row[:width]
+	if max_h % h == 0:
+		factor = max_h // h
+		out = row[:1] * (len(row) * factor)
+		for k in range(factor):
+			out[k::factor] = row
+		return out[:width]
+	out = row[:1] * width
+	for x in range(width):
+		out[x] = row[(x * h) // max_h]
+	return out
+
+# Convert rows of the components, already upsampled to the image width, to RGB
+#	returns (r, g, b) lists, or a single gray row for 1 component images
+# inverted says whether CMYK is stored inverted (0 means full ink), as Adobe does
+def rows_to_rgb_python(color_space, rows, precision, inverted=True):
+	limit = range_limit(precision)
+	maxval = (1 << precision) - 1
+	half = maxval >> 1
+
+	if color_space == 'L':
+		return (rows[0],)
+
+	if color_space == 'RGB':
+		return rows[:3]
+
+	if color_space in ('YCbCr', 'YCCK'):
+		cr_r, cb_b, cr_g, cb_g = ycc_rgb_table(precision)
+		y, cb, cr = rows[:3]
+		r = [limit[l + cr_r[v]] for l, v in zip(y, cr)]
+		g = [limit[l + ((cb_g[u] + cr_g[v]) >> SCALEBITS)] for l, u, v in zip(y, cb, cr)]
+		b = [limit[l + cb_b[u]] for l, u in zip(y, cb)]
+		if color_space == 'YCbCr':
+			return r, g, b
+		# YCCK is Adobe's inverted CMYK with the CMY part color transformed,
+		#	so YCbCr --> RGB gives back the inverted C, M and Y
+		c, m, y, k = r, g, b, rows[3]
+	elif inverted:
+		c, m, y, k = rows
+	else:
+		c, m, y, k = [[maxval - v for v in row] for row in rows]
+
+	return ([(u * v + half) // maxval for u, v in zip(c, k)],
+			[(u * v + half) // maxval for u, v in zip(m, k)],
+			[(u * v + half) // maxval for u, v in zip(y, k)])
+
+def rgb_to_gray_python(r, g, b):
+	return [(19595 * u + 38470 * v + 7471 * w + ONE_HALF) >> SCALEBITS for u, v, w in zip(r, g, b)]
+
+# The same conversion over whole (sub)planes with numpy, in 32 bit fixed point
+def planes_to_rgb_numpy(color_space, planes, precision, inverted=True):
+	maxval = (1 << precision) - 1
+	center = 1 << (precision - 1)
+
+	if color_space == 'L':
+		return (planes[0],)
+
+	if color_space == 'RGB':
+		return planes[:3]
+
+	if color_space in ('YCbCr', 'YCCK'):
+		y = planes[0].astype(numpy.int32)
+		cb = planes[1].astype(numpy.int32) - center
+		cr = planes[2].astype(numpy.int32) - center
+		r = y + ((fix(1.40200) * cr + ONE_HALF) >> SCALEBITS)
+		g = y + ((-fix(0.34414) * cb - fix(0.71414) * cr + ONE_HALF) >> SCALEBITS)
+		b = y + ((fix(1.77200) * cb + ONE_HALF) >> SCALEBITS)
+		rgb = [numpy.clip(v, 0, maxval, out=v) for v in (r, g, b)]
+		if color_space == 'YCbCr':
+			return rgb
+		cmy, k = rgb, planes[3].astype(numpy.int32)
+	else:
+		cmy, k = [p.astype(numpy.int32) for p in planes[:3]], planes[3].astype(numpy.int32)
+		if not inverted:
+			cmy = [maxval - v for v in cmy]
+			k = maxval - k
+
+	return [(v * k + (maxval >> 1)) // maxval for v in cmy]
+
+def rgb_to_gray_numpy(r, g, b):
+	return (19595 * r.astype(numpy.int32) + 38470 * g.astype(numpy.int32) + 7471 * b.astype(numpy.int32) + ONE_HALF) >> SCALEBITS
+
 class JpegHuffman(object):
+	# number of code bits resolved by a single probe of the lookup table
+	LOOKAHEAD = 9
+
 	def __init__(self, cv_tuple):
 		counts = cv_tuple[0]
 		values = cv_tuple[1]
 
+		self.counts = counts
+		self.values = values
 		self.build_lookups(counts, values)
 
-	# build lookup dictionaries of code --> (symbol, length of symbol)
-	#	this function assumes that codes are up to 2 bytes in length
-	# in order to reduce the amount of checking required to retrieve
-	#	a symbol, we just pass an entire byte into the high dict
-	#	and then conditionally into the corresponding low dict if necessary
+	# build the decoding tables for a canonical huffman code
+	# codes of up to LOOKAHEAD bits are resolved by self.lookup_table, indexed by the
+	#	next LOOKAHEAD bits of input; each entry packs (symbol << 4) | code length
+	#	every code of length n fills the 2 ** (LOOKAHEAD - n) entries it is a prefix of
+	# an entry of 0 means the code is longer, and we fall back to the canonical
+	#	maxcode / valptr tables: a code of length n is valid if it is <= maxcode[n]
+	#	and its symbol is values[valptr[n] + code]
 	def build_lookups(self, counts, values):
-		MAX_CODE = 0xff
-
-		counts_high = counts[:8]
-		counts_low = counts[8:]
+		MAX_SYMBOL_LENGTH = 16
+		lookahead = self.LOOKAHEAD
+		self.lookup_shift = 16 - lookahead
 
-		self.high = {}
-		high = self.high
+		self.lookup_table = lookup_table = array.array('H', [0]) * (1 << lookahead)
+		self.maxcode = maxcode = [-1] * (MAX_SYMBOL_LENGTH + 1)
+		self.valptr = valptr = [0] * (MAX_SYMBOL_LENGTH + 1)
 
-		interval = 0x80
 		code = 0
-		length = 1
+		k = 0
 		# counts[0] <--> codes of length 1
-		for count in counts_high:
-			if (count * interval) + code > MAX_CODE:
-				raise BadHuffmanTreeError(code, count, interval)
-			for i in range(count):
-				val = values.pop(0)
-				for j in range(interval):
-					high[code + j] = (val, length)
-				code += interval
-			interval >>= 1
-			length += 1
-
-		# short circuit - if we placed code MAX_CODE then we are done
-		#	note that this implies code == MAX_CODE + 1
-		if code == (MAX_CODE + 1):
-			return
+		for length in range(1, MAX_SYMBOL_LENGTH + 1):
+			count = counts[length - 1]
+			if count:
+				valptr[length] = k - code
+				if length <= lookahead:
+					span = 1 << (lookahead - length)
+					for i in range(count):
+						start = (code + i) * span
+						lookup_table[start:start + span] = array.array('H', [(values[k + i] << 4) | length]) * span
+				code += count
+				k += count
+				maxcode[length] = code - 1
+			# code is one more than the last code of this length, so it has to fit in length bits
+			if code > (1 << length):
+				raise BadHuffmanTreeError(code, count, length)
+			code <<= 1
 
-		print code
+		if k != len(values):
+			raise BadHuffmanTreeError(k, len(values))
+
+	# find the symbol at the front of full_2bytes, the next 16 bits of input
+	#	returns (symbol, length of symbol)
+	def lookup(self, full_2bytes):
+		entry = self.lookup_table[full_2bytes >> self.lookup_shift]
+		if entry:
+			return entry >> 4, entry & 0x0f
 
-		# we didn't place all the codes in the high set, so now we need to do
-		#	the remaining ones across 1 or more low sets
-		lows = []
-		for i in range(code, MAX_CODE + 1):
-			low = {}
-			high[i] = (low, -1) # we use length = -1 to indicate more checking required
-			lows.append(low)
+		maxcode = self.maxcode
+		for length in range(self.LOOKAHEAD + 1, 17):
+			code = full_2bytes >> (16 - length)
+			if code <= maxcode[length]:
+				return self.values[self.valptr[length] + code], length
+		raise BadFieldError('huffman code')
 
-		interval = 0x80
-		num_lows = len(lows)
+	# the (code, length) of every symbol, for encoding with the table: spec C.2
+	#	None for symbols the table has no code for
+	def encoding_table(self):
+		table = [None] * 256
 		code = 0
-		# and length = 9
-		# now build all the lows
-		# similar to above, but when we run out of space in one low, we hop to the next
-		# note that no value can cross multiple lows and we pop a low off once it is full
-		for count in counts_low:
-			# this is the same validation as above but modified to allow multiple dicts
-			# note that it evaluates the same if num_lows == 1
-			if (count * interval) + code > (((MAX_CODE + 1) * num_lows) - 1):
-				raise BadHuffmanTreeError(code, count, interval)
-			for i in range(count):
-				low = lows[0]
-				val = values.pop(0)
-				# it can be shown that this will never overflow a low
-				# interval decreases monotonically and is always a power of 2
-				#	as a result, it will always pack to the end of one low perfectly
-				for j in range(interval):
-					low[code + j] = (val, length)
-				code += interval
-				# now determine if we filled that low
-				#	remove filled low and reset code to 0
-				if code == (MAX_CODE + 1):
-					lows.pop(0)
-					code = 0
-			interval >>= 1
-			length += 1
-
-		# XXX fill any remaining slots with bad code indicator ?
+		k = 0
+		for length in range(1, 17):
+			for i in range(self.counts[length - 1]):
+				table[self.values[k]] = (code, length)
+				code += 1
+				k += 1
+			code <<= 1
+		return table
 
-	def lookup(self, full_2bytes):
-		high_byte = (full_2bytes >> 8) & 0xff
-		high_val, high_len = self.high[high_byte]
-		if high_len >= 0:
-			return high_val, high_len
+# Bounded LRU cache of tables built from header contents, shared by every Jpeg in the process
+#	most images use the Annex K tables or one of a few encoders' own, so these get built
+#	once rather than once per image
+# hits, misses and evictions count what it has done since it was last cleared
+class TableCache(object):
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self._tables = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Return the table for key, calling build() to make it if it is not cached
+	def get(self, key, build):
+		with self._lock:
+			table = self._tables.get(key)
+			if table is not None:
+				self._tables.move_to_end(key)
+				self.hits += 1
+				return table
+			self.misses += 1
+
+		table = build()
+		with self._lock:
+			self._tables[key] = table
+			while len(self._tables) > self.max_size:
+				self._tables.popitem(last=False)
+				self.evictions += 1
+		return table
+
+	def clear(self):
+		with self._lock:
+			self._tables.clear()
+			self.hits = self.misses = self.evictions = 0
+
+	def stats(self):
+		return {'size': len(self._tables), 'max_size': self.max_size,
+				'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# JpegHuffman objects keyed on the raw (counts, values) bytes of the DHT table
+huffman_cache = TableCache(64)
+# dequantization tables derived from a DQT table, keyed on the backend and its contents
+quantization_cache = TableCache(64)
+
+def huffman_table(counts, values):
+	return huffman_cache.get(bytes(counts) + bytes(values), lambda: JpegHuffman((counts, values)))
+
+# Build the optimal huffman code for a list of 256 symbol frequencies, as spec K.2 does
+#	returns the (counts, values) of a DHT segment, for just the symbols that occur
+#	a reserved symbol makes sure no code is all 1 bits, and codes are kept to 16 bits
+def optimal_huffman_table(frequencies):
+	frequencies = list(frequencies) + [1]
+	code_sizes = [0] * 257
+	others = [-1] * 257
+
+	while True:
+		# the two least frequent symbols, taking the highest numbered on ties
+		v1 = v2 = -1
+		for i, f in enumerate(frequencies):
+			if f and (v1 < 0 or f <= frequencies[v1]):
+				v1 = i
+		for i, f in enumerate(frequencies):
+			if f and i != v1 and (v2 < 0 or f <= frequencies[v2]):
+				v2 = i
+		if v2 < 0:
+			break
+
+		# merge them, lengthening the codes of every symbol in both branches
+		frequencies[v1] += frequencies[v2]
+		frequencies[v2] = 0
+		code_sizes[v1] += 1
+		while others[v1] >= 0:
+			v1 = others[v1]
+			code_sizes[v1] += 1
+		others[v1] = v2
+		code_sizes[v2] += 1
+		while others[v2] >= 0:
+			v2 = others[v2]
+			code_sizes[v2] += 1
+
+	bits = [0] * 258
+	for size in code_sizes:
+		if size:
+			bits[size] += 1
+
+	# spec K.3: move pairs of codes over 16 bits up the tree until none are left
+	for i in range(len(bits) - 1, 16, -1):
+		while bits[i] > 0:
+			j = i - 2
+			while bits[j] == 0:
+				j -= 1
+			bits[i] -= 2
+			bits[i - 1] += 1
+			bits[j + 1] += 2
+			bits[j] -= 1
+
+	# then drop the reserved symbol, which has one of the longest codes
+	i = 16
+	while bits[i] == 0:
+		i -= 1
+	bits[i] -= 1
+
+	values = [symbol for size, symbol in sorted((size, symbol) for symbol, size in enumerate(code_sizes[:256]) if size)]
+	return bits[1:17], values
 
-		low_byte = full_2bytes & 0xff
-		return high_val[low_byte]
+# The python IDCT's AAN scaled dequantization table, see aan_dequant_table()
+def cached_aan_dequant_table(qtable):
+	key = b'aan' + array.array('H', qtable).tobytes()
+	return quantization_cache.get(key, lambda: aan_dequant_table(qtable))
+
+# The numpy IDCT's (8, 8) float32 quantization matrix, read only since it is shared
+def cached_qmatrix_numpy(qtable):
+	def build():
+		qmatrix = numpy.array(qtable, dtype=numpy.float32).reshape(8, 8)
+		qmatrix.flags.writeable = False
+		return qmatrix
+	return quantization_cache.get(b'numpy' + array.array('H', qtable).tobytes(), build)
+
+# Counters of both table caches
+def cache_stats():
+	return {'huffman': huffman_cache.stats(), 'quantization': quantization_cache.stats()}
+
+def clear_caches():
+	huffman_cache.clear()
+	quantization_cache.clear()
+
+# Where parsing and decoding an image spends its time, see Jpeg(profile=...)
+#	markers holds [calls, seconds, bytes] for each marker's handler, bytes being how far it
+#	moved through the file: the segment, and for SOS the entropy-coded data after it too
+#	stages holds [calls, seconds] for each stage of decoding:
+#		'entropy' entropy decoding into coefficients (or lossless differences)
+#		'idct' dequantization and IDCT into sample planes
+#		'prediction' undoing the prediction of lossless scans
+#		'upsample' upsampling the planes to full size, a row or band at a time
+#		'color' color conversion and interleaving into the output
+#		'parallel' entropy decoding and IDCT in worker processes, see decode_planes_parallel()
+#	callback, if given, is called as callback(kind, name, seconds, size) with every
+#		measurement as it is added, kind being 'marker' or 'stage' and size None for stages
+# One profile can be given to several images to add them all up
+# Jpeg.profile is None unless one is given, and every hook checks for that first, so
+#	there is next to nothing to pay when profiling is off
+class JpegProfile(object):
+	def __init__(self, callback=None):
+		self.callback = callback
+		self.markers = {}
+		self.stages = {}
+
+	def add_marker(self, marker, seconds, size):
+		totals = self.markers.get(marker)
+		if totals is None:
+			totals = self.markers[marker] = [0, 0.0, 0]
+		totals[0] += 1
+		totals[1] += seconds
+		totals[2] += size
+		if self.callback is not None:
+			self.callback('marker', marker, seconds, size)
+
+	def add_stage(self, stage, seconds):
+		totals = self.stages.get(stage)
+		if totals is None:
+			totals = self.stages[stage] = [0, 0.0]
+		totals[0] += 1
+		totals[1] += seconds
+		if self.callback is not None:
+			self.callback('stage', stage, seconds, None)
+
+	def clear(self):
+		self.markers.clear()
+		self.stages.clear()
+
+	def as_dict(self):
+		return {
+			'markers': dict((marker, {'calls': calls, 'seconds': seconds, 'bytes': size})
+					for marker, (calls, seconds, size) in self.markers.items()),
+			'stages': dict((stage, {'calls': calls, 'seconds': seconds})
+					for stage, (calls, seconds) in self.stages.items()),
+		}
 
 class Jpeg(object):
 	# Please note the widespread use of self._index and self._buf throughout member functions here
@@ -115,57 +2035,84 @@ class Jpeg(object):
 	MAX_QUANTIZATION_TABLES = 4
 	MAX_HUFFMAN_TABLES = 4
 
+	# a JpegProfile to record handler and stage timings in, if any
+	profile = None
+
+	# how much of a file head probe() reads before retrying with more
+	PROBE_HEAD_SIZE = 4096
+
+	# the end of entropy-coded data is the first 0xff not followed by
+	#	stuffing (0x00), a restart marker (RSTn) or another fill byte
+	entropy_end = re.compile(b'\xff[^\x00\xd0-\xd7\xff]')
+	# restart markers split the entropy-coded data into independent intervals
+	restart_marker = re.compile(b'\xff+[\xd0-\xd7]')
+
 	# marker codes that identify the various headers in JPEG
 	markers = {
 			# The encoding process is actually stored as part of the SOF marker
 			# For this reason, there are several SOF markers here
-			'\xc0': 'SOF0',
-			'\xc1': 'SOF1',
-			'\xc2': 'SOF2',
-			'\xc3': 'SOF3',
+			0xc0: 'SOF0',
+			0xc1: 'SOF1',
+			0xc2: 'SOF2',
+			0xc3: 'SOF3',
 
 			# We take a break from SOF markers to bring you: DHT
 			# 'DHT' = Define Huffman Tree
-			'\xc4': 'DHT',
+			0xc4: 'DHT',
 
 			# And now return to SOF markers
-			'\xc5': 'SOF5',
-			'\xc6': 'SOF6',
-			'\xc7': 'SOF7',
-			'\xc8': 'SOF_JPEG',
-			'\xc9': 'SOF9',
-			'\xca': 'SOF10',
-			'\xcb': 'SOF11',
+			0xc5: 'SOF5',
+			0xc6: 'SOF6',
+			0xc7: 'SOF7',
+			0xc8: 'SOF_JPEG',
+			0xc9: 'SOF9',
+			0xca: 'SOF10',
+			0xcb: 'SOF11',
 
 			# DAC marker
-			'\xcc': 'DAC',
+			0xcc: 'DAC',
 
 			# More SOF markers
-			'\xcd': 'SOF13',
-			'\xce': 'SOF14',
-			'\xcf': 'SOF15',
-
-			'\xd8': 'SOI',
-			'\xd9': 'EOI',
-			'\xda': 'SOS',
-			'\xdb': 'DQT',
-
-			'\xe0': 'APP0',
-			'\xe1': 'APP1',
-			'\xe2': 'APP2',
-			'\xe3': 'APP3',
-			'\xe4': 'APP4',
-			'\xe5': 'APP5',
-			'\xe6': 'APP6',
-			'\xe7': 'APP7',
-			'\xe8': 'APP8',
-			'\xe9': 'APP9',
-			'\xea': 'APP10',
-			'\xeb': 'APP11',
-			'\xec': 'APP12',
-			'\xed': 'APP13',
-			'\xee': 'APP14',
-			'\xef': 'APP15',
+			0xcd: 'SOF13',
+			0xce: 'SOF14',
+			0xcf: 'SOF15',
+
+			# Restart markers only ever appear inside entropy-coded data
+			0xd0: 'RST0',
+			0xd1: 'RST1',
+			0xd2: 'RST2',
+			0xd3: 'RST3',
+			0xd4: 'RST4',
+			0xd5: 'RST5',
+			0xd6: 'RST6',
+			0xd7: 'RST7',
+
+			0xd8: 'SOI',
+			0xd9: 'EOI',
+			0xda: 'SOS',
+			0xdb: 'DQT',
+			# DRI = Define Restart Interval
+			0xdd: 'DRI',
+
+			0xe0: 'APP0',
+			0xe1: 'APP1',
+			0xe2: 'APP2',
+			0xe3: 'APP3',
+			0xe4: 'APP4',
+			0xe5: 'APP5',
+			0xe6: 'APP6',
+			0xe7: 'APP7',
+			0xe8: 'APP8',
+			0xe9: 'APP9',
+			0xea: 'APP10',
+			0xeb: 'APP11',
+			0xec: 'APP12',
+			0xed: 'APP13',
+			0xee: 'APP14',
+			0xef: 'APP15',
+
+			# Comment
+			0xfe: 'COM',
 	}
 
 	marker_handlers = {}
@@ -212,10 +2159,38 @@ class Jpeg(object):
 			'differential',
 	]
 
-	def __init__(self, buf):
+	# buf can be anything that exposes the buffer protocol (bytes, bytearray, mmap, memoryview)
+	#	we only ever hold a memoryview over it, so the image is never copied while parsing
+	# If stop_at is given, parsing stops once a header of that kind has been handled
+	#	'SOF' matches any of the SOFn markers
+	# index, a JpegIndex for this file, saves searching the entropy-coded data for the
+	#	end of each scan and its restart markers, and lets decode_region() start from checkpoints
+	# profile, a JpegProfile, records the time taken by each marker's handler and later by each
+	#	stage of decoding
+	def __init__(self, buf, stop_at=None, index=None, profile=None):
 		self._index = 0
-		self._buf = buf[:]
+		self._source = buf
+		self._buf = as_byte_view(buf)
+		if profile is not None:
+			self.profile = profile
+		self.init_headers()
+		try:
+			if index is not None:
+				index.check(self._buf)
+			self.index = index
+			self.build_from_buf(stop_at)
+		except BaseException:
+			# let go of buf now, so from_path() can unmap it before re-raising
+			self._buf.release()
+			raise
+
+	# Reset everything we gather from the headers
+	#	JpegStreamParser uses this to get a Jpeg that it feeds one segment at a time
+	def init_headers(self):
+		# absolute file offset of self._buf[0], so trackers always hold file offsets
+		self._origin = 0
 		self.image = None
+		self.index = None
 
 		# Use trackers to return back to parsed headers
 		self.trackers = {}
@@ -227,6 +2202,17 @@ class Jpeg(object):
 		self.x_density = None
 		self.y_density = None
 
+		# Attributes gathered from APP1 (EXIF) header
+		#	exif is the (offset, length) of the TIFF data of the EXIF header, if there is one
+		self.exif = None
+
+		# Thumbnails found in the APP0 and APP1 headers, see embedded_thumbnail()
+		self.thumbnails = []
+
+		# Attributes gathered from APP14 header
+		self.is_adobe = False
+		self.adobe_transform = None
+
 		# Attributes gathered from DQT header
 		self.quantization_tables = [[], [], [], []]
 		self.quantization_high_precision = [False, False, False, False]
@@ -238,6 +2224,10 @@ class Jpeg(object):
 		self.image_width = 0
 		self.components = []
 
+		# Attributes gathered from DRI header
+		#	every restart_interval MCUs the coder resets and a RSTn marker follows (0 for never)
+		self.restart_interval = 0
+
 		# Attributes gathered from DHT header
 		self.huffman_data = [None] * self.MAX_HUFFMAN_TABLES
 		# each has dc, ac component
@@ -245,32 +2235,141 @@ class Jpeg(object):
 			self.huffman_data[i] = [None, None]
 
 		# SOS
-		self.huffman_ac = []
-		self.huffman_dc = []
+		# built JpegHuffman objects for the tables currently defined, indexed like huffman_data
+		self.huffman_dc = [None] * self.MAX_HUFFMAN_TABLES
+		self.huffman_ac = [None] * self.MAX_HUFFMAN_TABLES
+		self.scans = []
+
+		# Attributes gathered from DAC header, with the defaults of spec F.1.4.4
+		#	(L, U) bounds of the DC conditioning, and Kx of the AC conditioning, per table
+		self.arithmetic_dc = [(0, 1)] * self.MAX_HUFFMAN_TABLES
+		self.arithmetic_ac = [5] * self.MAX_HUFFMAN_TABLES
+
+		# Decoded DCT coefficients, one array per component, and how many of the scans
+		#	are in there so far, see decode_next_scan()
+		self.blocks = None
+		self.scans_decoded = 0
+
+	# Wrap an in-memory image without copying it
+	@classmethod
+	def from_buffer(cls, buf, stop_at=None, index=None, profile=None):
+		return cls(buf, stop_at, index, profile)
 
-		self.build_from_buf()
+	# Map a file read-only instead of reading it in
+	#	only the pages holding the headers we parse ever become resident, so with
+	#	stop_at='SOF' the entropy-coded data is never read
+	@classmethod
+	def from_path(cls, path, stop_at=None, index=None, profile=None):
+		with open(path, 'rb') as f:
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return cls(mapped, stop_at, index, profile)
+		except BaseException:
+			mapped.close()
+			raise
 
-	def build_from_buf(self):
-		# First we expect to get a 'SOI' marker
-		marker = self.get_marker()
-		if marker != 'SOI':
-			raise NotJpegFileError
-		self.handle_marker(marker) # we don't expect this will do anything on SOI
+	# Read just enough of the headers to describe the frame and return a JpegInfo
+	# source can be a buffer, a path or a file object; for the latter two we only read
+	#	the head of the file, growing the read if the headers turn out to be longer
+	@classmethod
+	def probe(cls, source, stop_at='SOF'):
+		if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+			return cls(source, stop_at=stop_at).info()
 
-		# XXX enforce that 'APP0' comes immediately after?
+		if hasattr(source, 'read'):
+			return cls._probe_file(source, stop_at)
+		with open(source, 'rb') as f:
+			return cls._probe_file(f, stop_at)
 
-		# Now we are ready to handle markers in any arbitrary order
-		while marker != 'EOI':
+	@classmethod
+	def _probe_file(cls, f, stop_at):
+		head = bytearray()
+		size = cls.PROBE_HEAD_SIZE
+		while True:
+			chunk = f.read(size - len(head))
+			head += chunk
+			try:
+				return cls(head, stop_at=stop_at).info()
+			except TruncatedFileError:
+				if not chunk:
+					raise
+			size *= 2
+
+	def info(self):
+		return JpegInfo(self)
+
+	# Return a thumbnail embedded in the headers as a JpegThumbnail, with its data as a
+	#	memoryview into the file, or None if there is none
+	#	the EXIF and JFXX JPEG thumbnails are preferred over the uncompressed ones
+	#	source picks a particular one: 'EXIF', 'JFXX' or 'JFIF'
+	# Only the headers need parsing, so Jpeg.from_path(path, stop_at='SOF') will do
+	def embedded_thumbnail(self, source=None):
+		candidates = [t for t in self.thumbnails if source is None or t.source == source]
+		if not candidates:
+			return None
+		candidates.sort(key=lambda t: (t.format != 'jpeg', t.source != 'EXIF'))
+		found = candidates[0]
+		# a copy, so the view goes away with it and close() can release the file
+		thumbnail = JpegThumbnail(found.source, found.format, found.width, found.height, found.offset, found.length)
+		start = thumbnail.offset - self._origin
+		thumbnail.data = self._buf[start:start + thumbnail.length]
+		return thumbnail
+
+	# Drop our view of the buffer, and unmap it if we mapped it ourselves
+	# Any memoryview slices handed out by us must be released first
+	def close(self):
+		self._buf.release()
+		if isinstance(self._source, mmap.mmap):
+			self._source.close()
+		self._source = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def build_from_buf(self, stop_at=None):
+		# Every read goes through struct.unpack_from, so running off the end of
+		#	the buffer shows up as struct.error
+		try:
+			# First we expect to get a 'SOI' marker
 			marker = self.get_marker()
-			self.handle_marker(marker)
+			if marker != 'SOI':
+				raise NotJpegFileError
+			self.handle_marker(marker) # we don't expect this will do anything on SOI
+
+			# XXX enforce that 'APP0' comes immediately after?
+
+			# Now we are ready to handle markers in any arbitrary order
+			while marker != 'EOI':
+				marker = self.get_marker()
+				self.handle_marker(marker)
+				if stop_at is not None and self.marker_matches(marker, stop_at):
+					return
+		except struct.error:
+			raise TruncatedFileError(self._index)
+
+	@staticmethod
+	def marker_matches(marker, name):
+		if name == 'SOF':
+			return marker.startswith('SOF')
+		return marker == name
 
 	def get_marker(self):
-		if self._buf[self._index] != '\xff':
+		buf = self._buf
+		index = self._index
+		prefix, code = struct.unpack_from('BB', buf, index)
+		if prefix != 0xff:
 			raise MarkerNotRecognizedError()
-		marker = Jpeg.markers.get(self._buf[self._index + 1])
+		# any number of 0xff fill bytes may come before the marker code
+		while code == 0xff:
+			index += 1
+			code = struct.unpack_from('B', buf, index + 1)[0]
+		marker = Jpeg.markers.get(code)
 		if marker is None:
-			raise MarkerNotRecognizedError(marker)
-		self._index += 2
+			raise MarkerNotRecognizedError(code)
+		self._index = index + 2
 		return marker
 
 	def handle_marker(self, marker):
@@ -278,22 +2377,34 @@ class Jpeg(object):
 		handler = Jpeg.marker_handlers.get(marker)
 		if handler is None:
 			raise MarkerNotHandledError(marker)
+		self.track_marker(marker)
+		if self.profile is not None:
+			return self.profile_marker(marker, handler)
+		return handler(self)
+
+	def profile_marker(self, marker, handler):
+		index = self._index
+		start = time.perf_counter()
+		try:
+			return handler(self)
+		finally:
+			self.profile.add_marker(marker, time.perf_counter() - start, self._index - index)
+
+	def track_marker(self, marker):
 		tracker = self.trackers.get(marker, [])
-		tracker.append(self._index)
+		tracker.append(self._origin + self._index)
 		self.trackers[marker] = tracker
-		return handler(self)
 
 	# We define this next function for headers which we don't care about or can't do anything with
 	#	but need to skip over anyway
 	def handle_uninteresting_variable_length_header(self):
 		index = self._index
-		length = struct.unpack('>H', self._buf[index:index+2])[0]
+		length = struct.unpack_from('>H', self._buf, index)[0]
 		index += length
 		self._index = index
 
 	# Almost all the APP headers are headers we don't care about
-	# We DO care about APP 0 though
-	marker_handlers['APP1'] = handle_uninteresting_variable_length_header
+	# We DO care about APP 0 and APP 1 though
 	marker_handlers['APP2'] = handle_uninteresting_variable_length_header
 	marker_handlers['APP3'] = handle_uninteresting_variable_length_header
 	marker_handlers['APP4'] = handle_uninteresting_variable_length_header
@@ -306,8 +2417,17 @@ class Jpeg(object):
 	marker_handlers['APP11'] = handle_uninteresting_variable_length_header
 	marker_handlers['APP12'] = handle_uninteresting_variable_length_header
 	marker_handlers['APP13'] = handle_uninteresting_variable_length_header
-	# We also care about APP14 in some cases
+	# We also care about APP14 in some cases, see handle_app14
 	marker_handlers['APP15'] = handle_uninteresting_variable_length_header
+	marker_handlers['COM'] = handle_uninteresting_variable_length_header
+
+	# RSTn markers should only turn up inside the scans; if one appears between headers
+	#	there is nothing to do for it
+	def handle_rst(self):
+		pass
+
+	for i in range(8):
+		marker_handlers['RST%d' % i] = handle_rst
 
 	def handle_soi(self):
 		### no need to increase self._index here because soi is a 0-length header
@@ -317,120 +2437,192 @@ class Jpeg(object):
 
 	def handle_app0(self):
 		# APP0 header which contains the 'JFIF' identifier, version, and potentially a thumbnail
-		# This header can contain a thumbnail which we do not care about, just get the interesting fields
+		# We note where the thumbnail is, see embedded_thumbnail()
 		INTERESTING_LEN = 14 # does not include 2-byte length field
-		JFIF_IDENT = 'JFIF\x00'
+		JFIF_IDENT = b'JFIF\x00'
+		JFXX_IDENT = b'JFXX\x00'
 
+		buf = self._buf
 		index = self._index
 
 		# first get a 2-byte length field
-		length = struct.unpack('>H', self._buf[index:index + 2])[0]
+		length = struct.unpack_from('>H', buf, index)[0]
 
 		index += 2
 		interesting = length - 2
 
+		ident = struct.unpack_from('5s', buf, index)[0]
+		if ident == JFXX_IDENT:
+			self.handle_jfxx(index + 5, self._index + length)
+			self._index += length
+			return
+
 		if interesting > INTERESTING_LEN:
 			interesting = INTERESTING_LEN
 		elif interesting < INTERESTING_LEN:
-			# XXX we could alternately handle the JFXX extension marker here instead
 			raise BadFieldError('APP0')
 
-		ident = self._buf[index:index+5]
 		index += 5
 		if ident != JFIF_IDENT:
 			raise NotJpegFileError()
 		self.is_jfif = True
 
-		maj_version = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		min_version = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		self.jfif_version = (maj_version, min_version)
-		
-		
-		density_unit = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		x_density = struct.unpack('>H', self._buf[index:index+2])[0]
-		index += 2
-		y_density = struct.unpack('>H', self._buf[index:index+2])[0]
+		maj_version, min_version = struct.unpack_from('BB', buf, index)
 		index += 2
+		self.jfif_version = (maj_version, min_version)
+
+		density_unit, x_density, y_density = struct.unpack_from('>BHH', buf, index)
+		index += 5
 		self.density_unit = density_unit
 		self.x_density = x_density
 		self.y_density = y_density
 
-		thumbnail_x_dim = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		thumbnail_y_dim = struct.unpack('B', self._buf[index])[0]
-		index += 1
+		thumbnail_x_dim, thumbnail_y_dim = struct.unpack_from('BB', buf, index)
+		index += 2
 
 		thumbnail_size = 3 * thumbnail_x_dim * thumbnail_y_dim # packed RGB values
 		if length - (interesting + 2) != thumbnail_size:
 			raise BadFieldError('APP0')
+		if thumbnail_size:
+			self.thumbnails.append(JpegThumbnail('JFIF', 'rgb', thumbnail_x_dim, thumbnail_y_dim,
+					self._origin + index, thumbnail_size))
 		index += thumbnail_size
 
 		self._index = index
 
 	marker_handlers['APP0'] = handle_app0
 
+	# The JFIF extension APP0 header holds just a thumbnail, in one of three formats
+	#	index is where the extension code is, end where the header ends
+	def handle_jfxx(self, index, end):
+		JFXX_JPEG = 0x10
+		JFXX_PALETTE = 0x11
+		JFXX_RGB = 0x13
+
+		extension = struct.unpack_from('B', self._buf, index)[0]
+		index += 1
+		if extension == JFXX_JPEG:
+			self.thumbnails.append(JpegThumbnail('JFXX', 'jpeg', None, None, self._origin + index, end - index))
+			return
+
+		if extension not in (JFXX_PALETTE, JFXX_RGB):
+			raise BadFieldError('APP0')
+		width, height = struct.unpack_from('BB', self._buf, index)
+		index += 2
+		if extension == JFXX_PALETTE:
+			format, size = 'palette', 768 + width * height
+		else:
+			format, size = 'rgb', 3 * width * height
+		if end - index != size:
+			raise BadFieldError('APP0')
+		self.thumbnails.append(JpegThumbnail('JFXX', format, width, height, self._origin + index, size))
+
+	# APP1 is where EXIF data lives, a TIFF file in all but name
+	# We note where it is, and where the JPEG thumbnail in its second IFD is, if it has one
+	# EXIF headers are often malformed, and are not needed to decode the image, so one we
+	#	cannot make sense of is skipped rather than raising an error
+	def handle_app1(self):
+		EXIF_IDENT = b'Exif\x00\x00'
+		JPEG_INTERCHANGE_FORMAT = 0x0201
+		JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+
+		index = self._index
+		length = struct.unpack_from('>H', self._buf, index)[0]
+		self._index = index + length
+		if length < 2 + 6 + 8 or bytes(self._buf[index + 2:index + 8]) != EXIF_IDENT:
+			return
+
+		start = index + 8
+		tiff = self._buf[start:self._index]
+		self.exif = (self._origin + start, len(tiff))
+		byte_order = bytes(tiff[:2])
+		if byte_order not in (b'II', b'MM'):
+			return
+		endian = '<' if byte_order == b'II' else '>'
+
+		try:
+			ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+			entries, ifd1 = read_ifd(tiff, endian, ifd0)
+			if not ifd1:
+				return
+			entries, next_ifd = read_ifd(tiff, endian, ifd1)
+		except struct.error:
+			return
+
+		if JPEG_INTERCHANGE_FORMAT not in entries or JPEG_INTERCHANGE_FORMAT_LENGTH not in entries:
+			return
+		offset = ifd_value(entries[JPEG_INTERCHANGE_FORMAT], endian)
+		size = ifd_value(entries[JPEG_INTERCHANGE_FORMAT_LENGTH], endian)
+		if size and offset + size <= len(tiff):
+			self.thumbnails.append(JpegThumbnail('EXIF', 'jpeg', None, None, self._origin + start + offset, size))
+
+	marker_handlers['APP1'] = handle_app1
+
+	# APP14 is where Adobe records whether the components were color transformed
+	#	(0: none, so RGB or CMYK; 1: YCbCr; 2: YCCK)
+	# Other APP14 segments are skipped like the rest of the APP headers
+	def handle_app14(self):
+		ADOBE_IDENT = b'Adobe'
+		ADOBE_LEN = 12 # does not include 2-byte length field
+
+		buf = self._buf
+		index = self._index
+
+		length = struct.unpack_from('>H', buf, index)[0]
+		if length - 2 >= ADOBE_LEN and struct.unpack_from('5s', buf, index + 2)[0] == ADOBE_IDENT:
+			# version, flags0 and flags1 come before the transform
+			self.is_adobe = True
+			self.adobe_transform = struct.unpack_from('>HHHB', buf, index + 7)[3]
+
+		self._index = index + length
+
+	marker_handlers['APP14'] = handle_app14
+
 
 	def handle_dqt(self):
-		# The DQT header contains one of the quantization tables used to encode the JPEG
+		# The DQT header contains the quantization tables used to encode the JPEG
 		# These tables are needed to perform the IDCT
-		# One header <--> one table (can have MAX_QUANTIZATION_TABLES)
+		# One header can carry several tables (we can have MAX_QUANTIZATION_TABLES in total)
+		buf = self._buf
 		index = self._index
 
-		length = struct.unpack('>H', self._buf[index:index+2])[0]
+		length = struct.unpack_from('>H', buf, index)[0]
+		end = index + length
 		index += 2
 
-		# quantization table number is the bottom 4 bits, precision is a boolean from top 4 of
-		# if we have precision marker, we use twice as many bytes for quant. table
-		# note that the precision of the actual dct samples is stored in the sof header, not here
-		quant_num_and_prec = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		quant_num = quant_num_and_prec & 0x0f
-		quant_precision = quant_num_and_prec >> 4
-		if quant_num >= self.MAX_QUANTIZATION_TABLES:
-			raise BadFieldError('DQT')
+		# We want to get the appropriate zigzag to natural conversion table
+		# Every table carries all 64 entries of an 8x8 block
+		zigzag_natural = self.zigzag_natural[8]
 
-		# Get the number of entries present for the quant. table.
-		# Subtract 3 to remove the previous fields' lengths and then div by 2 for higher precision table
-		num_entries = length - 3
-		if quant_precision:
-			num_entries /= 2
+		while index < end:
+			# quantization table number is the bottom 4 bits, precision is a boolean from top 4 of
+			# if we have precision marker, we use twice as many bytes for quant. table
+			# note that the precision of the actual dct samples is stored in the sof header, not here
+			quant_num_and_prec = struct.unpack_from('B', buf, index)[0]
+			index += 1
+			quant_num = quant_num_and_prec & 0x0f
+			quant_precision = quant_num_and_prec >> 4
+			if quant_num >= self.MAX_QUANTIZATION_TABLES:
+				raise BadFieldError('DQT')
 
-		table = [1] * num_entries
+			# Now we simply pull all the entries at once and put them in natural order
+			if quant_precision:
+				entries = struct.unpack_from('>64H', buf, index)
+				index += 128
+			else:
+				entries = struct.unpack_from('64B', buf, index)
+				index += 64
 
-		# We want to get the appropriate zigzag to natural conversion table
-		# Note that if num_entries is not a square something is wrong
-		# One dimension should be the sqrt of the number of entries
-		# XXX Do we actually want to handle non-64-entry cases?
-		dqt_dim = math.sqrt(num_entries)
-		if int(dqt_dim) != dqt_dim:
-			raise BadFieldError('DQT')
-		zigzag_natural = self.zigzag_natural.get(dqt_dim)
-		if zigzag_natural is None:
-			raise BadFieldError('DQT')
+			table = [1] * 64
+			for i in range(64):
+				table[zigzag_natural[i]] = entries[i]
 
-		# for now we are going to make sure it's 8x8 only
-		assert dqt_dim == 8
-
-		# Now we simply move along, collecting bytes and filling table
-		if quant_precision:
-			# precompile struct just to move a bit quicker
-			s = struct.Struct('>H')
-			for i in range(num_entries):
-				entry = s.unpack(self._buf[index:index+2])[0]
-				table[zigzag_natural[i]] = entry
-				index += 2
-		else:
-			s = struct.Struct('B')
-			for i in range(num_entries):
-				entry = s.unpack(self._buf[index:index+1])[0]
-				table[zigzag_natural[i]] = entry
-				index += 1
+			self.quantization_tables[quant_num] = table
+			self.quantization_high_precision[quant_num] = bool(quant_precision)
+
+		if index != end:
+			raise BadFieldError('DQT')
 
-		self.quantization_tables[quant_num] = table
-		self.quantization_high_precision[quant_num] = quant_precision
 		self._index = index
 
 	marker_handlers['DQT'] = handle_dqt
@@ -444,19 +2636,12 @@ class Jpeg(object):
 		for t in self.encoding_types:
 			self.encoding_type[t] = kwargs.get(t, False)
 
+		buf = self._buf
 		index = self._index
 
-		length = struct.unpack('>H', self._buf[index:index+2])[0]
-		index += 2
-
-		self.sample_precision = struct.unpack('B', self._buf[index])[0]
-		index += 1
-		self.image_height = struct.unpack('>H', self._buf[index:index+2])[0]
-		index += 2
-		self.image_width = struct.unpack('>H', self._buf[index:index+2])[0]
-		index += 2
-		num_components = struct.unpack('B', self._buf[index])[0]
-		index += 1
+		length, self.sample_precision, self.image_height, self.image_width, num_components = \
+				struct.unpack_from('>HBHHB', buf, index)
+		index += 8
 
 		if self.image_height == 0:
 			raise BadFieldError()
@@ -467,6 +2652,13 @@ class Jpeg(object):
 		if num_components == 0:
 			raise BadFieldError()
 
+		# DCT images have 8 or 12 bit samples, lossless ones anything from 2 to 16 bits
+		if kwargs.get('lossless'):
+			if not 2 <= self.sample_precision <= 16:
+				raise BadFieldError()
+		elif self.sample_precision not in (8, 12):
+			raise BadFieldError()
+
 		# 8 bytes removed from length to cover previous fields
 		# 3 bytes retrieved per component
 		if (length - 8) != (3 * num_components):
@@ -474,17 +2666,32 @@ class Jpeg(object):
 
 		# XXX handle case where this header isn't present (not here)
 		for i in range(num_components):
-			component_id = struct.unpack('B', self._buf[index])[0]
-			sample_factor = struct.unpack('B', self._buf[index + 1])[0]
-			quant_tbl_index = struct.unpack('B', self._buf[index + 2])[0]
+			component_id, sample_factor, quant_tbl_index = struct.unpack_from('BBB', buf, index)
 			index += 3
 			h_sample_factor = (sample_factor >> 4) & 0x0f
 			v_sample_factor = sample_factor & 0x0f
 			if quant_tbl_index >= self.MAX_QUANTIZATION_TABLES:
 				raise BadFieldError()
+			if not (1 <= h_sample_factor <= 4 and 1 <= v_sample_factor <= 4):
+				raise BadFieldError()
 			d = {'id': component_id, 'h_factor': h_sample_factor, 'v_factor': v_sample_factor, 'quant_tbl_index': quant_tbl_index}
 			self.components.append(d)
 
+		# Interleaved scans code the image in MCUs (minimum coded units), each covering
+		#	8 * max_h_factor by 8 * max_v_factor pixels and h_factor by v_factor blocks of every component
+		self.max_h_factor = max(c['h_factor'] for c in self.components)
+		self.max_v_factor = max(c['v_factor'] for c in self.components)
+		self.mcus_x = ceil_div(self.image_width, 8 * self.max_h_factor)
+		self.mcus_y = ceil_div(self.image_height, 8 * self.max_v_factor)
+		for c in self.components:
+			# the blocks that actually cover the (subsampled) component
+			#	a non-interleaved scan codes just these
+			c['width_in_blocks'] = ceil_div(ceil_div(self.image_width * c['h_factor'], self.max_h_factor), 8)
+			c['height_in_blocks'] = ceil_div(ceil_div(self.image_height * c['v_factor'], self.max_v_factor), 8)
+			# the component's share of all the MCUs, padding included
+			c['blocks_w'] = self.mcus_x * c['h_factor']
+			c['blocks_h'] = self.mcus_y * c['v_factor']
+
 		self._index = index
 
 	# And now we define the individual SOF types
@@ -532,34 +2739,34 @@ class Jpeg(object):
 
 	# SOF9 - Sequential / Arithmetic coding
 	def handle_sof9(self):
-		return self.handle_sof(sequential=True, arithmetic=True)
+		return self.handle_sof(sequential=True, arithmetic_code=True)
 	marker_handlers['SOF9'] = handle_sof9
 
 	# SOF10 - Progressive / Arithmetic coding
 	def handle_sof10(self):
-		return self.handle_sof(progressive=True, arithmetic=True)
+		return self.handle_sof(progressive=True, arithmetic_code=True)
 	marker_handlers['SOF10'] = handle_sof10
 
 	# SOF11 - Lossless / Arithmetic coding
 	def handle_sof11(self):
-		return self.handle_sof(progressive=True, differential=True)
+		return self.handle_sof(lossless=True, arithmetic_code=True)
 	marker_handlers['SOF11'] = handle_sof11
 
 	# SOF12 - Doesn't exist!
 
 	# SOF13 - Sequential / Differential / Arithmetic coding
 	def handle_sof13(self):
-		return self.handle_sof(sequential=True, differential=True, arithmetic=True)
+		return self.handle_sof(sequential=True, differential=True, arithmetic_code=True)
 	marker_handlers['SOF13'] = handle_sof13
 
 	# SOF14 - Progressive / Differential / Arithmetic coding
 	def handle_sof14(self):
-		return self.handle_sof(progressive=True, differential=True, arithmetic=True)
+		return self.handle_sof(progressive=True, differential=True, arithmetic_code=True)
 	marker_handlers['SOF14'] = handle_sof14
 
 	# SOF15 - Lossless / Differential / Arithmetic coding
 	def handle_sof15(self):
-		return self.handle_sof(lossless=True, differential=True, arithmetic=True)
+		return self.handle_sof(lossless=True, differential=True, arithmetic_code=True)
 	marker_handlers['SOF15'] = handle_sof15
 
 	# DHT - Define Huffman Tree
@@ -569,9 +2776,10 @@ class Jpeg(object):
 		MAX_SYMBOL_LENGTH = 16 # bits
 		MAX_NUM_SYMBOLS = 256
 
+		buf = self._buf
 		index = self._index
 
-		length = struct.unpack('>H', self._buf[index:index+2])[0]
+		length = struct.unpack_from('>H', buf, index)[0]
 		index += 2
 
 		# We get one section of one component at a time
@@ -580,28 +2788,23 @@ class Jpeg(object):
 		#	In fact, 4 trees could be defined by 4 calls to handle_dht with 1 tree each, 1 call to handle_dht with 4 trees, etc
 		# Also, we don't really check inside the loop if we violate the length but we will check after
 		while index < self._index + length:
-			huffman_index = struct.unpack('B', self._buf[index])[0]
+			huffman_index = struct.unpack_from('B', buf, index)[0]
 			index += 1
 
 			# next we grab the number of entries at each bit depth in this tree
 			# e.g. 0,0,1,4 -> 1 symbol of length 2 bits, 4 symbols of length 3 bits, etc.
 			# we also maintain a running total of how many symbols are in the tree
-			total = 0
-			counts = [0] * MAX_SYMBOL_LENGTH
-			for i in range(MAX_SYMBOL_LENGTH):
-				counts[i] = struct.unpack('B', self._buf[index])[0]
-				index += 1
-				total += counts[i]
+			counts = list(struct.unpack_from('%dB' % MAX_SYMBOL_LENGTH, buf, index))
+			index += MAX_SYMBOL_LENGTH
+			total = sum(counts)
 
 			if total > MAX_NUM_SYMBOLS:
 				raise BadFieldError()
 
 			# next we retrieve the ordered huffman tree values
 			# these values will fill the tree in row order, left to right
-			values = [0] * total
-			for i in range(total):
-				values[i] = struct.unpack('B', self._buf[index])[0]
-				index += 1
+			values = list(struct.unpack_from('%dB' % total, buf, index))
+			index += total
 
 			# finally, we save this information to self.huffman_data
 			# huffman_index has a bit flag in the high nibble to indicate dc or ac
@@ -610,10 +2813,15 @@ class Jpeg(object):
 			is_ac = bool(huffman_index & 0x10)
 			huffman_index &= 0x0f
 
-			if huffman_index > self.MAX_HUFFMAN_TABLES:
+			if huffman_index >= self.MAX_HUFFMAN_TABLES:
 				raise BadFieldError()
 
 			self.huffman_data[huffman_index][int(is_ac)] = (counts, values)
+			# a redefined table has to be built again
+			if is_ac:
+				self.huffman_ac[huffman_index] = None
+			else:
+				self.huffman_dc[huffman_index] = None
 
 		if index != self._index + length:
 			raise BadFieldError()
@@ -622,48 +2830,2008 @@ class Jpeg(object):
 
 	marker_handlers['DHT'] = handle_dht
 
-	# here's where we actually build the RGB output pixels and validate consistency of headers
+	# DAC - Define Arithmetic Coding conditioning
+	# Like DHT, any number of tables, each a class / destination byte and one value:
+	#	the lower and upper DC conditioning bounds L and U in its low and high nibble,
+	#	or the AC conditioning Kx
+	def handle_dac(self):
+		buf = self._buf
+		index = self._index
+
+		length = struct.unpack_from('>H', buf, index)[0]
+		end = self._index + length
+		index += 2
+
+		while index < end:
+			table, value = struct.unpack_from('BB', buf, index)
+			index += 2
+			is_ac = bool(table & 0x10)
+			table &= 0x0f
+			if table >= self.MAX_HUFFMAN_TABLES:
+				raise BadFieldError('DAC')
+			if is_ac:
+				if not 1 <= value <= 63:
+					raise BadFieldError('DAC')
+				self.arithmetic_ac[table] = value
+			else:
+				lower = value & 0x0f
+				upper = value >> 4
+				if lower > upper:
+					raise BadFieldError('DAC')
+				self.arithmetic_dc[table] = (lower, upper)
+
+		if index != end:
+			raise BadFieldError('DAC')
+
+		self._index = index
+
+	marker_handlers['DAC'] = handle_dac
+
+	# The SOS header names the components in the scan, the tables they use and,
+	#	for progressive scans, which coefficients / bits the scan carries
+	# We keep one dict per scan in self.scans, in the same spirit as self.components
+	def parse_sos_header(self):
+		buf = self._buf
+		index = self._index
+
+		length, num_components = struct.unpack_from('>HB', buf, index)
+		index += 3
+
+		# 6 bytes for the fixed fields, 2 bytes per component
+		if (length - 6) != (2 * num_components) or num_components == 0:
+			raise BadFieldError('SOS')
+
+		component_ids = [c['id'] for c in self.components]
+		scan_components = []
+		for i in range(num_components):
+			component_id, tables = struct.unpack_from('BB', buf, index)
+			index += 2
+			if component_id not in component_ids:
+				raise BadFieldError('SOS')
+			dc_tbl = tables >> 4
+			ac_tbl = tables & 0x0f
+			if dc_tbl >= self.MAX_HUFFMAN_TABLES or ac_tbl >= self.MAX_HUFFMAN_TABLES:
+				raise BadFieldError('SOS')
+			scan_components.append({'component': component_ids.index(component_id), 'dc_tbl': dc_tbl, 'ac_tbl': ac_tbl})
+
+		spectral_start, spectral_end, approx = struct.unpack_from('BBB', buf, index)
+		index += 3
+
+		scan = {
+				'components': scan_components,
+				'spectral_start': spectral_start,
+				'spectral_end': spectral_end,
+				'approx_high': approx >> 4,
+				'approx_low': approx & 0x0f,
+				# the entropy-coded data starts right after the header
+				'offset': self._origin + index,
+		}
+		self.scans.append(scan)
+		self._index = index
+		return scan
+
+	# Check that every table the scan refers to has been defined
+	#	DC tables are only needed by scans that carry DC bits for the first time,
+	#	AC tables only by scans that carry AC coefficients
+	def scan_tables_ready(self, scan):
+		for c in scan['components']:
+			component = self.components[c['component']]
+			# lossless images have no quantization tables, and code samples with the DC tables
+			if self.encoding_type.get('lossless'):
+				if not self.encoding_type.get('arithmetic_code') and self.huffman_data[c['dc_tbl']][0] is None:
+					return False
+				continue
+			if not self.quantization_tables[component['quant_tbl_index']]:
+				return False
+			if self.encoding_type.get('arithmetic_code'):
+				continue
+			if scan['spectral_start'] == 0 and scan['approx_high'] == 0:
+				if self.huffman_data[c['dc_tbl']][0] is None:
+					return False
+			if scan['spectral_end'] > 0:
+				if self.huffman_data[c['ac_tbl']][1] is None:
+					return False
+		return True
+
+	# Tables can be redefined between scans, so each scan keeps the JpegHuffman objects
+	#	that were current when it started
+	# Identical tables are shared between images, see huffman_cache
+	# Arithmetic coded scans keep their tables' conditioning instead, as (table, L, U) for
+	#	DC and (table, Kx) for AC
+	def build_scan_tables(self, scan):
+		if not self.scan_tables_ready(scan):
+			raise BadFieldError('SOS')
+		if self.encoding_type.get('arithmetic_code'):
+			for c in scan['components']:
+				c['dc_conditioning'] = (c['dc_tbl'],) + self.arithmetic_dc[c['dc_tbl']]
+				c['ac_conditioning'] = (c['ac_tbl'], self.arithmetic_ac[c['ac_tbl']])
+			return
+
+		# A symbol's magnitude category can't be more than the bits a difference or coefficient
+		#	can have: spec F.1.2.1 and H.1.2.2, so 11 for DC and 10 for AC at 8 bit precision,
+		#	15 and 14 at 12 bit, 16 for lossless
+		# The tables aren't checked in handle_dht, which can come before the SOF that sets
+		#	the precision
+		if self.encoding_type.get('lossless'):
+			max_dc = 16
+		else:
+			max_dc = self.sample_precision + 3
+		max_ac = max_dc - 1
+
+		for c in scan['components']:
+			dc_tbl = c['dc_tbl']
+			ac_tbl = c['ac_tbl']
+			c['dc_huffman'] = None
+			c['ac_huffman'] = None
+			if self.huffman_data[dc_tbl][0] is not None:
+				if self.huffman_dc[dc_tbl] is None:
+					counts, values = self.huffman_data[dc_tbl][0]
+					if values and max(values) > max_dc:
+						raise BadFieldError('DHT')
+					self.huffman_dc[dc_tbl] = huffman_table(counts, values)
+				c['dc_huffman'] = self.huffman_dc[dc_tbl]
+			if self.huffman_data[ac_tbl][1] is not None:
+				if self.huffman_ac[ac_tbl] is None:
+					counts, values = self.huffman_data[ac_tbl][1]
+					if any(v & 0x0f > max_ac for v in values):
+						raise BadFieldError('DHT')
+					self.huffman_ac[ac_tbl] = huffman_table(counts, values)
+				c['ac_huffman'] = self.huffman_ac[ac_tbl]
+
+	# We only parse the scan header and build its tables here, then skip over the
+	#	entropy-coded data; decode_scans() does the actual decoding later
 	def handle_sos(self):
-		# now build the huffman objects
-		for l in self.huffman_data:
-			dc = l[0]
-			ac = l[1]
+		scan = self.parse_sos_header()
+		self.build_scan_tables(scan)
 
-			# XXX make sure the indices store correctly
-			if dc is not None:
-				self.huffman_dc.append(JpegHuffman(dc))
-			if ac is not None:
-				self.huffman_ac.append(JpegHuffman(ac))
+		# an index already knows where everything in the scan is
+		if self.index is not None and len(self.index.scans) >= len(self.scans):
+			indexed = self.index.scans[len(self.scans) - 1]
+			if indexed['offset'] != scan['offset'] or indexed['restart_interval'] != self.restart_interval:
+				raise BadIndexError('index does not match the file')
+			for key in ('length', 'restart_interval', 'segments', 'checkpoints'):
+				scan[key] = indexed[key]
+			self._index += scan['length']
+			return
+
+		match = self.entropy_end.search(self._buf, self._index)
+		if match is None:
+			raise TruncatedFileError(len(self._buf))
+		end = match.start()
+		scan['length'] = end - self._index
 
-		raise BadFieldError()
+		# Record where the data of each restart interval starts and ends, so the intervals
+		#	can be decoded independently
+		scan['restart_interval'] = self.restart_interval
+		segments = []
+		start = self._index
+		for match in self.restart_marker.finditer(self._buf, start, end):
+			# RSTn markers count 0 to 7 and round again; one out of turn (or any at all without
+			#	a restart interval) means data was lost or mangled, and every interval after it
+			#	would be decoded into the wrong MCUs
+			if not self.restart_interval or self._buf[match.end() - 1] != 0xd0 + len(segments) % 8:
+				raise BadFieldError('RST')
+			segments.append((self._origin + start, self._origin + match.start()))
+			start = match.end()
+		segments.append((self._origin + start, self._origin + end))
+		# the same goes for markers missing at the end
+		if self.restart_interval and len(segments) < ceil_div(self.scan_mcu_count(scan), self.restart_interval):
+			raise BadFieldError('RST')
+		scan['segments'] = segments
+
+		self._index = end
 
 	marker_handlers['SOS'] = handle_sos
 
+	# Entropy decode every scan into self.blocks, which holds one array of coefficients per
+	#	component: blocks_w * blocks_h blocks in row order, 64 coefficients per block in zigzag order
+	def decode_scans(self):
+		while self.decode_next_scan() is not None:
+			pass
+		return self.blocks
+
+	# Entropy decode the next scan into self.blocks, allocating them on the first call
+	#	progressive scans add to what the earlier ones left there
+	#	returns the scan, or None once all of them have been decoded
+	def decode_next_scan(self):
+		if self.blocks is None:
+			self.blocks = [array.array('h', bytes(128 * c['blocks_w'] * c['blocks_h'])) for c in self.components]
+		if self.scans_decoded == len(self.scans):
+			return None
+		scan = self.scans[self.scans_decoded]
+		self.decode_scan(scan)
+		self.scans_decoded += 1
+		return scan
+
+	# The quantized DCT coefficients, without going on to reconstruct any pixels
+	# Returns one array per component, of shape (blocks_h, blocks_w, 64) holding each block in
+	#	natural order, padding blocks included (only the first width_in_blocks columns and
+	#	height_in_blocks rows hold image data in a non-interleaved scan); these are NumPy int16
+	#	arrays, or memoryviews of the same shape and format 'h' without NumPy
+	# dc_only returns just the DC coefficients, arrays of shape (blocks_h, blocks_w), decoded
+	#	as partial_blocks() does
+	def coefficients(self, dc_only=False):
+		if dc_only and self.scans_decoded < len(self.scans):
+			blocks = self.partial_blocks([1] * len(self.components))
+		else:
+			blocks = self.decode_scans()
+
+		result = []
+		for coefficients, c in zip(blocks, self.components):
+			shape = (c['blocks_h'], c['blocks_w'])
+			if dc_only:
+				if numpy is not None:
+					result.append(numpy.frombuffer(coefficients, dtype=numpy.int16)[::64].reshape(shape).copy())
+				else:
+					result.append(memoryview(coefficients[::64]).cast('B').cast('h', shape))
+			elif numpy is not None:
+				zigzag = numpy.frombuffer(coefficients, dtype=numpy.int16).reshape(shape + (64,))
+				result.append(zigzag[:, :, NATURAL_ZIGZAG])
+			else:
+				natural = array.array('h', bytes(len(coefficients) * 2))
+				for n, z in enumerate(NATURAL_ZIGZAG):
+					natural[n::64] = coefficients[z::64]
+				result.append(memoryview(natural).cast('B').cast('h', shape + (64,)))
+		return result
+
+	# Entropy decode just the first keep[i] coefficients (in zigzag order) of each block of
+	#	component i, into new blocks rather than self.blocks: a sequential huffman scan reads
+	#	past the rest without storing them (arithmetic coded ones are decoded whole), and a
+	#	progressive image's AC scans are skipped outright for components keeping only the DC
+	# Other AC scans are all decoded, since how a refinement scan reads depends on which
+	#	coefficients of its band the scans before it made nonzero
+	def partial_blocks(self, keep):
+		blocks = [array.array('h', bytes(128 * c['blocks_w'] * c['blocks_h'])) for c in self.components]
+		progressive = self.encoding_type.get('progressive')
+		for scan in self.scans:
+			if progressive and scan['spectral_start'] > 0 and all(keep[c['component']] == 1 for c in scan['components']):
+				continue
+			self.decode_scan(scan, blocks, keep)
+		return blocks
+
+	# Dequantize and IDCT the decoded coefficients of every component
+	# Returns one plane of samples per component, covering all of its blocks (padding
+	#	included), so each is component['blocks_w'] * size samples wide, where size is
+	#	the component's IDCT size at scale, see scaling()
+	#	with the numpy backend these are 2-D arrays, otherwise flat bytearrays
+	# With workers, restart intervals are decoded in parallel when the image allows it, see
+	#	decode_planes_parallel()
+	# Below scale 1, when nothing has been decoded yet, only the coefficients the reduced IDCTs
+	#	use are decoded (see partial_blocks()), and self.blocks is left unset; at 1/8 that is
+	#	just the DC of each block not upsampled
+	def decode_planes(self, backend=None, workers=None, scale=1):
+		backend = check_backend(backend)
+		sizes = [size for size, h_ratio, v_ratio in self.scaling(scale)]
+		if workers is not None and self.blocks is None and self.can_decode_in_parallel():
+			return self.decode_planes_parallel(backend, workers, sizes)
+		if self.blocks is None and min(sizes) < 8:
+			blocks = self.partial_blocks([reduced_coefficients(size) for size in sizes])
+			return self.idct_planes(backend, scale, blocks, (self.mcus_x, self.mcus_y))
+		if self.blocks is None or self.scans_decoded < len(self.scans):
+			self.decode_scans()
+		return self.idct_planes(backend, scale)
+
+	# Dequantize and IDCT self.blocks as they are, see decode_planes()
+	#	or blocks covering just mcus (MCU columns, MCU rows) of the image, see region_blocks()
+	def idct_planes(self, backend=None, scale=1, blocks=None, mcus=None):
+		backend = check_backend(backend)
+		if blocks is None:
+			blocks = self.blocks
+			mcus = (self.mcus_x, self.mcus_y)
+		sizes = [size for size, h_ratio, v_ratio in self.scaling(scale)]
+		if self.profile is not None:
+			start_time = time.perf_counter()
+		planes = []
+		for coefficients, component, size in zip(blocks, self.components, sizes):
+			qtable = self.quantization_tables[component['quant_tbl_index']]
+			planes.append(idct_plane(coefficients, qtable, mcus[0] * component['h_factor'], mcus[1] * component['v_factor'],
+					self.sample_precision, component['v_factor'], backend, size))
+		if self.profile is not None:
+			self.profile.add_stage('idct', time.perf_counter() - start_time)
+		return planes
+
+	# The last checkpoint of the scan in MCUs [first, mcu], see JpegIndex
+	#	returns (mcu, file offset, bit, predictions), or None
+	def scan_checkpoint(self, scan, first, mcu):
+		checkpoints = scan.get('checkpoints')
+		if not checkpoints or not checkpoints[0]:
+			return None
+		mcus, positions, bits, predictions = checkpoints
+		i = bisect.bisect_right(mcus, mcu) - 1
+		if i < 0 or mcus[i] < first:
+			return None
+		num_predictors = len(predictions) // len(mcus)
+		return mcus[i], positions[i], bits[i], list(predictions[i * num_predictors:(i + 1) * num_predictors])
+
+	# Index the file for random access, see JpegIndex
+	#	with checkpoint_interval, sequential huffman scans are entropy decoded (without
+	#	storing anything) to record a checkpoint every that many MCUs
+	def build_index(self, checkpoint_interval=0):
+		markers = []
+		codes = dict((name, code) for code, name in self.markers.items())
+		for marker, offsets in self.trackers.items():
+			markers.extend((codes[marker], offset) for offset in offsets)
+		markers.sort(key=lambda m: m[1])
+
+		scans = []
+		for scan in self.scans:
+			if checkpoint_interval and not self.encoding_type.get('progressive') and not self.encoding_type.get('arithmetic_code'):
+				checkpoints = self.scan_checkpoints(scan, checkpoint_interval)
+			else:
+				checkpoints = (array.array('I'), array.array('Q'), array.array('B'), array.array('i'))
+			scans.append({
+					'offset': scan['offset'],
+					'length': scan['length'],
+					'restart_interval': scan['restart_interval'],
+					'segments': scan['segments'],
+					'checkpoints': checkpoints,
+			})
+
+		header_size = self.scans[0]['offset'] if self.scans else len(self._buf)
+		return JpegIndex(len(self._buf), header_size, zlib.crc32(self._buf[:header_size]), markers, scans,
+				checkpoint_interval)
+
+	# Decode a sequential scan noting the decoder's state every interval MCUs, see build_index()
+	def scan_checkpoints(self, scan, interval):
+		mcus, positions, bits, predictions = array.array('I'), array.array('Q'), array.array('B'), array.array('i')
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		num_predictors = len(scan['components'])
+		scratch = array.array('h', bytes(128))
+		skip = [(scratch, dc, ac, predictor, 0, 0, 0, 0, 0) for c, dc, ac, predictor, stride, h, v, x, y in units]
+		restart_interval = scan['restart_interval'] or mcu_count
+
+		for i, (start, end) in enumerate(scan['segments']):
+			first = i * restart_interval
+			last = min(first + restart_interval, mcu_count)
+			if first >= last:
+				break
+			stuffed = bytes(self._buf[start - self._origin:end - self._origin])
+			unstuffed = stuffed.replace(b'\xff\x00', b'\xff')
+			data = unstuff(stuffed)
+			state = [0, 0, 0, [0] * num_predictors]
+			# 0xff bytes before byte, each of which had a stuffed 0x00 after it in the file
+			byte = stuffing = 0
+			mcu = first
+			for checkpoint in range(first + interval - first % interval, last, interval):
+				try:
+					decode_huffman_sequential(data, skip, mcus_per_row, mcu, checkpoint, num_predictors, state)
+				except IndexError:
+					raise TruncatedFileError(end)
+				mcu = checkpoint
+				bit_position = state[0] * 32 - state[2]
+				stuffing += unstuffed.count(b'\xff', byte, bit_position >> 3)
+				byte = bit_position >> 3
+				mcus.append(mcu)
+				positions.append(start + byte + stuffing)
+				bits.append(bit_position & 7)
+				predictions.extend(state[3])
+		return mcus, positions, bits, predictions
+
+	# How each component is reconstructed when decoding at scale (1, 1/2, 1/4 or 1/8):
+	#	returns (IDCT size, (h, max h), (v, max v)) per component, the ratios being what its
+	#	samples are upsampled by
+	# Like libjpeg, a subsampled component is IDCT'd to a larger size where that makes
+	#	upsampling unnecessary, which at reduced scales is cheaper and sharper
+	def scaling(self, scale=1):
+		size = scale_size(scale)
+		scaling = []
+		for c in self.components:
+			h_ratio = (c['h_factor'], self.max_h_factor)
+			v_ratio = (c['v_factor'], self.max_v_factor)
+			factor = self.max_h_factor // c['h_factor']
+			if (factor > 1 and self.max_h_factor % c['h_factor'] == 0 and self.max_v_factor % c['v_factor'] == 0
+					and self.max_v_factor // c['v_factor'] == factor and size * factor <= 8):
+				scaling.append((size * factor, (1, 1), (1, 1)))
+			else:
+				scaling.append((size, h_ratio, v_ratio))
+		return scaling
+
+	# Restart intervals can only be taken all the way to samples independently when a single
+	#	sequential scan carries the whole image
+	def can_decode_in_parallel(self):
+		for t in ('progressive', 'arithmetic_code', 'lossless', 'differential'):
+			if self.encoding_type.get(t):
+				return False
+		return (len(self.scans) == 1 and self.scans[0]['restart_interval'] > 0
+				and len(self.scans[0]['components']) == len(self.components))
+
+	# Split the scan at its restart markers and hand runs of restart intervals to a process
+	#	pool; each worker entropy decodes and IDCTs its intervals (see decode_restart_task())
+	#	and the samples of the MCUs it covered are copied into the planes here
+	# workers is either a number of processes or a concurrent.futures.Executor to use
+	# self.blocks is left unset, since the coefficients never reach this process
+	def decode_planes_parallel(self, backend, workers, sizes):
+		scan = self.scans[0]
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		restart_interval = scan['restart_interval']
+		segments = scan['segments'][:ceil_div(mcu_count, restart_interval)]
+		interleaved = len(scan['components']) > 1
+
+		# (blocks_w, blocks per MCU across, blocks per MCU down, qtable, IDCT size) of each component
+		geometry = []
+		for component, size in zip(self.components, sizes):
+			qtable = self.quantization_tables[component['quant_tbl_index']]
+			if interleaved:
+				geometry.append((component['blocks_w'], component['h_factor'], component['v_factor'], qtable, size))
+			else:
+				geometry.append((component['blocks_w'], 1, 1, qtable, size))
+
+		if isinstance(workers, concurrent.futures.Executor):
+			executor = workers
+			# an executor does not say how many workers it has, so plan for one per CPU
+			num_workers = os.cpu_count() or 1
+		else:
+			executor = concurrent.futures.ProcessPoolExecutor(workers)
+			num_workers = workers
+
+		# a few tasks per worker evens out intervals that take longer than others
+		per_task = ceil_div(len(segments), min(len(segments), 4 * num_workers))
+		tasks = []
+		for first in range(0, len(segments), per_task):
+			group = segments[first:first + per_task]
+			start = group[0][0]
+			data = self._buf[start - self._origin:group[-1][1] - self._origin].tobytes()
+			bounds = [(s - start, e - start) for s, e in group]
+			tasks.append((data, bounds, first, units, mcus_per_row, mcu_count, restart_interval,
+					geometry, self.sample_precision, backend))
+
+		planes = []
+		for component, size in zip(self.components, sizes):
+			planes.append(new_plane(component['blocks_w'] * size, component['blocks_h'] * size, self.sample_precision, backend))
+
+		if self.profile is not None:
+			start_time = time.perf_counter()
+		try:
+			for mcu_start, mcu_end, row0, local_planes in executor.map(decode_restart_task, tasks):
+				for plane, local, (blocks_w, h, v, qtable, size) in zip(planes, local_planes, geometry):
+					copy_mcus(plane, local, blocks_w * size, mcus_per_row, mcu_start, mcu_end, row0, h, v, backend, size)
+		finally:
+			if executor is not workers:
+				executor.shutdown()
+		if self.profile is not None:
+			self.profile.add_stage('parallel', time.perf_counter() - start_time)
+		return planes
+
+	# Work out what the components hold, the way libjpeg does:
+	#	'L', 'YCbCr', 'RGB', 'CMYK' or 'YCCK'
+	def color_space(self):
+		num_components = len(self.components)
+		if num_components == 1:
+			return 'L'
+		if num_components == 3:
+			if self.is_jfif:
+				return 'YCbCr'
+			if self.is_adobe:
+				return 'RGB' if self.adobe_transform == 0 else 'YCbCr'
+			if [c['id'] for c in self.components] == [ord('R'), ord('G'), ord('B')]:
+				return 'RGB'
+			return 'YCbCr'
+		if num_components == 4:
+			if self.is_adobe and self.adobe_transform == 2:
+				return 'YCCK'
+			return 'CMYK'
+		raise BadFieldError('SOF')
+
+	# Decode the image to pixels in mode ('L', 'RGB', 'RGBA' or 'CMYK')
+	# The pixels are written row by row, interleaved, into out if it is given (anything writable
+	#	with the buffer protocol, e.g. a bytearray or a numpy array, of the right size) and
+	#	out is returned; otherwise a new bytearray or, with the numpy backend, an array of
+	#	shape (height, width, channels) is returned
+	# Samples are bytes, or 16 bit ints for images with more than 8 bit precision
+	# workers decodes restart intervals in parallel, see decode_planes()
+	# scale (1, 1/2, 1/4 or 1/8) decodes a smaller image straight from the coefficients, with
+	#	reduced size IDCTs; see output_size() for its dimensions
+	# region (x, y, width, height), in pixels of the output at scale, decodes just that
+	#	rectangle, see decode_region()
+	def decode(self, mode='RGB', out=None, backend=None, workers=None, scale=1, region=None):
+		backend = check_backend(backend)
+		if self.encoding_type.get('lossless'):
+			self.image = self.decode_lossless(mode, out, backend, scale, region)
+			return self.image
+		self.check_mode(mode)
+		if region is not None:
+			self.image = self.decode_region(region, mode, out, backend, scale)
+			return self.image
+		planes = self.decode_planes(backend, workers, scale)
+		self.image = self.render(planes, mode, out, backend, scale)
+		return self.image
+
+	# Decode a lossless (SOF3) image, spec annex H, see decode()
+	#	the samples are output as they are coded, so mode has to have a channel per component:
+	#	'L' for one, 'RGB' for three and 'CMYK' for four; subsampled components are upsampled
+	#	by repeating samples
+	#	samples are bytes for up to 8 bit precision, and 16 bit ints above that
+	# Lossless images are decoded at full scale, whole; region crops the result
+	def decode_lossless(self, mode='RGB', out=None, backend=None, scale=1, region=None):
+		for t in ('arithmetic_code', 'differential'):
+			if self.encoding_type.get(t):
+				raise MarkerNotHandledError('SOS', t)
+		backend = check_backend(backend)
+		channels = MODE_CHANNELS.get(mode)
+		if channels != len(self.components) or mode == 'RGBA':
+			raise ValueError(mode)
+		if scale_size(scale) != 8:
+			raise ValueError(scale)
+		x0, y0, width, height = region if region is not None else (0, 0, self.image_width, self.image_height)
+		if x0 < 0 or y0 < 0 or width <= 0 or height <= 0 or x0 + width > self.image_width or y0 + height > self.image_height:
+			raise ValueError(region)
+
+		planes = self.lossless_planes(backend)
+		sample_size = 1 if self.sample_precision <= 8 else 2
+		if out is None:
+			if backend == 'numpy':
+				out = numpy.empty((height, width, channels), dtype=numpy.uint8 if sample_size == 1 else numpy.uint16)
+			else:
+				out = bytearray(width * height * channels * sample_size)
+		view = as_byte_view(out)
+		if len(view) != width * height * channels * sample_size:
+			raise ValueError('output buffer size')
+
+		ratios = [(self.max_h_factor // c['h_factor'], self.max_v_factor // c['v_factor']) for c in self.components]
+		# there is no color conversion, so upsampling and interleaving is all that is left
+		if self.profile is not None:
+			start_time = time.perf_counter()
+		if backend == 'numpy':
+			pixels = numpy.frombuffer(view, dtype=numpy.uint8 if sample_size == 1 else numpy.uint16).reshape(height, width, channels)
+			for i, ((plane, stride), (h_ratio, v_ratio)) in enumerate(zip(planes, ratios)):
+				plane = numpy.frombuffer(plane, dtype=numpy.int32).reshape(-1, stride)
+				xs = numpy.arange(x0, x0 + width) // h_ratio
+				ys = numpy.arange(y0, y0 + height) // v_ratio
+				pixels[:, :, i] = plane[ys[:, None], xs]
+		else:
+			if sample_size == 2:
+				view = view.cast('H')
+			make_row = bytes if sample_size == 1 else lambda values: array.array('H', values)
+			line = width * channels
+			for y in range(height):
+				for i, ((plane, stride), (h_ratio, v_ratio)) in enumerate(zip(planes, ratios)):
+					start = (y0 + y) // v_ratio * stride
+					view[y * line + i:(y + 1) * line:channels] = make_row([plane[start + x // h_ratio] for x in range(x0, x0 + width)])
+		if self.profile is not None:
+			self.profile.add_stage('upsample', time.perf_counter() - start_time)
+		return out
+
+	# Entropy decode every lossless scan and undo the prediction, see decode_lossless()
+	#	returns (samples, stride) for each component, the samples as an int32 array with
+	#	stride to a row, which holds at least the component's share of the image
+	def lossless_planes(self, backend):
+		# a lossless MCU is h_factor by v_factor samples of each component
+		mcus_x = ceil_div(self.image_width, self.max_h_factor)
+		mcus_y = ceil_div(self.image_height, self.max_v_factor)
+		planes = [array.array('i', bytes(4 * mcus_x * c['h_factor'] * mcus_y * c['v_factor'])) for c in self.components]
+		samples = lossless_samples_numpy if backend == 'numpy' else lossless_samples_python
+
+		for scan in self.scans:
+			predictor = scan['spectral_start']
+			point_transform = scan['approx_low']
+			if not 1 <= predictor <= 7 or scan['spectral_end'] or scan['approx_high'] or point_transform >= self.sample_precision:
+				raise BadFieldError('SOS')
+
+			# (component, samples across, rows, MCUs they make up a row of) for each component,
+			#	and the samples of one MCU
+			units = []
+			coded = []
+			if len(scan['components']) == 1:
+				c = scan['components'][0]
+				component = self.components[c['component']]
+				stride = mcus_x * component['h_factor']
+				width = ceil_div(self.image_width * component['h_factor'], self.max_h_factor)
+				height = ceil_div(self.image_height * component['v_factor'], self.max_v_factor)
+				units.append((planes[c['component']], c['dc_huffman'], stride, 1, 1, 0, 0))
+				coded.append((c['component'], width, height, 1))
+				mcus_per_row, mcu_count = width, width * height
+			else:
+				for c in scan['components']:
+					component = self.components[c['component']]
+					h = component['h_factor']
+					v = component['v_factor']
+					for y in range(v):
+						for x in range(h):
+							units.append((planes[c['component']], c['dc_huffman'], mcus_x * h, h, v, x, y))
+					coded.append((c['component'], mcus_x * h, mcus_y * v, v))
+				mcus_per_row, mcu_count = mcus_x, mcus_x * mcus_y
+
+			# prediction starts over with each restart interval, which has to begin a row
+			restart_interval = scan['restart_interval'] or mcu_count
+			if restart_interval % mcus_per_row:
+				raise MarkerNotHandledError('DRI', 'restart interval is not a whole number of MCU rows')
+			if self.profile is not None:
+				start_time = time.perf_counter()
+			for i, (start, end) in enumerate(scan['segments']):
+				mcu_start = i * restart_interval
+				if mcu_start >= mcu_count:
+					break
+				data = unstuff(self._buf[start - self._origin:end - self._origin])
+				try:
+					decode_huffman_lossless(data, units, mcus_per_row, mcu_start, min(mcu_start + restart_interval, mcu_count))
+				except IndexError:
+					raise TruncatedFileError(end)
+
+			if self.profile is not None:
+				self.profile.add_stage('entropy', time.perf_counter() - start_time)
+				start_time = time.perf_counter()
+
+			first_rows = set(range(0, ceil_div(mcu_count, mcus_per_row), restart_interval // mcus_per_row))
+			for c, width, height, v in coded:
+				stride = mcus_x * self.components[c]['h_factor']
+				samples(planes[c], width, height, stride, predictor, self.sample_precision, point_transform,
+						set(row * v for row in first_rows))
+			if self.profile is not None:
+				self.profile.add_stage('prediction', time.perf_counter() - start_time)
+
+		return [(plane, mcus_x * c['h_factor']) for plane, c in zip(planes, self.components)]
+
+	# Decode just the MCUs under region, and only as much of the entropy-coded data as
+	#	that needs: with restart markers we go straight to the intervals holding them, without
+	#	we decode up to the region's last MCU, storing nothing for MCUs outside it
+	# Only the region's MCUs are IDCT'd, upsampled and color converted
+	# Progressive images, and ones already entropy decoded, take the region's coefficients
+	#	from self.blocks instead
+	def decode_region(self, region, mode='RGB', out=None, backend=None, scale=1):
+		x, y, width, height = region
+		full_width, full_height = self.output_size(scale)
+		if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > full_width or y + height > full_height:
+			raise ValueError(region)
+
+		size = scale_size(scale)
+		mcu_width = self.max_h_factor * size
+		mcu_height = self.max_v_factor * size
+		columns = (x // mcu_width, ceil_div(x + width, mcu_width))
+		rows = (y // mcu_height, ceil_div(y + height, mcu_height))
+
+		blocks = self.region_blocks(columns, rows)
+		mcus = (columns[1] - columns[0], rows[1] - rows[0])
+		planes = self.idct_planes(backend, scale, blocks, mcus)
+		window = (x - columns[0] * mcu_width, y - rows[0] * mcu_height, width, height, mcus[0])
+		return self.render(planes, mode, out, backend, scale, window)
+
+	# The coefficients of MCU columns [c0, c1) and rows [r0, r1) of the image, one array per
+	#	component laid out as self.blocks is, but just (c1 - c0) MCUs wide
+	def region_blocks(self, columns, rows):
+		c0, c1 = columns
+		r0, r1 = rows
+		region = []
+		for c in self.components:
+			region.append(array.array('h', bytes(128 * (c1 - c0) * c['h_factor'] * (r1 - r0) * c['v_factor'])))
+
+		if self.blocks is None and not self.encoding_type.get('progressive') and not self.encoding_type.get('arithmetic_code'):
+			if self.profile is not None:
+				start_time = time.perf_counter()
+			for scan in self.scans:
+				self.decode_scan_region(scan, region, columns, rows)
+			if self.profile is not None:
+				self.profile.add_stage('entropy', time.perf_counter() - start_time)
+			return region
+
+		self.decode_scans()
+		for blocks, local, c in zip(self.blocks, region, self.components):
+			h = c['h_factor']
+			v = c['v_factor']
+			line = (c1 - c0) * h * 64
+			for row in range(r1 - r0):
+				for y in range(v):
+					start = (((r0 + row) * v + y) * c['blocks_w'] + c0 * h) * 64
+					at = (row * v + y) * line
+					local[at:at + line] = blocks[start:start + line]
+		return region
+
+	# Entropy decode the part of a sequential scan that falls in MCU columns [c0, c1) and
+	#	rows [r0, r1) into region, see region_blocks()
+	# MCUs before and between the wanted ones in a restart interval still have to be decoded
+	#	to get past them; they are all written to one scratch block
+	def decode_scan_region(self, scan, region, columns, rows):
+		for t in ('progressive', 'arithmetic_code', 'lossless', 'differential'):
+			if self.encoding_type.get(t):
+				raise MarkerNotHandledError('SOS', t)
+
+		c0, c1 = columns
+		r0, r1 = rows
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		num_predictors = len(scan['components'])
+		scratch = array.array('h', bytes(128))
+		skip = [(scratch, dc, ac, predictor, 0, 0, 0, 0, 0) for c, dc, ac, predictor, stride, h, v, x, y in units]
+
+		if len(scan['components']) == 1:
+			# a non-interleaved scan's MCUs are the blocks of its component that hold image data
+			component = self.components[units[0][0]]
+			h = component['h_factor']
+			v = component['v_factor']
+			c, dc, ac = units[0][:3]
+			stride = (c1 - c0) * h
+			units = [(region[c], dc, ac, 0, stride, 1, 1, -c0 * h, -r0 * v)]
+			first, last = c0 * h, min(c1 * h, component['width_in_blocks'])
+			wanted = range(r0 * v, min(r1 * v, component['height_in_blocks']))
+		else:
+			units = [(region[c], dc, ac, predictor, (c1 - c0) * h, h, v, x - c0 * h, y - r0 * v)
+					for c, dc, ac, predictor, stride, h, v, x, y in units]
+			first, last = c0, c1
+			wanted = range(r0, r1)
+		if first >= last:
+			return
+
+		# the runs of wanted MCUs, split at restart intervals
+		restart_interval = scan['restart_interval'] or mcu_count
+		runs = {}
+		for row in wanted:
+			start = row * mcus_per_row + first
+			end = row * mcus_per_row + last
+			for i in range(start // restart_interval, (end - 1) // restart_interval + 1):
+				runs.setdefault(i, []).append((max(start, i * restart_interval), min(end, (i + 1) * restart_interval)))
+
+		segments = scan['segments']
+		for i, pieces in runs.items():
+			start, end = segments[i]
+			mcu = i * restart_interval
+			state = [0, 0, 0, [0] * num_predictors]
+
+			# start from the last checkpoint before the first wanted MCU, if there is one
+			checkpoint = self.scan_checkpoint(scan, mcu, pieces[0][0])
+			if checkpoint is not None:
+				mcu, start, bit, predictions = checkpoint
+				state = [1, 0, 32 - bit, predictions]
+			data = unstuff(self._buf[start - self._origin:end - self._origin])
+			state[1] = data[0]
+			try:
+				for piece_start, piece_end in pieces:
+					decode_huffman_sequential(data, skip, mcus_per_row, mcu, piece_start, num_predictors, state)
+					decode_huffman_sequential(data, units, mcus_per_row, piece_start, piece_end, num_predictors, state)
+					mcu = piece_end
+			except IndexError:
+				raise TruncatedFileError(end)
+
+	# Decode the image scan by scan, yielding (scan, pixels) after each one
+	#	the pixels are what decode() would return, reconstructed from the coefficients of the
+	#	scans so far; for a progressive image the first is a preview from the DC values alone
+	#	out, if given, is reused for every one of them
+	# Stop whenever the preview is good enough; decode() carries on from that scan
+	def previews(self, mode='RGB', out=None, backend=None, scale=1):
+		backend = check_backend(backend)
+		self.check_mode(mode)
+		while self.decode_next_scan() is not None:
+			yield self.scans[self.scans_decoded - 1], self.render(self.idct_planes(backend, scale), mode, out, backend, scale)
+
+	# Decode the image one MCU row at a time, yielding (y, pixels) for each strip of output
+	#	rows from row y down, laid out as decode() lays out the whole image; with mode None
+	#	the pixels are the strip's component planes, as idct_planes() makes them
+	# A sequential image coded in a single scan is entropy decoded as the strips are taken:
+	#	only one MCU row of coefficients, and the entropy-coded data that row needs, is held
+	#	at once, so memory grows with the width of the image rather than its area
+	# Others (progressive, or a scan per component) have to be entropy decoded in full
+	#	first, and only their pixels come a strip at a time
+	def strips(self, mode='RGB', backend=None, scale=1):
+		backend = check_backend(backend)
+		if mode is not None:
+			self.check_mode(mode)
+		size = scale_size(scale)
+		width, height = self.output_size(scale)
+		strip_height = self.max_v_factor * size
+		mcus = (self.mcus_x, 1)
+
+		for row, blocks in enumerate(self.coefficient_rows()):
+			planes = self.idct_planes(backend, scale, blocks, mcus)
+			y = row * strip_height
+			if mode is None:
+				yield y, planes
+			else:
+				window = (0, 0, width, min(strip_height, height - y), self.mcus_x)
+				yield y, self.render(planes, mode, None, backend, scale, window)
+
+	# The coefficients of the image one MCU row at a time, each laid out as region_blocks()
+	#	lays them out
+	#	a sequential image coded in a single scan is entropy decoded a row at a time as they
+	#	are taken, see stream_mcu_rows(); anything else is entropy decoded in full first
+	def coefficient_rows(self):
+		streamable = self.blocks is None and len(self.scans) == 1 and len(self.scans[0]['components']) == len(self.components)
+		for t in ('progressive', 'arithmetic_code', 'lossless', 'differential'):
+			if self.encoding_type.get(t):
+				streamable = False
+		if streamable:
+			return self.stream_mcu_rows(self.scans[0])
+		self.decode_scans()
+		return (self.region_blocks((0, self.mcus_x), (row, row + 1)) for row in range(self.mcus_y))
+
+	# How a scan's MCUs fall in MCU rows of the image, for working on it a row at a time
+	#	units, mcus_per_row are from scan_units()
+	#	returns, for each MCU row, the lines of mcus_per_row MCUs it is coded as: one for an
+	#	interleaved scan, and one per block row of the component for a non-interleaved one,
+	#	each as (block row in the MCU row, first MCU)
+	def scan_lines(self, units, mcus_per_row):
+		if len(units) == 1:
+			component = self.components[units[0][0]]
+			v = component['v_factor']
+			return [[(y, (row * v + y) * mcus_per_row) for y in range(v) if row * v + y < component['height_in_blocks']]
+					for row in range(self.mcus_y)]
+		return [[(0, row * mcus_per_row)] for row in range(self.mcus_y)]
+
+	# Entropy decode a sequential scan of every component one MCU row at a time, yielding
+	#	each row's coefficients laid out as region_blocks() lays them out, see strips()
+	def stream_mcu_rows(self, scan):
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		num_predictors = len(scan['components'])
+		restart_interval = scan['restart_interval'] or mcu_count
+		segments = scan['segments']
+		line_rows = self.scan_lines(units, mcus_per_row)
+
+		window = None
+		segment = None
+		try:
+			for lines in line_rows:
+				if self.profile is not None:
+					start_time = time.perf_counter()
+				region = [array.array('h', bytes(128 * c['blocks_w'] * c['v_factor'])) for c in self.components]
+				for line_y, mcu in lines:
+					# the line's MCUs are decoded as MCU row 0
+					line_units = [(region[c], dc, ac, predictor, stride, h, v, x, y + line_y)
+							for c, dc, ac, predictor, stride, h, v, x, y in units]
+					line_end = mcu + mcus_per_row
+					while mcu < line_end:
+						i = mcu // restart_interval
+						if i != segment:
+							if window is not None:
+								window.buf.release()
+							start, end = segments[i]
+							window = EntropyWindow(self._buf[start - self._origin:end - self._origin])
+							state = [0, 0, 0, [0] * num_predictors]
+							segment = i
+						run_end = min(line_end, (i + 1) * restart_interval)
+						# no block takes more than 64 words of entropy-coded data
+						window.fill(state, (run_end - mcu) * len(units) * 64)
+						first = mcu - line_end + mcus_per_row
+						decode_huffman_sequential(window.words, line_units, mcus_per_row, first, first + run_end - mcu, num_predictors, state)
+						mcu = run_end
+				if self.profile is not None:
+					self.profile.add_stage('entropy', time.perf_counter() - start_time)
+				yield region
+		except IndexError:
+			raise TruncatedFileError(end if window is not None else self._buf.nbytes)
+		finally:
+			if window is not None:
+				window.buf.release()
+
+	# The EXIF orientation of the image, 1 to 8 (1 being upright, see EXIF_ORIENTATIONS)
+	#	returns (orientation, file offset of its value, byte order), or (1, None, None) when
+	#	the file has none
+	def exif_orientation(self):
+		ORIENTATION = 0x0112
+		if self.exif is None:
+			return 1, None, None
+		start, length = self.exif
+		tiff = self._buf[start - self._origin:start - self._origin + length]
+		try:
+			endian = {b'II': '<', b'MM': '>'}[bytes(tiff[:2])]
+			offset = struct.unpack_from(endian + 'I', tiff, 4)[0]
+			count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+			for i in range(count):
+				entry = offset + 2 + i * 12
+				tag, type, number = struct.unpack_from(endian + 'HHI', tiff, entry)
+				if tag == ORIENTATION and type == 3 and number == 1:
+					orientation = struct.unpack_from(endian + 'H', tiff, entry + 8)[0]
+					if orientation in EXIF_ORIENTATIONS:
+						return orientation, start + entry + 8, endian
+		except (KeyError, struct.error):
+			pass
+		finally:
+			tiff.release()
+		return 1, None, None
+
+	# Losslessly rotate or flip the image, or crop it, and return the new file
+	#	operation is one of TRANSFORMS, or None to just crop
+	#	crop is the (x, y, width, height) of the part of the image to keep, x and y multiples
+	#		of the MCU size (8 * max_h_factor across, 8 * max_v_factor down)
+	# The coefficients are moved about rather than decoded to pixels and encoded again, so
+	#	there is no loss. A flip can only move whole MCUs though, so a partial MCU at the
+	#	edge it would move is cut off, as jpegtran -trim does
+	# Decoded, a flipped image is exactly the original's pixels flipped, but a transposed one
+	#	can be 1 off here and there, the IDCT's rounding not being symmetric in its two passes
+	# The new file is a single sequential scan with optimal huffman tables, with the APPn
+	#	and COM segments copied over. reset_orientation sets an EXIF orientation to 1; any
+	#	thumbnails are left as they are
+	def transform(self, operation=None, crop=None, reset_orientation=False):
+		if operation is None:
+			transpose, flip_x, flip_y = False, False, False
+		elif operation in TRANSFORMS:
+			transpose, flip_x, flip_y = TRANSFORMS[operation]
+		else:
+			raise ValueError(operation)
+
+		mcu_width = 8 * self.max_h_factor
+		mcu_height = 8 * self.max_v_factor
+		x, y, width, height = crop if crop is not None else (0, 0, self.image_width, self.image_height)
+		if x % mcu_width or y % mcu_height or x < 0 or y < 0 or width <= 0 or height <= 0 or \
+				x + width > self.image_width or y + height > self.image_height:
+			raise ValueError(crop)
+		# the image's own axes that end up flipped lose a partial MCU at the end
+		if flip_y if transpose else flip_x:
+			width -= width % mcu_width
+		if flip_x if transpose else flip_y:
+			height -= height % mcu_height
+		if not width or not height:
+			raise ValueError('image smaller than an MCU')
+		columns = (x // mcu_width, ceil_div(x + width, mcu_width))
+		rows = (y // mcu_height, ceil_div(y + height, mcu_height))
+		region = self.region_blocks(columns, rows)
+
+		order = transform_block_order(transpose, flip_x, flip_y)
+		blocks = []
+		for coefficients, c in zip(region, self.components):
+			# the region's size in blocks, and the transformed one's
+			region_w = (columns[1] - columns[0]) * c['h_factor']
+			region_h = (rows[1] - rows[0]) * c['v_factor']
+			out_w, out_h = (region_h, region_w) if transpose else (region_w, region_h)
+			if numpy is not None:
+				b = numpy.frombuffer(coefficients, dtype=numpy.int16).reshape(region_h, region_w, 64)
+				if transpose:
+					b = b.transpose(1, 0, 2)
+				if flip_x:
+					b = b[:, ::-1]
+				if flip_y:
+					b = b[::-1]
+				b = b[:, :, [z for z, sign in order]] * numpy.array([sign for z, sign in order], dtype=numpy.int16)
+				blocks.append(array.array('h', b.astype(numpy.int16).tobytes()))
+				continue
+			out = array.array('h', bytes(128 * out_w * out_h))
+			for block_y in range(out_h):
+				for block_x in range(out_w):
+					sx = out_w - 1 - block_x if flip_x else block_x
+					sy = out_h - 1 - block_y if flip_y else block_y
+					if transpose:
+						sx, sy = sy, sx
+					block = coefficients[(sy * region_w + sx) << 6:(sy * region_w + sx + 1) << 6]
+					out[(block_y * out_w + block_x) << 6:(block_y * out_w + block_x + 1) << 6] = \
+							array.array('h', [block[z] if sign > 0 else -block[z] for z, sign in order])
+			blocks.append(out)
+
+		if transpose:
+			width, height = height, width
+		return self.write_coefficients(blocks, width, height, transpose, reset_orientation)
+
+	# Rotate and flip the image upright by its EXIF orientation, see transform()
+	#	returns the new file with its orientation set to 1, or None if it is upright already
+	def auto_orient(self, crop=None):
+		operation = EXIF_ORIENTATIONS[self.exif_orientation()[0]]
+		if operation is None:
+			return None
+		return self.transform(operation, crop, reset_orientation=True)
+
+	# Write a new file of the image's components with blocks for coefficients, width x height
+	#	in size, as a single sequential scan, see transform()
+	#	transposed swaps the sampling factors and transposes the quantization tables
+	def write_coefficients(self, blocks, width, height, transposed=False, reset_orientation=False):
+		out = [b'\xff\xd8']
+		orientation, orientation_offset, endian = self.exif_orientation()
+		for marker, start, end in self.marker_segments():
+			if not (marker.startswith('APP') or marker == 'COM'):
+				continue
+			segment = self._buf[start - self._origin:end - self._origin].tobytes()
+			if reset_orientation and orientation_offset is not None and start < orientation_offset < end:
+				at = orientation_offset - start
+				segment = segment[:at] + struct.pack(endian + 'H', 1) + segment[at + 2:]
+			out.append(segment)
+
+		extended = self.sample_precision != 8
+		for index in sorted(set(c['quant_tbl_index'] for c in self.components)):
+			table = self.quantization_tables[index]
+			if transposed:
+				table = [table[((n & 7) << 3) | (n >> 3)] for n in range(64)]
+			high_precision = self.quantization_high_precision[index]
+			extended = extended or high_precision
+			entries = [table[n] for n in ZIGZAG_NATURAL]
+			data = struct.pack('>B64H' if high_precision else '>65B', (high_precision << 4) | index, *entries)
+			out.append(b'\xff\xdb' + struct.pack('>H', len(data) + 2) + data)
+
+		factors = [(c['v_factor'], c['h_factor']) if transposed else (c['h_factor'], c['v_factor']) for c in self.components]
+		sof = struct.pack('>HBHHB', 8 + 3 * len(self.components), self.sample_precision, height, width, len(self.components))
+		for c, (h, v) in zip(self.components, factors):
+			sof += struct.pack('>BBB', c['id'], (h << 4) | v, c['quant_tbl_index'])
+		out.append((b'\xff\xc1' if extended else b'\xff\xc0') + sof)
+
+		# the first component gets tables 0, and the rest share tables 1
+		max_h = max(h for h, v in factors)
+		max_v = max(v for h, v in factors)
+		if len(self.components) == 1:
+			h, v = factors[0]
+			blocks_w = ceil_div(width, 8 * max_h) * h
+			width_in_blocks = ceil_div(ceil_div(width * h, max_h), 8)
+			height_in_blocks = ceil_div(ceil_div(height * v, max_v), 8)
+			units = [(blocks[0], 0, 0, 0, blocks_w, 1, 1, 0, 0)]
+			mcus_per_row, mcu_count = width_in_blocks, width_in_blocks * height_in_blocks
+		else:
+			mcus_per_row = ceil_div(width, 8 * max_h)
+			mcu_count = mcus_per_row * ceil_div(height, 8 * max_v)
+			units = []
+			for i, (coefficients, (h, v)) in enumerate(zip(blocks, factors)):
+				table = min(i, 1)
+				for y in range(v):
+					for x in range(h):
+						units.append((coefficients, table, table, i, mcus_per_row * h, h, v, x, y))
+		segment, data = encode_optimized_scan(units, mcus_per_row, mcu_count, len(self.components))
+		out.append(segment)
+
+		sos = struct.pack('>HB', 6 + 2 * len(self.components), len(self.components))
+		for i, c in enumerate(self.components):
+			sos += struct.pack('>BB', c['id'], min(i, 1) * 0x11)
+		out.append(b'\xff\xda' + sos + b'\x00\x3f\x00')
+		out.append(data)
+		out.append(b'\xff\xd9')
+		return b''.join(out)
+
+	# The marker segments of the file in order, as (marker, start, end) file offsets from the
+	#	marker's 0xff to the end of its segment; for SOS that is the end of the scan header, the
+	#	entropy-coded data is not included
+	def marker_segments(self):
+		found = sorted((offset, marker) for marker, offsets in self.trackers.items() for offset in offsets)
+		for offset, marker in found:
+			if marker in ('SOI', 'EOI', 'TEM') or marker.startswith('RST'):
+				end = offset
+			else:
+				end = offset + struct.unpack_from('>H', self._buf, offset - self._origin)[0]
+			yield marker, offset - 2, end
+
+	# Rewrite the metadata of the file, without copying the rest of it
+	#	drop lists APPn and COM markers ('APP1', 'COM', ...) whose segments are left out
+	#	replace maps such markers to new segment contents (what follows the length field),
+	#		or a list of them: these take the place of all the file's segments with that
+	#		marker, where the first of them was; if it has none they go in after the APPn
+	#		segments at the start of the file
+	# Returns the new file as a list of memoryview slices, of the file where it is unchanged,
+	#	ready to go to os.writev() or out one at a time; release them before close()
+	# Segments past where parsing stopped (see stop_at) are copied over as they are, and so is
+	#	anything after EOI, such as the further images of an MPF file or a motion photo's video
+	def rewrite(self, drop=(), replace=None):
+		replace = dict(replace or {})
+		for marker in list(drop) + list(replace):
+			if not (marker == 'COM' or re.match(r'APP\d+$', marker)) or marker not in self.markers.values():
+				raise ValueError(marker)
+		codes = dict((name, code) for code, name in self.markers.items())
+		segments = {}
+		for marker, payloads in replace.items():
+			if isinstance(payloads, (bytes, bytearray, memoryview)):
+				payloads = [payloads]
+			segments[marker] = []
+			for payload in payloads:
+				if len(payload) > 0xffff - 2:
+					raise ValueError('%s segment too long' % marker)
+				segments[marker].append(memoryview(bytes([0xff, codes[marker]]) + struct.pack('>H', len(payload) + 2) + bytes(payload)))
+
+		missing = []
+		for marker in replace:
+			if marker not in self.trackers:
+				missing.extend(segments.pop(marker))
+
+		views = []
+		kept = last = self._origin
+		for marker, start, segment_end in self.marker_segments():
+			if missing and marker != 'SOI' and not marker.startswith('APP'):
+				views.append(self._buf[kept - self._origin:start - self._origin])
+				views.extend(missing)
+				missing = []
+				kept = start
+			if marker in replace or marker in drop:
+				views.append(self._buf[kept - self._origin:start - self._origin])
+				views.extend(segments.pop(marker, ()))
+				kept = segment_end
+			last = segment_end
+		if missing:
+			views.append(self._buf[kept - self._origin:last - self._origin])
+			views.extend(missing)
+			kept = last
+		views.append(self._buf[kept - self._origin:])
+		return [view for view in views if len(view)]
+
+	# Losslessly recompress the image with huffman tables made for it
+	#	each scan is given the optimal tables for its own symbol statistics, in a DHT segment
+	#	right before it, and its coefficients are coded again with them; the other segments
+	#	are copied as they are, and the old DHT segments dropped
+	# Yields the new file a piece at a time, b''.join() them for all of it
+	# Each scan is entropy decoded twice, once to count its symbols and once to code them;
+	#	an image coded in a single scan goes through coefficient_rows() a row at a time, so
+	#	neither pass holds all of its coefficients
+	# Only sequential huffman coded images can be recompressed
+	def optimize_huffman(self):
+		for t in ('progressive', 'arithmetic_code', 'lossless', 'differential'):
+			if self.encoding_type.get(t):
+				raise MarkerNotHandledError('SOS', t)
+
+		scans = iter(self.scans)
+		for marker, start, end in self.marker_segments():
+			if marker == 'DHT':
+				continue
+			header = self._buf[start - self._origin:end - self._origin].tobytes()
+			if marker == 'SOS':
+				for piece in self.optimized_scan(next(scans), header):
+					yield piece
+			else:
+				yield header
+
+	# The runs of a scan's MCUs, MCU row by MCU row, for working through its coefficients
+	#	yields (units, first MCU, last MCU, restart) to pass to the coders, with the units'
+	#	coefficients pointing at the row's blocks from coefficient_rows(); restart is true
+	#	for the first run of every restart interval after the first
+	def scan_runs(self, scan, units):
+		units, mcus_per_row, mcu_count = units
+		restart_interval = scan['restart_interval'] or mcu_count
+		for lines, region in zip(self.scan_lines(units, mcus_per_row), self.coefficient_rows()):
+			for line_y, mcu in lines:
+				# the line's MCUs are coded as MCU row 0
+				line_units = [(region[c], dc, ac, predictor, stride, h, v, x, y + line_y)
+						for c, dc, ac, predictor, stride, h, v, x, y in units]
+				line_end = mcu + mcus_per_row
+				while mcu < line_end:
+					run_end = min(line_end, (mcu // restart_interval + 1) * restart_interval)
+					first = mcu - line_end + mcus_per_row
+					yield line_units, first, first + run_end - mcu, mcu > 0 and mcu % restart_interval == 0
+					mcu = run_end
+
+	# The DHT segment and the recoded entropy-coded data of scan, see optimize_huffman()
+	def optimized_scan(self, scan, header):
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		num_predictors = len(scan['components'])
+		tables = dict((c['component'], (c['dc_tbl'], c['ac_tbl'])) for c in scan['components'])
+
+		frequencies = {}
+		for dc_tbl, ac_tbl in tables.values():
+			frequencies.setdefault((0, dc_tbl), [0] * 256)
+			frequencies.setdefault((1, ac_tbl), [0] * 256)
+		counting = [(u[0], frequencies[0, tables[u[0]][0]], frequencies[1, tables[u[0]][1]]) + u[3:] for u in units]
+		predictions = [0] * num_predictors
+		for run_units, first, last, restart in self.scan_runs(scan, (counting, mcus_per_row, mcu_count)):
+			if restart:
+				predictions = [0] * num_predictors
+			count_huffman_sequential(run_units, mcus_per_row, first, last, predictions)
+
+		segment, codes = optimal_dht_segment(frequencies)
+		yield segment + header
+
+		coding = [(u[0], codes[0, tables[u[0]][0]], codes[1, tables[u[0]][1]]) + u[3:] for u in units]
+		state = [0, 0, [0] * num_predictors]
+		out = bytearray()
+		restarts = 0
+		for run_units, first, last, restart in self.scan_runs(scan, (coding, mcus_per_row, mcu_count)):
+			if restart:
+				flush_huffman_bits(state, out)
+				yield bytes(out).replace(b'\xff', b'\xff\x00') + bytes([0xff, 0xd0 + restarts % 8])
+				del out[:]
+				restarts += 1
+				state = [0, 0, [0] * num_predictors]
+			encode_huffman_sequential(run_units, mcus_per_row, first, last, state, out)
+			if len(out) >= 65536:
+				yield bytes(out).replace(b'\xff', b'\xff\x00')
+				del out[:]
+
+		flush_huffman_bits(state, out)
+		yield bytes(out).replace(b'\xff', b'\xff\x00')
+
+	# Check that the image can be decoded to mode, returns its number of channels
+	def check_mode(self, mode):
+		channels = MODE_CHANNELS.get(mode)
+		if channels is None:
+			raise ValueError(mode)
+		if mode == 'CMYK' and self.color_space() not in ('CMYK', 'YCCK'):
+			raise ValueError(mode)
+		return channels
+
+	# Upsample, color convert and interleave the planes into out, see decode()
+	#	window is (x, y, width, height, MCU columns) when the planes cover only some MCU
+	#		columns of the image: the rectangle to render, relative to the planes' first MCU
+	def render(self, planes, mode, out=None, backend=None, scale=1, window=None):
+		backend = check_backend(backend)
+		channels = self.check_mode(mode)
+		color_space = self.color_space()
+		if window is None:
+			window = (0, 0) + self.output_size(scale) + (self.mcus_x,)
+
+		width, height = window[2:4]
+		sample_size = 1 if self.sample_precision <= 8 else 2
+		if out is None:
+			if backend == 'numpy':
+				out = numpy.empty((height, width, channels), dtype=numpy.uint8 if sample_size == 1 else numpy.uint16)
+			else:
+				out = bytearray(width * height * channels * sample_size)
+
+		view = as_byte_view(out)
+		if len(view) != width * height * channels * sample_size:
+			raise ValueError('output buffer size')
+
+		if backend == 'numpy':
+			dtype = numpy.uint8 if sample_size == 1 else numpy.uint16
+			pixels = numpy.frombuffer(view, dtype=dtype).reshape(height, width, channels)
+			self.render_numpy(planes, pixels, mode, color_space, scale, window)
+		else:
+			if sample_size == 2:
+				view = view.cast('H')
+			self.render_python(planes, view, mode, color_space, scale, window)
+		return out
+
+	# The (width, height) of the image decoded at scale, rounded up as libjpeg does
+	def output_size(self, scale=1):
+		size = scale_size(scale)
+		return ceil_div(self.image_width * size, 8), ceil_div(self.image_height * size, 8)
+
+	# Upsample, color convert and interleave the planes into view, one row at a time
+	#	scale is the one the planes were decoded at, see decode_planes(), window as for render()
+	def render_python(self, planes, view, mode, color_space, scale, window):
+		left, top, width, height, mcu_columns = window
+		precision = self.sample_precision
+		maxval = (1 << precision) - 1
+		channels = MODE_CHANNELS[mode]
+		line = width * channels
+		if precision > 8:
+			make_row = lambda values: array.array('H', values)
+		else:
+			make_row = bytes
+
+		ratios = []
+		for c, (size, h_ratio, v_ratio) in zip(self.components, self.scaling(scale)):
+			ratios.append((h_ratio, v_ratio, mcu_columns * c['h_factor'] * size))
+		# the last upsampled row of each component, which vertical replication reuses
+		cached = [(None, None)] * len(planes)
+		profile = self.profile
+		upsample_time = color_time = 0.0
+
+		for y in range(top, top + height):
+			if profile is not None:
+				start_time = time.perf_counter()
+			rows = []
+			for i, (plane, (h_ratio, (v, max_v), stride)) in enumerate(zip(planes, ratios)):
+				source_y = (y * v) // max_v
+				cached_y, row = cached[i]
+				if cached_y != source_y:
+					start = source_y * stride
+					row = upsample_row(plane[start:start + stride], h_ratio, left + width)[left:]
+					cached[i] = (source_y, row)
+				rows.append(row)
+			if profile is not None:
+				split_time = time.perf_counter()
+				upsample_time += split_time - start_time
+
+			if mode == 'CMYK':
+				if color_space == 'YCCK':
+					rows = list(rows_to_rgb_python('YCbCr', rows[:3], precision)) + [rows[3]]
+				if color_space == 'YCCK' or self.is_adobe:
+					rows = [[maxval - v for v in row] for row in rows]
+				pixel_rows = rows
+			else:
+				rgb = rows_to_rgb_python(color_space, rows, precision, self.is_adobe)
+				if mode == 'L':
+					if color_space in ('L', 'YCbCr'):
+						pixel_rows = rows[:1]
+					else:
+						pixel_rows = [rgb_to_gray_python(*rgb)]
+				else:
+					pixel_rows = list(rgb) * 3 if len(rgb) == 1 else list(rgb)
+					if mode == 'RGBA':
+						pixel_rows.append([maxval] * width)
+
+			start = (y - top) * line
+			for c, row in enumerate(pixel_rows):
+				if isinstance(row, list):
+					row = make_row(row)
+				view[start + c:start + line:channels] = row
+			if profile is not None:
+				color_time += time.perf_counter() - split_time
+
+		if profile is not None:
+			profile.add_stage('upsample', upsample_time)
+			profile.add_stage('color', color_time)
+
+	# The numpy version works over bands of whole MCU rows, which bounds the temporaries
+	def render_numpy(self, planes, pixels, mode, color_space, scale, window):
+		left, top, width, height, mcu_columns = window
+		precision = self.sample_precision
+		maxval = (1 << precision) - 1
+
+		columns = []
+		v_ratios = []
+		for size, (h, max_h), v_ratio in self.scaling(scale):
+			columns.append((numpy.arange(left, left + width) * h) // max_h)
+			v_ratios.append(v_ratio)
+		band = 8 * self.max_v_factor * max(1, IDCT_BATCH_BLOCKS * 64 // (width * 8 * self.max_v_factor))
+		profile = self.profile
+		upsample_time = color_time = 0.0
+
+		for y0 in range(0, height, band):
+			if profile is not None:
+				start_time = time.perf_counter()
+			y1 = min(y0 + band, height)
+			sub = []
+			for plane, (v, max_v), x_index in zip(planes, v_ratios, columns):
+				y_index = (numpy.arange(top + y0, top + y1) * v) // max_v
+				sub.append(plane[y_index[:, None], x_index])
+			if profile is not None:
+				split_time = time.perf_counter()
+				upsample_time += split_time - start_time
+
+			if mode == 'CMYK':
+				if color_space == 'YCCK':
+					sub = list(planes_to_rgb_numpy('YCbCr', sub[:3], precision)) + [sub[3]]
+				if color_space == 'YCCK' or self.is_adobe:
+					sub = [maxval - p.astype(numpy.int32) for p in sub]
+				pixel_planes = sub
+			else:
+				rgb = planes_to_rgb_numpy(color_space, sub, precision, self.is_adobe)
+				if mode == 'L':
+					if color_space in ('L', 'YCbCr'):
+						pixel_planes = sub[:1]
+					else:
+						pixel_planes = [rgb_to_gray_numpy(*rgb)]
+				else:
+					pixel_planes = list(rgb) * 3 if len(rgb) == 1 else list(rgb)
+					if mode == 'RGBA':
+						pixel_planes.append(maxval)
+
+			for c, p in enumerate(pixel_planes):
+				pixels[y0:y1, :, c] = p
+			if profile is not None:
+				color_time += time.perf_counter() - split_time
+
+		if profile is not None:
+			profile.add_stage('upsample', upsample_time)
+			profile.add_stage('color', color_time)
+
+	# Entropy decode scan into blocks, self.blocks if None
+	#	keep, if given, is how many coefficients of each component's blocks a sequential
+	#	huffman scan stores, see partial_blocks()
+	def decode_scan(self, scan, blocks=None, keep=None):
+		for t in ('lossless', 'differential'):
+			if self.encoding_type.get(t):
+				raise MarkerNotHandledError('SOS', t)
+		arithmetic = self.encoding_type.get('arithmetic_code')
+
+		if self.encoding_type.get('progressive'):
+			decoder = self.progressive_decoder(scan)
+			args = (scan['spectral_start'], scan['spectral_end'], scan['approx_low'])
+		elif arithmetic:
+			decoder = decode_arithmetic_sequential
+			args = ()
+		else:
+			decoder = decode_huffman_sequential
+			args = ()
+
+		if blocks is None:
+			blocks = self.blocks
+		units, mcus_per_row, mcu_count = self.scan_units(scan)
+		if keep is not None and decoder is decode_huffman_sequential:
+			args = (None, [keep[u[0]] for u in units])
+		units = [(blocks[u[0]],) + u[1:] for u in units]
+		restart_interval = scan['restart_interval'] or mcu_count
+		if self.profile is not None:
+			start_time = time.perf_counter()
+
+		# each restart interval starts afresh: a new bit reader and DC predictions back to 0,
+		#	and for arithmetic coding new statistics
+		for i, (start, end) in enumerate(scan['segments']):
+			mcu_start = i * restart_interval
+			if mcu_start >= mcu_count:
+				break
+			data = self._buf[start - self._origin:end - self._origin]
+			if arithmetic:
+				data = bytes(data).replace(b'\xff\x00', b'\xff')
+			else:
+				data = unstuff(data)
+			try:
+				decoder(data, units, mcus_per_row, mcu_start,
+						min(mcu_start + restart_interval, mcu_count), len(scan['components']), *args)
+			except IndexError:
+				raise TruncatedFileError(end)
+			# arithmetic decoding runs on into zeros at the end of the data, so corrupt or
+			#	truncated data shows up as coefficients out of range instead
+			except OverflowError:
+				raise BadFieldError('SOS')
+		if self.profile is not None:
+			self.profile.add_stage('entropy', time.perf_counter() - start_time)
+
+	# Check a progressive scan's band and bit position are allowed (spec G.1.1.1.1), and
+	#	pick its decoder
+	def progressive_decoder(self, scan):
+		spectral_start = scan['spectral_start']
+		spectral_end = scan['spectral_end']
+		approx_high = scan['approx_high']
+		approx_low = scan['approx_low']
+
+		if approx_low > 13 or (approx_high and approx_low != approx_high - 1):
+			raise BadFieldError('SOS')
+		if spectral_start == 0:
+			if spectral_end != 0:
+				raise BadFieldError('SOS')
+			if self.encoding_type.get('arithmetic_code'):
+				return decode_arithmetic_dc_refine if approx_high else decode_arithmetic_sequential
+			return decode_huffman_dc_refine if approx_high else decode_huffman_dc_first
+		# AC bands are never interleaved
+		if spectral_end < spectral_start or spectral_end > 63 or len(scan['components']) != 1:
+			raise BadFieldError('SOS')
+		if self.encoding_type.get('arithmetic_code'):
+			return decode_arithmetic_ac_refine if approx_high else decode_arithmetic_sequential
+		return decode_huffman_ac_refine if approx_high else decode_huffman_ac_first
+
+	# Lay out the blocks of one MCU of the scan for the decoders, see decode_huffman_sequential()
+	#	the first item of each unit is the index of the component rather than its coefficients
+	#	and arithmetic coded scans have their conditioning in place of the JpegHuffman tables
+	#	returns (units, mcus per row, total mcus)
+	def scan_units(self, scan):
+		units = []
+		scan_components = scan['components']
+		if self.encoding_type.get('arithmetic_code'):
+			dc, ac = 'dc_conditioning', 'ac_conditioning'
+		else:
+			dc, ac = 'dc_huffman', 'ac_huffman'
+
+		# A non-interleaved scan codes each block as its own MCU and skips the padding blocks
+		if len(scan_components) == 1:
+			c = scan_components[0]
+			component = self.components[c['component']]
+			units.append((c['component'], c[dc], c[ac], 0, component['blocks_w'], 1, 1, 0, 0))
+			return units, component['width_in_blocks'], component['width_in_blocks'] * component['height_in_blocks']
+
+		for predictor, c in enumerate(scan_components):
+			component = self.components[c['component']]
+			for y in range(component['v_factor']):
+				for x in range(component['h_factor']):
+					units.append((c['component'], c[dc], c[ac], predictor,
+							component['blocks_w'], component['h_factor'], component['v_factor'], x, y))
+		return units, self.mcus_x, self.mcus_x * self.mcus_y
+
+	# How many MCUs a scan codes, as scan_units() counts them; in a lossless scan an MCU is one
+	#	sample of each component, or h_factor by v_factor samples when interleaved
+	def scan_mcu_count(self, scan):
+		scan_components = scan['components']
+		if self.encoding_type.get('lossless'):
+			if len(scan_components) == 1:
+				component = self.components[scan_components[0]['component']]
+				return (ceil_div(self.image_width * component['h_factor'], self.max_h_factor) *
+						ceil_div(self.image_height * component['v_factor'], self.max_v_factor))
+			return ceil_div(self.image_width, self.max_h_factor) * ceil_div(self.image_height, self.max_v_factor)
+		if len(scan_components) == 1:
+			component = self.components[scan_components[0]['component']]
+			return component['width_in_blocks'] * component['height_in_blocks']
+		return self.mcus_x * self.mcus_y
+
 	# EOI indicates that we have reached the end of the image, so we're done
 	def handle_eoi(self):
 		pass
 
 	marker_handlers['EOI'] = handle_eoi
 
+	# DRI - Define Restart Interval
+	# Applies to every scan after it, until redefined
+	def handle_dri(self):
+		length, restart_interval = struct.unpack_from('>HH', self._buf, self._index)
+		if length != 4:
+			raise BadFieldError('DRI')
+		self.restart_interval = restart_interval
+		self._index += length
+
+	marker_handlers['DRI'] = handle_dri
+
+# zigzag order to natural order, and back, for whole 8x8 blocks: Jpeg.zigzag_natural[8] and
+#	its inverse, by the names the functions above use them by
+ZIGZAG_NATURAL = Jpeg.zigzag_natural[8]
+NATURAL_ZIGZAG = [ZIGZAG_NATURAL.index(i) for i in range(64)]
+
+# Random access index of a JPEG file, see Jpeg.build_index()
+#	markers is a list of (marker code, file offset) for every marker, as Jpeg.trackers has them
+#	scans holds one dict per scan, with the 'offset', 'length', 'restart_interval' and
+#		'segments' that handle_sos() finds, and 'checkpoints'
+#	checkpoints are (mcus, positions, bits, predictions) arrays: at checkpoint i, decoding
+#		of MCU mcus[i] starts bits[i] bits into the byte at file offset positions[i], with
+#		the DC predictions in predictions[i * num_predictors:(i + 1) * num_predictors]
+#	file_size, header_size and header_crc (of the bytes up to the first scan's data) tell
+#		whether the index still matches a file
+# Saved as a little-endian sidecar of packed arrays, see dumps()
+class JpegIndex(object):
+	MAGIC = b'PYJI'
+	VERSION = 1
+
+	def __init__(self, file_size, header_size, header_crc, markers, scans, checkpoint_interval=0):
+		self.file_size = file_size
+		self.header_size = header_size
+		self.header_crc = header_crc
+		self.markers = markers
+		self.scans = scans
+		self.checkpoint_interval = checkpoint_interval
+
+	def __repr__(self):
+		return '<JpegIndex %d scans, %d checkpoints>' % (len(self.scans),
+				sum(len(s['checkpoints'][0]) for s in self.scans))
+
+	# Check the index was made for buf, raises BadIndexError if not
+	def check(self, buf):
+		if len(buf) != self.file_size or zlib.crc32(buf[:self.header_size]) != self.header_crc:
+			raise BadIndexError('index does not match the file')
+
+	def dumps(self):
+		chunks = [self.MAGIC, struct.pack('<HQQIIII', self.VERSION, self.file_size, self.header_size,
+				self.header_crc, self.checkpoint_interval, len(self.markers), len(self.scans))]
+		chunks.append(pack_array('B', [code for code, offset in self.markers]))
+		chunks.append(pack_array('Q', [offset for code, offset in self.markers]))
+		for scan in self.scans:
+			mcus, positions, bits, predictions = scan['checkpoints']
+			num_predictors = len(predictions) // len(mcus) if mcus else 0
+			chunks.append(struct.pack('<QQIIII', scan['offset'], scan['length'], scan['restart_interval'],
+					len(scan['segments']), len(mcus), num_predictors))
+			chunks.append(pack_array('Q', [offset for segment in scan['segments'] for offset in segment]))
+			chunks.append(pack_array('I', mcus))
+			chunks.append(pack_array('Q', positions))
+			chunks.append(pack_array('B', bits))
+			chunks.append(pack_array('i', predictions))
+		return b''.join(chunks)
+
+	@classmethod
+	def loads(cls, data):
+		data = as_byte_view(data)
+		if bytes(data[:4]) != cls.MAGIC:
+			raise BadIndexError('not an index')
+		index = 4
+		try:
+			fields = struct.unpack_from('<HQQIIII', data, index)
+			index += struct.calcsize('<HQQIIII')
+			version, file_size, header_size, header_crc, checkpoint_interval, num_markers, num_scans = fields
+			if version != cls.VERSION:
+				raise BadIndexError('index version %d' % version)
+
+			codes, index = unpack_array('B', data, index, num_markers)
+			offsets, index = unpack_array('Q', data, index, num_markers)
+			scans = []
+			for i in range(num_scans):
+				offset, length, restart_interval, num_segments, num_checkpoints, num_predictors = \
+						struct.unpack_from('<QQIIII', data, index)
+				index += struct.calcsize('<QQIIII')
+				segments, index = unpack_array('Q', data, index, 2 * num_segments)
+				mcus, index = unpack_array('I', data, index, num_checkpoints)
+				positions, index = unpack_array('Q', data, index, num_checkpoints)
+				bits, index = unpack_array('B', data, index, num_checkpoints)
+				predictions, index = unpack_array('i', data, index, num_checkpoints * num_predictors)
+				scans.append({
+						'offset': offset,
+						'length': length,
+						'restart_interval': restart_interval,
+						'segments': list(zip(segments[::2], segments[1::2])),
+						'checkpoints': (mcus, positions, bits, predictions),
+				})
+		except struct.error:
+			raise BadIndexError('index is truncated')
+		return cls(file_size, header_size, header_crc, list(zip(codes, offsets)), scans, checkpoint_interval)
+
+	def save(self, path):
+		with open(path, 'wb') as f:
+			f.write(self.dumps())
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			return cls.loads(f.read())
+
+# Sidecar arrays are stored little-endian whatever the machine
+def pack_array(typecode, values):
+	values = array.array(typecode, values)
+	if sys.byteorder == 'big':
+		values.byteswap()
+	return values.tobytes()
+
+# returns (array, index just past it)
+def unpack_array(typecode, data, index, count):
+	values = array.array(typecode)
+	end = index + count * values.itemsize
+	if end > len(data):
+		raise struct.error('truncated')
+	values.frombytes(data[index:end])
+	if sys.byteorder == 'big':
+		values.byteswap()
+	return values, end
+
+
+# Push parser for images that arrive in pieces (sockets, uploads)
+# Call feed() with each chunk as it arrives; it returns the events that chunk completed:
+#	('header', marker)	- a header segment was parsed
+#	('frame', JpegInfo)	- the SOF header was parsed, the image size and layout are known
+#	('scan', scan)		- the SOS header was parsed and entropy-coded data follows; the
+#				  tables it names are all defined (BadFieldError if not)
+#	('end', None)		- EOI was reached
+# Only the segment currently being parsed is buffered; entropy-coded data is
+#	skipped over as it arrives and just counted in scan_bytes
+# done is set once EOI is reached, and end_offset then says where the image ended: how many
+#	bytes of everything fed in belong to it, anything after that being ignored
+class JpegStreamParser(object):
+	# states of the parser
+	MARKER = 0
+	SEGMENT = 1
+	ENTROPY = 2
+	DONE = 3
+
+	# profile, a JpegProfile, times the handlers of the segments fed through
+	def __init__(self, profile=None):
+		self.jpeg = Jpeg.__new__(Jpeg)
+		self.jpeg.init_headers()
+		if profile is not None:
+			self.jpeg.profile = profile
+
+		self._pending = bytearray()
+		# absolute file offset of self._pending[0]
+		self._offset = 0
+		self._state = self.MARKER
+		self._marker = None
+		self.scan_bytes = 0
+		self.done = False
+		self.end_offset = None
+
+	def feed(self, chunk):
+		if self._state == self.DONE:
+			return []
+		self._pending += chunk
+		events = []
+		while self._step(events):
+			pass
+		return events
+
+	# Tell the parser the input is over
+	def close(self):
+		if self._state != self.DONE:
+			raise TruncatedFileError(self._offset + len(self._pending))
+
+	def _consume(self, n):
+		del self._pending[:n]
+		self._offset += n
+
+	# Do as much work as the pending bytes allow, return False when we need more
+	def _step(self, events):
+		pending = self._pending
+
+		if self._state == self.MARKER:
+			# skip fill bytes, but keep the last 0xff we have until we see what follows
+			index = 0
+			while index + 1 < len(pending) and pending[index] == 0xff and pending[index + 1] == 0xff:
+				index += 1
+			if index + 1 >= len(pending):
+				if index:
+					self._consume(index)
+				return False
+			if pending[index] != 0xff:
+				raise MarkerNotRecognizedError()
+			marker = Jpeg.markers.get(pending[index + 1])
+			if marker is None:
+				raise MarkerNotRecognizedError(pending[index + 1])
+			if self.jpeg.trackers == {} and marker != 'SOI':
+				raise NotJpegFileError
+			self._consume(index + 2)
+
+			if marker in ('SOI', 'EOI'):
+				self._handle(marker, b'')
+				if marker == 'EOI':
+					self._state = self.DONE
+					self.done = True
+					self.end_offset = self._offset
+					events.append(('end', None))
+				return True
+
+			self._marker = marker
+			self._state = self.SEGMENT
+			return True
+
+		if self._state == self.SEGMENT:
+			if len(pending) < 2:
+				return False
+			length = (pending[0] << 8) | pending[1]
+			if len(pending) < length:
+				return False
+			segment = bytes(pending[:length])
+			marker = self._marker
+
+			if marker == 'SOS':
+				scan = self._handle(marker, segment)
+				if not self.jpeg.scan_tables_ready(scan):
+					raise BadFieldError('SOS')
+				events.append(('scan', scan))
+				self._consume(length)
+				self._state = self.ENTROPY
+				return True
+
+			self._handle(marker, segment)
+			self._consume(length)
+			if marker.startswith('SOF'):
+				info = self.jpeg.info()
+				info.header_size = self._offset
+				events.append(('frame', info))
+			else:
+				events.append(('header', marker))
+			self._state = self.MARKER
+			return True
+
+		if self._state == self.ENTROPY:
+			m = Jpeg.entropy_end.search(pending)
+			if m is not None:
+				end = m.start()
+				self._state = self.MARKER
+			else:
+				# a trailing 0xff might be the start of a marker
+				end = len(pending)
+				if end and pending[end - 1] == 0xff:
+					end -= 1
+			self.scan_bytes += end
+			self._consume(end)
+			return m is not None
+
+		return False
+
+	# Run the regular Jpeg handler over one complete segment
+	def _handle(self, marker, segment):
+		jpeg = self.jpeg
+		jpeg._buf = memoryview(segment)
+		jpeg._index = 0
+		jpeg._origin = self._offset
+		try:
+			if marker == 'SOS':
+				jpeg.track_marker(marker)
+				return jpeg.parse_sos_header()
+			jpeg.handle_marker(marker)
+		except struct.error:
+			raise BadFieldError(marker)
+		if jpeg._index != len(segment):
+			raise BadFieldError(marker)
+
+# Read stream through a JpegStreamParser until it reports one of the events in until
+#	returns what was read, which may run a little past the event; the parser has seen it all
+async def read_stream_until(stream, parser, until, chunk_size):
+	data = bytearray()
+	while True:
+		chunk = await stream.read(chunk_size)
+		if not chunk:
+			parser.close()
+			raise TruncatedFileError(len(data))
+		data += chunk
+		for event, value in parser.feed(chunk):
+			if event in until:
+				return data, value
+
+# Read the headers from an asyncio.StreamReader up to the frame header, and return a
+#	JpegInfo for them, as Jpeg.probe() does
+# Parsing runs on the event loop a chunk at a time, never blocking it; the stream is left
+#	wherever the last chunk read ended
+async def aprobe(stream, chunk_size=Jpeg.PROBE_HEAD_SIZE):
+	return (await read_stream_until(stream, JpegStreamParser(), ('frame',), chunk_size))[1]
+
+# adecode()'s executor task
+def decode_buffer(data, mode, scale, backend):
+	with Jpeg(data) as image:
+		return image.decode(mode, backend=backend, scale=scale)
+
+# Decodes images read from asyncio streams without stalling the event loop
+#	headers are parsed on the loop as they arrive, so a stream that is not a JPEG is turned
+#		away before its body is read
+#	the decode itself runs on executor, the loop's default one if None; CPU bound as it is,
+#		a concurrent.futures.ProcessPoolExecutor is what gets decodes running side by side
+#	at most concurrency images are decoded at once, by default one per CPU; the rest wait
+#		with just their headers read, so a busy decoder stops reading from its streams and
+#		lets flow control push back on the senders
+#		An executor does not say how many workers it has, so concurrency has to be given
+#		with one, ValueError if not
+class AsyncDecoder(object):
+	def __init__(self, executor=None, concurrency=None, chunk_size=65536):
+		if concurrency is None:
+			if executor is not None:
+				raise ValueError('concurrency is needed with an executor')
+			concurrency = os.cpu_count() or 1
+		if concurrency < 1:
+			raise ValueError(concurrency)
+		self.executor = executor
+		self.concurrency = concurrency
+		self.chunk_size = chunk_size
+		self._loop = None
+		self._semaphore = None
+
+	# Semaphores belong to an event loop, so make one for whichever loop we run in
+	def _limit(self):
+		loop = asyncio.get_running_loop()
+		if self._loop is not loop:
+			self._loop = loop
+			self._semaphore = asyncio.Semaphore(self.concurrency)
+		return self._semaphore
+
+	async def probe(self, stream):
+		return await aprobe(stream, self.chunk_size)
+
+	# Read one image from stream, up to its EOI marker, and return decode()'s result for it
+	#	anything read past the EOI is dropped
+	async def decode(self, stream, mode='RGB', scale=1, backend=None):
+		backend = check_backend(backend)
+		if mode not in MODE_CHANNELS:
+			raise ValueError(mode)
+		scale_size(scale)
+
+		parser = JpegStreamParser()
+		data = (await read_stream_until(stream, parser, ('scan',), self.chunk_size))[0]
+		async with self._limit():
+			# a small image may have ended in the chunk holding its first scan header
+			if not parser.done:
+				data += (await read_stream_until(stream, parser, ('end',), self.chunk_size))[0]
+			del data[parser.end_offset:]
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, decode_buffer, data, mode, scale, backend)
+
+# The AsyncDecoder adecode() uses unless given another one
+async_decoder = AsyncDecoder()
+
+# Read a JPEG from an asyncio.StreamReader and decode it, see AsyncDecoder
+async def adecode(stream, mode='RGB', scale=1, backend=None, decoder=None):
+	if decoder is None:
+		decoder = async_decoder
+	return await decoder.decode(stream, mode, scale, backend)
+
+# One image decoded by decode_many(), its pixels in a shared memory block
+#	the pixels are laid out as decode() lays them out in a bytearray; error is the exception
+#		decoding path raised, in which case there are no pixels
+# The block outlives the worker that filled it: release() it, or use a with statement, once
+#	done with the pixels, or it stays allocated until the interpreter exits
+class DecodedImage(object):
+	__slots__ = (
+			'path',
+			'mode',
+			'width',
+			'height',
+			'channels',
+			'sample_size',
+			'error',
+			'_shm',
+	)
+
+	def __init__(self, path, mode, error=None):
+		self.path = path
+		self.mode = mode
+		self.width = self.height = self.channels = self.sample_size = 0
+		self.error = error
+		self._shm = None
+
+	def __repr__(self):
+		if self.error is not None:
+			return '<DecodedImage %r, %r>' % (self.path, self.error)
+		return '<DecodedImage %r, %dx%d %s>' % (self.path, self.width, self.height, self.mode)
+
+	# The pixels as a flat memoryview, of 16 bit samples for images over 8 bits
+	#	release it before calling release()
+	def pixels(self):
+		if self.error is not None:
+			raise self.error
+		view = self._shm.buf[:self.width * self.height * self.channels * self.sample_size]
+		if self.sample_size == 2:
+			view = view.cast('H')
+		return view
+
+	# A (height, width, channels) NumPy array over the pixels, without copying them
+	def array(self):
+		dtype = numpy.uint8 if self.sample_size == 1 else numpy.uint16
+		return numpy.frombuffer(self.pixels(), dtype=dtype).reshape(self.height, self.width, self.channels)
+
+	def release(self):
+		if self._shm is not None:
+			self._shm.close()
+			self._shm.unlink()
+			self._shm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.release()
+
+# A new shared memory block for a worker to hand over to the parent process, which unlinks it
+#	once done with it
+# Left registered with the worker's resource tracker, the block would also be unlinked when
+#	the worker exits, pulling it from under the parent: Python 3.13 can create it untracked,
+#	before that the only way out is to unregister it by hand, under the name it was
+#	registered by (its public name with the leading slash POSIX needs put back)
+def untracked_shared_memory(size):
+	if sys.version_info >= (3, 13):
+		return multiprocessing.shared_memory.SharedMemory(create=True, size=size, track=False)
+	shm = multiprocessing.shared_memory.SharedMemory(create=True, size=size)
+	if os.name == 'posix':
+		multiprocessing.resource_tracker.unregister('/' + shm.name, 'shared_memory')
+	return shm
+
+# decode_many()'s worker: decode path into a new shared memory block, and send back just its
+#	name and the image's layout, so the pixels never go through pickle
+def decode_to_shared_memory(path, mode, scale, backend):
+	with Jpeg.from_path(path) as image:
+		channels = image.check_mode(mode)
+		width, height = image.output_size(scale)
+		sample_size = 1 if image.sample_precision <= 8 else 2
+		size = width * height * channels * sample_size
+		shm = untracked_shared_memory(max(size, 1))
+		out = shm.buf[:size]
+		try:
+			image.decode(mode, out, backend, scale=scale)
+		except BaseException:
+			image.image = None
+			out.release()
+			shm.close()
+			shm.unlink()
+			raise
+		image.image = None
+		out.release()
+	shm.close()
+	return shm.name, width, height, channels, sample_size
+
+# Attach to the block a finished decode_to_shared_memory() left its pixels in
+def decoded_image(path, mode, future):
+	result = DecodedImage(path, mode)
+	try:
+		name, result.width, result.height, result.channels, result.sample_size = future.result()
+	except Exception as e:
+		result.error = e
+	else:
+		result._shm = multiprocessing.shared_memory.SharedMemory(name)
+	return result
+
+# Decode many files on a pool of processes, yielding a DecodedImage for each
+#	workers is a number of processes, None for one per CPU, or a concurrent.futures
+#		Executor to run them on; it has to be a process pool, threads gain nothing here
+#	in_flight bounds how many files are being decoded, or are decoded and waiting to be
+#		yielded, at once; it defaults to twice the workers. paths is only read as far ahead
+#		as that, so it can be a generator over an arbitrarily long listing
+#		An executor does not say how many workers it has, so with one in_flight has to be
+#		given, ValueError if not
+#	ordered yields the images in the order of paths; otherwise each one as soon as it is done,
+#		so one slow file does not hold up the rest
+# A file that fails to decode is yielded with error set, rather than ending the batch
+# Stopping early cancels the files not started yet, and releases the ones already decoded
+def decode_many(paths, workers=None, mode='RGB', scale=1, backend=None, ordered=True, in_flight=None):
+	backend = check_backend(backend)
+	if mode not in MODE_CHANNELS:
+		raise ValueError(mode)
+	scale_size(scale)
+
+	if isinstance(workers, concurrent.futures.Executor):
+		if in_flight is None:
+			raise ValueError('in_flight is needed with an executor')
+		executor = workers
+	else:
+		if in_flight is None:
+			in_flight = 2 * (workers or os.cpu_count() or 1)
+		executor = None
+	if in_flight < 1:
+		raise ValueError(in_flight)
+	if executor is None:
+		executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+	paths = iter(paths)
+	pending = collections.OrderedDict()
+	try:
+		while True:
+			for path in paths:
+				future = executor.submit(decode_to_shared_memory, path, mode, scale, backend)
+				pending[future] = path
+				if len(pending) >= in_flight:
+					break
+			if not pending:
+				break
+
+			if ordered:
+				future = next(iter(pending))
+			else:
+				done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+				future = next(f for f in pending if f in done)
+			path = pending.pop(future)
+			yield decoded_image(path, mode, future)
+	finally:
+		for future, path in pending.items():
+			if not future.cancel():
+				decoded_image(path, mode, future).release()
+		if executor is not workers:
+			executor.shutdown()
 
 class Foo(object):
 	def __init__(self, _buf):
 		next_b = False
 		for b in _buf:
 			if next_b:
-				print hex(ord(b))
+				print(hex(b))
 				next_b = False
-			elif b == '\xff':
+			elif b == 0xff:
 				next_b = True
 
 def main():
 	import sys
 	argv = sys.argv
 	filename = argv[1]
-	f = open(filename)
-	buf = f.read()
-	f.close()
-	Jpeg(buf)
+	with Jpeg.from_path(filename):
+		pass
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,63 @@
+import io
+import os
+import sys
+
+import pytest
+
+# the tests run against the jpeg.py next to this directory, not an installed copy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jpeg
+
+# every backend, the numpy one skipped without NumPy, to parametrize tests with
+BACKENDS = [pytest.param(backend, marks=pytest.mark.skipif(backend == 'numpy' and jpeg.numpy is None, reason='needs NumPy'))
+		for backend in jpeg.BACKENDS]
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def fixture_path(name):
+	return os.path.join(FIXTURES, name)
+
+def read_fixture(name):
+	with open(fixture_path(name), 'rb') as f:
+		return f.read()
+
+# A width x height test image with smooth gradients and some sharp detail, the same every run
+#	returns the pixels as bytes, interleaved, with MODE_CHANNELS[mode] samples a pixel
+def pattern_pixels(width, height, mode='RGB'):
+	channels = jpeg.MODE_CHANNELS[mode]
+	out = bytearray()
+	seed = 12345
+	for y in range(height):
+		for x in range(width):
+			seed = (seed * 1103515245 + 12345) & 0x7fffffff
+			noise = (seed >> 16) & 15
+			edge = 96 if (x // 7 + y // 5) % 3 == 0 else 0
+			for c in range(channels):
+				value = (x * 255 // max(width - 1, 1) * (c + 1) + y * 255 // max(height - 1, 1) * (channels - c)) // (channels + 1)
+				out.append(min(255, value // 2 + edge + noise))
+	return bytes(out)
+
+# Encode pattern_pixels() with Pillow (libjpeg), passing options on to Image.save()
+#	the tests that need a real encoder's output are skipped without Pillow
+def pillow_jpeg(width, height, mode='RGB', **options):
+	Image = pytest.importorskip('PIL.Image')
+	image = Image.frombytes(mode, (width, height), pattern_pixels(width, height, mode))
+	f = io.BytesIO()
+	options.setdefault('quality', 85)
+	image.save(f, 'JPEG', **options)
+	return f.getvalue()
+
+# Decode with Pillow, as the reference the decoder's output is checked against
+def pillow_decode(data, mode='RGB'):
+	Image = pytest.importorskip('PIL.Image')
+	return Image.open(io.BytesIO(data)).convert(mode).tobytes()
+
+# The pixels decode() returns as bytes, whatever the backend
+def as_bytes(pixels):
+	return bytes(memoryview(pixels).cast('B'))
+
+# Largest difference between two equal length runs of samples
+def max_difference(a, b):
+	assert len(a) == len(b)
+	return max(abs(u - v) for u, v in zip(a, b)) if len(a) else 0
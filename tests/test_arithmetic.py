@@ -0,0 +1,66 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, read_fixture, pillow_decode, max_difference, as_bytes
+
+# The arithmetic coded fixtures were transcoded from their huffman coded twins by libjpeg
+#	(jpeg_write_coefficients() with arith_code set, as jpegtran -arithmetic does), so both
+#	hold the same coefficients; some have restart intervals and DAC conditioning that is
+#	not the default
+TWINS = [
+		('arithmetic_gray.jpg', 'huffman_gray.jpg'),
+		('arithmetic_color.jpg', 'huffman_color.jpg'),
+		('arithmetic_color_restart.jpg', 'huffman_color.jpg'),
+		('arithmetic_progressive_gray.jpg', 'huffman_gray.jpg'),
+		('arithmetic_progressive_color.jpg', 'huffman_color.jpg'),
+]
+
+@pytest.mark.parametrize('name, twin', TWINS)
+def test_same_coefficients_as_huffman(name, twin):
+	image = jpeg.Jpeg(read_fixture(name))
+	assert image.encoding_type.get('arithmetic_code')
+	assert bool(image.encoding_type.get('progressive')) == ('progressive' in name)
+	huffman = jpeg.Jpeg(read_fixture(twin))
+	for a, b in zip(image.coefficients(), huffman.coefficients()):
+		assert a.tolist() == b.tolist()
+
+def test_conditioning():
+	image = jpeg.Jpeg(read_fixture('arithmetic_color_restart.jpg'))
+	assert image.restart_interval == 3
+	assert image.arithmetic_dc[:2] == [(2, 4), (0, 0)] and image.arithmetic_ac[:2] == [1, 20]
+	# the progressive one has every kind of scan: DC and AC, first and refinement
+	image = jpeg.Jpeg(read_fixture('arithmetic_progressive_color.jpg'))
+	assert image.restart_interval == 2
+	assert image.arithmetic_dc[:2] == [(1, 3), (0, 1)] and image.arithmetic_ac[:2] == [30, 2]
+	assert {(s['spectral_start'] > 0, s['approx_high'] > 0) for s in image.scans} == {
+			(False, False), (False, True), (True, False), (True, True)}
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('name, twin', TWINS)
+def test_matches_libjpeg(backend, name, twin):
+	data = read_fixture(name)
+	mode = 'L' if 'gray' in name else 'RGB'
+	pixels = as_bytes(jpeg.Jpeg(data).decode(mode, backend=backend))
+	assert pixels == as_bytes(jpeg.Jpeg(read_fixture(twin)).decode(mode, backend=backend))
+	assert max_difference(pixels, pillow_decode(data, mode)) <= (1 if mode == 'L' else 3)
+
+# Past the end of its data the decoder reads zeros, as libjpeg does, so a truncated scan
+#	still decodes, the same up to where the data ran out
+def test_truncated():
+	data = read_fixture('arithmetic_color.jpg')
+	scan = jpeg.Jpeg(data).scans[0]
+	truncated = data[:scan['offset'] + scan['length'] // 2] + b'\xff\xd9'
+	full = jpeg.Jpeg(data).coefficients()
+	cut = jpeg.Jpeg(truncated).coefficients()
+	assert [c.shape for c in cut] == [c.shape for c in full]
+	assert cut[0].tolist()[0][:2] == full[0].tolist()[0][:2]
+	assert cut[0].tolist() != full[0].tolist()
+
+def test_corrupt():
+	data = read_fixture('arithmetic_gray.jpg')
+	scan = jpeg.Jpeg(data).scans[0]
+	start = scan['offset']
+	end = start + scan['length']
+	corrupt = data[:start] + (b'\xff\x00' * scan['length'])[:scan['length']] + data[end:]
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(corrupt).decode()
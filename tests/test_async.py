@@ -0,0 +1,52 @@
+import asyncio
+import concurrent.futures
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg, as_bytes
+
+def reader(data):
+	stream = asyncio.StreamReader()
+	stream.feed_data(data)
+	stream.feed_eof()
+	return stream
+
+def test_aprobe():
+	async def probe():
+		return await jpeg.aprobe(reader(pillow_jpeg(40, 24)), chunk_size=64)
+	info = asyncio.run(probe())
+	assert (info.image_width, info.image_height) == (40, 24)
+
+@pytest.mark.parametrize('chunk_size', [64, 1 << 16])
+def test_adecode(chunk_size):
+	data = pillow_jpeg(40, 24, progressive=True)
+	async def decode():
+		return await jpeg.AsyncDecoder(chunk_size=chunk_size).decode(reader(data + b'trailing junk'), 'L')
+	assert as_bytes(asyncio.run(decode())) == as_bytes(jpeg.Jpeg(data).decode('L'))
+
+def test_several_streams():
+	images = [pillow_jpeg(16 + i, 8 * i + 8) for i in range(4)]
+	async def decode_all():
+		decoder = jpeg.AsyncDecoder(concurrency=2, chunk_size=100)
+		return await asyncio.gather(*(decoder.decode(reader(data)) for data in images))
+	for pixels, data in zip(asyncio.run(decode_all()), images):
+		assert as_bytes(pixels) == as_bytes(jpeg.Jpeg(data).decode())
+
+def test_truncated_stream():
+	async def decode():
+		return await jpeg.adecode(reader(pillow_jpeg(40, 24)[:-10]))
+	with pytest.raises(jpeg.TruncatedFileError):
+		asyncio.run(decode())
+
+def test_executor_needs_concurrency():
+	with concurrent.futures.ThreadPoolExecutor(2) as executor:
+		with pytest.raises(ValueError):
+			jpeg.AsyncDecoder(executor)
+		decoder = jpeg.AsyncDecoder(executor, concurrency=2)
+		data = pillow_jpeg(24, 16)
+		async def decode():
+			return await decoder.decode(reader(data))
+		assert as_bytes(asyncio.run(decode())) == as_bytes(jpeg.Jpeg(data).decode())
+	with pytest.raises(ValueError):
+		jpeg.AsyncDecoder(concurrency=0)
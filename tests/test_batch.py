@@ -0,0 +1,84 @@
+import concurrent.futures
+import os
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+@pytest.fixture
+def image_files(tmp_path):
+	paths = []
+	for i, (width, height) in enumerate([(40, 24), (17, 33), (64, 8), (8, 8), (33, 21)]):
+		path = tmp_path / ('%d.jpg' % i)
+		path.write_bytes(pillow_jpeg(width, height, subsampling=i % 3))
+		paths.append(str(path))
+	return paths
+
+def expected_pixels(path, mode='RGB', scale=1):
+	with open(path, 'rb') as f:
+		return bytes(jpeg.Jpeg(f.read()).decode(mode, scale=scale))
+
+def test_ordered(image_files):
+	names = []
+	for image in jpeg.decode_many(image_files, workers=2):
+		with image:
+			names.append(image.path)
+			assert bytes(image.pixels()) == expected_pixels(image.path)
+			assert len(image.pixels()) == image.width * image.height * 3
+	assert names == image_files
+
+def test_unordered_and_scaled(image_files):
+	seen = {}
+	for image in jpeg.decode_many(image_files, workers=2, mode='L', scale=1 / 2, ordered=False, in_flight=3):
+		with image:
+			seen[image.path] = bytes(image.pixels())
+	assert seen == dict((path, expected_pixels(path, 'L', 1 / 2)) for path in image_files)
+
+# The pixels stay readable after the pool's workers have exited, and are gone once released
+def test_blocks_outlive_workers(image_files):
+	images = list(jpeg.decode_many(image_files[:2], workers=1))
+	for image, path in zip(images, image_files):
+		assert bytes(image.pixels()) == expected_pixels(path)
+	name = images[0]._shm.name
+	for image in images:
+		image.release()
+	if os.path.isdir('/dev/shm'):
+		assert not os.path.exists(os.path.join('/dev/shm', name))
+
+def test_errors_are_yielded(image_files, tmp_path):
+	bad = tmp_path / 'bad.jpg'
+	bad.write_bytes(pillow_jpeg(40, 24)[:200])
+	images = list(jpeg.decode_many([image_files[0], str(bad), image_files[1]], workers=2))
+	assert [image.error is None for image in images] == [True, False, True]
+	assert isinstance(images[1].error, jpeg.TruncatedFileError)
+	with pytest.raises(jpeg.TruncatedFileError):
+		images[1].pixels()
+	for image in images:
+		image.release()
+
+@pytest.mark.skipif(jpeg.numpy is None, reason='needs NumPy')
+def test_array(image_files):
+	for image in jpeg.decode_many(image_files[:1], workers=1):
+		with image:
+			pixels = image.array()
+			assert pixels.shape == (24, 40, 3)
+			assert pixels.tobytes() == expected_pixels(image.path)
+			del pixels
+
+def test_executor_needs_in_flight(image_files):
+	with concurrent.futures.ProcessPoolExecutor(1) as executor:
+		with pytest.raises(ValueError):
+			next(jpeg.decode_many(image_files, workers=executor))
+		images = list(jpeg.decode_many(image_files, workers=executor, in_flight=2))
+		assert [image.path for image in images] == image_files
+		for image in images:
+			image.release()
+		# the caller's executor is left running
+		assert executor.submit(abs, -1).result() == 1
+
+def test_bad_arguments(image_files):
+	with pytest.raises(ValueError):
+		next(jpeg.decode_many(image_files, workers=1, in_flight=0))
+	with pytest.raises(ValueError):
+		next(jpeg.decode_many(image_files, workers=1, mode='XYZ'))
@@ -0,0 +1,70 @@
+import mmap
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+@pytest.fixture
+def image_file(tmp_path):
+	path = tmp_path / 'image.jpg'
+	path.write_bytes(pillow_jpeg(48, 32))
+	return path
+
+# Record every mapping from_path() makes, to check they get closed
+@pytest.fixture
+def mappings(monkeypatch):
+	made = []
+	class RecordingMap(mmap.mmap):
+		def __init__(self, *args, **kwargs):
+			made.append(self)
+	monkeypatch.setattr(jpeg.mmap, 'mmap', RecordingMap)
+	return made
+
+def test_buffer_is_not_copied():
+	data = bytearray(pillow_jpeg(48, 32))
+	image = jpeg.Jpeg.from_buffer(data)
+	assert image._buf.obj is data
+	assert (image.image_width, image.image_height) == (48, 32)
+	image.close()
+	# with our view released, the bytearray can be resized again
+	data.append(0)
+
+def test_memoryview_source():
+	data = pillow_jpeg(48, 32)
+	view = memoryview(data)[:]
+	with jpeg.Jpeg.from_buffer(view) as image:
+		assert image._buf.obj is data
+		assert len(image.scans) == 1
+
+def test_from_path_maps_the_file(image_file, mappings):
+	with jpeg.Jpeg.from_path(image_file) as image:
+		assert image.image_width == 48
+		assert len(mappings) == 1 and not mappings[0].closed
+	assert mappings[0].closed
+
+def test_from_path_closes_map_on_error(tmp_path, mappings):
+	path = tmp_path / 'truncated.jpg'
+	path.write_bytes(pillow_jpeg(48, 32)[:40])
+	with pytest.raises(jpeg.TruncatedFileError):
+		jpeg.Jpeg.from_path(path)
+	assert len(mappings) == 1 and mappings[0].closed
+
+def test_from_path_closes_map_on_bad_index(image_file, tmp_path, mappings):
+	other = tmp_path / 'other.jpg'
+	other.write_bytes(pillow_jpeg(40, 24))
+	with jpeg.Jpeg.from_path(other) as image:
+		index = image.build_index()
+	with pytest.raises(jpeg.BadIndexError):
+		jpeg.Jpeg.from_path(image_file, index=index)
+	assert all(m.closed for m in mappings)
+
+def test_stop_at_sof_leaves_scans_unparsed(image_file):
+	with jpeg.Jpeg.from_path(image_file, stop_at='SOF') as image:
+		assert image.image_width == 48
+		assert image.scans == []
+
+def test_main_closes_file(image_file, mappings, monkeypatch):
+	monkeypatch.setattr(jpeg.sys, 'argv', ['jpeg.py', str(image_file)])
+	jpeg.main()
+	assert len(mappings) == 1 and mappings[0].closed
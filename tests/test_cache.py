@@ -0,0 +1,63 @@
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+	jpeg.clear_caches()
+	yield
+	jpeg.clear_caches()
+
+def test_lru():
+	cache = jpeg.TableCache(2)
+	built = []
+	def build(key):
+		return lambda: built.append(key) or [key]
+
+	a = cache.get('a', build('a'))
+	assert cache.get('a', build('a')) is a
+	cache.get('b', build('b'))
+	# 'a' was used last, so 'b' goes when 'c' comes in
+	cache.get('a', build('a'))
+	cache.get('c', build('c'))
+	assert cache.get('a', build('a')) is a
+	cache.get('b', build('b'))
+	assert built == ['a', 'b', 'c', 'b']
+	assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 4, 'evictions': 2}
+
+	cache.clear()
+	assert cache.stats() == {'size': 0, 'max_size': 2, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+def test_keyed_on_table_contents():
+	counts = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+	values = list(range(12))
+	table = jpeg.huffman_table(counts, values)
+	assert jpeg.huffman_table(bytes(counts), bytearray(values)) is table
+	assert jpeg.huffman_table(counts, values[::-1]) is not table
+	assert jpeg.cache_stats()['huffman']['hits'] == 1
+
+def test_images_share_tables():
+	first = jpeg.Jpeg(pillow_jpeg(40, 24))
+	misses = jpeg.cache_stats()['huffman']['misses']
+	# Pillow codes every image with the Annex K tables
+	assert misses == 4
+
+	second = jpeg.Jpeg(pillow_jpeg(24, 40, quality=50))
+	stats = jpeg.cache_stats()['huffman']
+	assert stats['misses'] == misses and stats['hits'] >= 4
+	assert second.scans[0]['components'][0]['ac_huffman'] is first.scans[0]['components'][0]['ac_huffman']
+
+def test_quantization_tables():
+	data = pillow_jpeg(16, 16)
+	jpeg.Jpeg(data).decode(backend='python')
+	jpeg.Jpeg(data).decode(backend='python')
+	stats = jpeg.cache_stats()['quantization']
+	assert stats['misses'] == 2 and stats['hits'] >= 2
+
+@pytest.mark.skipif(jpeg.numpy is None, reason='needs NumPy')
+def test_numpy_matrix_is_read_only():
+	qmatrix = jpeg.cached_qmatrix_numpy(list(range(1, 65)))
+	assert qmatrix is jpeg.cached_qmatrix_numpy(list(range(1, 65)))
+	with pytest.raises(ValueError):
+		qmatrix[0, 0] = 0
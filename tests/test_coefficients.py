@@ -0,0 +1,53 @@
+import io
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+@pytest.fixture(params=['numpy', 'memoryview'])
+def array_type(request, monkeypatch):
+	if request.param == 'numpy':
+		if jpeg.numpy is None:
+			pytest.skip('needs NumPy')
+	else:
+		monkeypatch.setattr(jpeg, 'numpy', None)
+		monkeypatch.setattr(jpeg, 'DEFAULT_BACKEND', 'python')
+	return request.param
+
+@pytest.mark.parametrize('options', [
+		{'subsampling': 2},
+		{'subsampling': 1, 'restart_marker_blocks': 2},
+		{'subsampling': 2, 'progressive': True},
+])
+def test_dc_only(array_type, options):
+	data = pillow_jpeg(45, 37, **options)
+	full = jpeg.Jpeg(data).coefficients()
+	image = jpeg.Jpeg(data)
+	dc = image.coefficients(dc_only=True)
+	assert image.blocks is None
+	for coefficients, values, c in zip(full, dc, image.components):
+		assert values.shape == (c['blocks_h'], c['blocks_w'])
+		assert coefficients.shape == (c['blocks_h'], c['blocks_w'], 64)
+		assert values.tolist() == [[block[0] for block in row] for row in coefficients.tolist()]
+
+def test_after_decoding(array_type):
+	data = pillow_jpeg(24, 16)
+	image = jpeg.Jpeg(data)
+	image.decode()
+	# taken from the blocks decode() left, the same as decoding afresh
+	assert [c.tolist() for c in image.coefficients()] == [c.tolist() for c in jpeg.Jpeg(data).coefficients()]
+	assert [c.tolist() for c in image.coefficients(dc_only=True)] == [c.tolist() for c in jpeg.Jpeg(data).coefficients(dc_only=True)]
+
+# Blocks come in natural order: a picture that only changes across has nothing in the
+#	first column of any block past the DC
+def test_natural_order(array_type):
+	Image = pytest.importorskip('PIL.Image')
+	picture = Image.frombytes('L', (32, 16), bytes((x * 8) & 0xff for y in range(16) for x in range(32)))
+	f = io.BytesIO()
+	picture.save(f, 'JPEG', quality=95)
+	blocks = jpeg.Jpeg(f.getvalue()).coefficients()[0].tolist()
+	for row in blocks:
+		for block in row:
+			assert block[1] != 0
+			assert all(block[v * 8] == 0 for v in range(1, 8))
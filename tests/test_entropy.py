@@ -0,0 +1,95 @@
+import array
+import random
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg, pillow_decode
+
+# Random coefficient blocks that look like an image's: small, mostly zero at high frequencies
+def random_blocks(rng, count):
+	blocks = array.array('h', bytes(128 * count))
+	for b in range(count):
+		blocks[b * 64] = rng.randint(-300, 300)
+		for k in range(1, 64):
+			if rng.random() < 0.6 / (1 + k / 8):
+				blocks[b * 64 + k] = rng.choice((-1, 1)) * int(rng.expovariate(0.3) + 1)
+	return blocks
+
+# A grayscale file with the given coefficients, coded with encode_optimized_scan()
+#	bands lists the (ss, se) of each scan, more than one making it progressive
+def gray_file(blocks, width, height, restart_interval=0, bands=((0, 63),)):
+	header = b'\xff\xd8\xff\xdb\x00\x43\x00' + bytes([1] * 64)
+	sof = b'\xc2' if len(bands) > 1 else b'\xc0'
+	header += b'\xff' + sof + b'\x00\x0b\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + b'\x01\x01\x11\x00'
+	if restart_interval:
+		header += b'\xff\xdd\x00\x04' + restart_interval.to_bytes(2, 'big')
+	blocks_w = -(-width // 8)
+	units = [(blocks, 0, 0, 0, blocks_w, 1, 1, 0, 0)]
+	count = blocks_w * -(-height // 8)
+	for ss, se in bands:
+		dht, data = jpeg.encode_optimized_scan(units, blocks_w, count, 1, restart_interval, ss, se)
+		header += dht + b'\xff\xda\x00\x08\x01\x01\x00' + bytes([ss, se, 0]) + data
+	return header + b'\xff\xd9'
+
+def test_coefficients_round_trip():
+	rng = random.Random(5)
+	blocks = random_blocks(rng, 6 * 4)
+	image = jpeg.Jpeg(gray_file(blocks, 48, 32))
+	assert image.decode_scans()[0] == blocks
+
+def test_restart_intervals_round_trip():
+	rng = random.Random(6)
+	blocks = random_blocks(rng, 6 * 4)
+	data = gray_file(blocks, 48, 32, restart_interval=5)
+	image = jpeg.Jpeg(data)
+	assert image.restart_interval == 5 and len(image.scans[0]['segments']) == 5
+	assert image.decode_scans()[0] == blocks
+
+# The first scans of progressive bands, as the benchmark corpus codes them
+def test_bands_round_trip():
+	rng = random.Random(7)
+	blocks = random_blocks(rng, 6 * 4)
+	image = jpeg.Jpeg(gray_file(blocks, 48, 32, restart_interval=4, bands=((0, 0), (1, 5), (6, 63))))
+	assert len(image.scans) == 3
+	assert image.decode_scans()[0] == blocks
+	# a band's scan only has the table it uses
+	dht, data = jpeg.encode_optimized_scan([(blocks, 0, 0, 0, 6, 1, 1, 0, 0)], 6, 24, 1, 0, 1, 63)
+	assert dht[4] == 0x10 and len(dht) == 4 + 17 + sum(dht[5:21])
+
+@pytest.mark.parametrize('subsampling', [0, 1, 2])
+def test_dc_is_the_block_mean(subsampling):
+	data = pillow_jpeg(40, 24, subsampling=subsampling, quality=95)
+	image = jpeg.Jpeg(data)
+	blocks = image.decode_scans()
+	luma = pillow_decode(data, 'YCbCr')[::3]
+	component = image.components[0]
+	q = image.quantization_tables[component['quant_tbl_index']][0]
+	for by in range(3):
+		for bx in range(5):
+			dc = blocks[0][(by * component['blocks_w'] + bx) * 64] * q / 8 + 128
+			mean = sum(luma[(by * 8 + y) * 40 + bx * 8 + x] for y in range(8) for x in range(8)) / 64
+			assert abs(dc - mean) < 1.5
+
+# Magnitude categories past what the precision allows are rejected when the table is built,
+#	rather than reaching the decoder: 11 for DC and 10 for AC at 8 bit precision
+@pytest.mark.parametrize('table_class, symbol', [(0, 12), (0, 16), (1, 0x0b), (1, 0x3f)])
+def test_out_of_range_symbols(table_class, symbol):
+	rng = random.Random(8)
+	data = bytearray(gray_file(random_blocks(rng, 6 * 4), 48, 32))
+	index = data.index(b'\xff\xc4') + 4
+	# the DC table comes first, then the AC one
+	if table_class:
+		index += 17 + sum(data[index + 1:index + 17])
+	assert data[index] == table_class << 4
+	data[index + 17 + sum(data[index + 1:index + 17]) - 1] = symbol
+	with pytest.raises(jpeg.BadFieldError) as error:
+		jpeg.Jpeg(bytes(data))
+	assert error.value.args == ('DHT',)
+
+def test_truncated_data():
+	data = pillow_jpeg(40, 24)
+	start = jpeg.Jpeg(data).scans[0]['offset']
+	image = jpeg.Jpeg(data[:start + 20] + b'\xff\xd9')
+	with pytest.raises(jpeg.TruncatedFileError):
+		image.decode_scans()
@@ -0,0 +1,55 @@
+import pytest
+
+import jpeg
+
+# The Annex K luminance AC table, which has codes of every length up to 16 bits
+K3_AC_COUNTS = [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d]
+K3_AC_VALUES = [
+		0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+		0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+		0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+		0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+		0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+		0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+		0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+		0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+		0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+		0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+		0xf9, 0xfa]
+
+def test_lookup_finds_every_code():
+	table = jpeg.JpegHuffman((K3_AC_COUNTS, K3_AC_VALUES))
+	codes = table.encoding_table()
+	for symbol in K3_AC_VALUES:
+		code, length = codes[symbol]
+		# any bits may follow the code
+		for tail in (0, (1 << (16 - length)) - 1):
+			assert table.lookup((code << (16 - length)) | tail) == (symbol, length)
+
+def test_short_codes_resolve_in_one_probe():
+	table = jpeg.JpegHuffman((K3_AC_COUNTS, K3_AC_VALUES))
+	lookahead = jpeg.JpegHuffman.LOOKAHEAD
+	for symbol, entry in enumerate(table.encoding_table()):
+		if entry is None:
+			continue
+		code, length = entry
+		probe = table.lookup_table[code << (lookahead - length)] if length <= lookahead else 0
+		assert probe == ((symbol << 4) | length if length <= lookahead else 0)
+
+def test_canonical_codes():
+	# spec annex C: codes count up within a length and double going to the next
+	table = jpeg.JpegHuffman(([0, 2, 1] + [0] * 13, [5, 6, 7]))
+	codes = table.encoding_table()
+	assert codes[5] == (0b00, 2)
+	assert codes[6] == (0b01, 2)
+	assert codes[7] == (0b100, 3)
+	with pytest.raises(jpeg.BadFieldError):
+		table.lookup(0xffff)
+
+def test_over_subscribed_table():
+	with pytest.raises(jpeg.BadHuffmanTreeError):
+		jpeg.JpegHuffman(([3] + [0] * 15, [0, 1, 2]))
+
+def test_counts_must_match_values():
+	with pytest.raises(jpeg.BadHuffmanTreeError):
+		jpeg.JpegHuffman(([0, 2] + [0] * 14, [0, 1, 2]))
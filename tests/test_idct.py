@@ -0,0 +1,111 @@
+import array
+import math
+import random
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+def random_blocks(rng, count, spread=60):
+	blocks = array.array('h', bytes(128 * count))
+	for i in range(64 * count):
+		if i % 64 == 0 or rng.random() < 0.3:
+			blocks[i] = int(rng.gauss(0, spread / (1 + (i % 64) / 4)))
+	return blocks
+
+# The IDCT straight from its definition, spec A.3.3, rounded and clamped
+def reference_block(block, qtable, precision=8):
+	natural = [0] * 64
+	for k, n in enumerate(jpeg.ZIGZAG_NATURAL):
+		natural[n] = block[k] * qtable[n]
+	c = [math.sqrt(0.5)] + [1.0] * 7
+	out = []
+	for y in range(8):
+		for x in range(8):
+			value = sum(c[u] * c[v] * natural[v * 8 + u] * math.cos((2 * x + 1) * u * math.pi / 16) * math.cos((2 * y + 1) * v * math.pi / 16)
+					for u in range(8) for v in range(8)) / 4
+			out.append(min(max(int(math.floor(value + (1 << (precision - 1)) + 0.5)), 0), (1 << precision) - 1))
+	return out
+
+def plane_samples(plane, backend):
+	if backend == 'numpy':
+		return [int(v) for v in plane.ravel()]
+	return list(plane)
+
+def block_of(samples, stride, bx, by):
+	return [samples[(by * 8 + y) * stride + bx * 8 + x] for y in range(8) for x in range(8)]
+
+@pytest.mark.parametrize('backend', jpeg.BACKENDS)
+def test_matches_the_definition(backend):
+	if backend == 'numpy':
+		pytest.importorskip('numpy')
+	rng = random.Random(2)
+	qtable = [rng.randint(1, 12) for i in range(64)]
+	blocks = random_blocks(rng, 6)
+	plane = plane_samples(jpeg.idct_plane(blocks, qtable, 3, 2, backend=backend), backend)
+	for b in range(6):
+		expected = reference_block(blocks[b * 64:(b + 1) * 64], qtable)
+		assert max(abs(u - v) for u, v in zip(block_of(plane, 24, b % 3, b // 3), expected)) <= 1
+
+@pytest.mark.parametrize('backend', jpeg.BACKENDS)
+def test_twelve_bit(backend):
+	if backend == 'numpy':
+		pytest.importorskip('numpy')
+	rng = random.Random(3)
+	qtable = [rng.randint(1, 4) for i in range(64)]
+	blocks = random_blocks(rng, 2, spread=2000)
+	plane = plane_samples(jpeg.idct_plane(blocks, qtable, 2, 1, precision=12, backend=backend), backend)
+	for b in range(2):
+		expected = reference_block(blocks[b * 64:(b + 1) * 64], qtable, 12)
+		assert max(abs(u - v) for u, v in zip(block_of(plane, 16, b, 0), expected)) <= 1
+
+@pytest.mark.parametrize('backend', jpeg.BACKENDS)
+def test_flat_and_clamped_blocks(backend):
+	if backend == 'numpy':
+		pytest.importorskip('numpy')
+	blocks = array.array('h', bytes(128 * 3))
+	blocks[0] = 10
+	blocks[64] = 2000
+	blocks[128] = -2000
+	plane = plane_samples(jpeg.idct_plane(blocks, [1] * 64, 3, 1, backend=backend), backend)
+	assert set(block_of(plane, 24, 0, 0)) == {129}
+	assert set(block_of(plane, 24, 1, 0)) == {255}
+	assert set(block_of(plane, 24, 2, 0)) == {0}
+
+# Corrupt coefficients can take the IDCT far past the samples' range, and still only clamp
+@pytest.mark.filterwarnings('error')
+@pytest.mark.parametrize('backend', jpeg.BACKENDS)
+@pytest.mark.parametrize('size', [8, 4, 2, 1])
+def test_extreme_coefficients(backend, size):
+	if backend == 'numpy':
+		pytest.importorskip('numpy')
+	rng = random.Random(5)
+	blocks = array.array('h', [32767] + [0] * 63 + [-32768] + [0] * 63)
+	blocks.extend(rng.choice((32767, -32768, 0)) for i in range(64 * 4))
+	qtable = [255] * 64
+	plane = plane_samples(jpeg.idct_plane(blocks, qtable, 6, 1, backend=backend, size=size), backend)
+	if size == 8:
+		for b in range(6):
+			expected = reference_block(blocks[b * 64:(b + 1) * 64], qtable)
+			assert max(abs(u - v) for u, v in zip(block_of(plane, 48, b, 0), expected)) <= 1
+	else:
+		assert set(plane[:size]) == {255} and set(plane[size:2 * size]) == {0}
+	assert plane == plane_samples(jpeg.idct_plane(blocks, qtable, 6, 1, backend='python', size=size), 'python')
+
+# and a corrupt sample precision doesn't get as far as the IDCT
+@pytest.mark.parametrize('precision', [0, 7, 9, 16, 200])
+def test_bad_precision(precision):
+	data = bytearray(pillow_jpeg(16, 8))
+	data[data.index(b'\xff\xc0') + 4] = precision
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(bytes(data))
+
+def test_backends_agree():
+	pytest.importorskip('numpy')
+	rng = random.Random(4)
+	qtable = [rng.randint(1, 20) for i in range(64)]
+	blocks = random_blocks(rng, 40 * 3)
+	python = jpeg.idct_plane(blocks, qtable, 40, 3, backend='python')
+	numpy = jpeg.idct_plane(blocks, qtable, 40, 3, backend='numpy')
+	assert max(abs(u - int(v)) for u, v in zip(python, numpy.ravel())) <= 1
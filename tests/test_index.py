@@ -0,0 +1,66 @@
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg, as_bytes
+
+def test_round_trip():
+	data = pillow_jpeg(64, 48, restart_marker_blocks=4)
+	index = jpeg.Jpeg(data).build_index(checkpoint_interval=5)
+	loaded = jpeg.JpegIndex.loads(index.dumps())
+	for name in ('file_size', 'header_size', 'header_crc', 'markers', 'checkpoint_interval'):
+		assert getattr(loaded, name) == getattr(index, name)
+	assert len(loaded.scans) == len(index.scans) == 1
+	for scan, original in zip(loaded.scans, index.scans):
+		for key in ('offset', 'length', 'restart_interval', 'segments'):
+			assert scan[key] == original[key]
+		assert [list(a) for a in scan['checkpoints']] == [list(a) for a in original['checkpoints']]
+	assert len(index.scans[0]['checkpoints'][0]) > 0
+
+def test_save_and_load(tmp_path):
+	data = pillow_jpeg(40, 24, progressive=True)
+	path = tmp_path / 'image.idx'
+	jpeg.Jpeg(data).build_index().save(path)
+	image = jpeg.Jpeg(data, index=jpeg.JpegIndex.load(path))
+	assert [s['segments'] for s in image.scans] == [s['segments'] for s in jpeg.Jpeg(data).scans]
+	assert as_bytes(image.decode()) == as_bytes(jpeg.Jpeg(data).decode())
+
+# The index spares the parse the search for the end of each scan
+def test_indexed_parse_matches():
+	data = pillow_jpeg(64, 48, subsampling=2, restart_marker_rows=1)
+	plain = jpeg.Jpeg(data)
+	indexed = jpeg.Jpeg(data, index=plain.build_index())
+	for a, b in zip(indexed.scans, plain.scans):
+		assert (a['offset'], a['length'], a['segments']) == (b['offset'], b['length'], b['segments'])
+	assert as_bytes(indexed.decode()) == as_bytes(plain.decode())
+
+# A region after a checkpoint is decoded from there on: the data before it is never read
+def test_region_starts_at_checkpoint():
+	data = pillow_jpeg(64, 64, subsampling=0)
+	index = jpeg.Jpeg(data).build_index(checkpoint_interval=8)
+	region = (0, 40, 64, 24)
+	expected = as_bytes(jpeg.Jpeg(data).decode(region=region))
+
+	mcus, positions, bits, predictions = index.scans[0]['checkpoints']
+	assert list(mcus) == [8, 16, 24, 32, 40, 48, 56]
+	start = index.scans[0]['offset']
+	mangled = bytearray(data)
+	mangled[start:positions[mcus.index(40)]] = bytes(positions[mcus.index(40)] - start)
+	assert as_bytes(jpeg.Jpeg(bytes(mangled), index=index).decode(region=region)) == expected
+
+def test_no_checkpoints_for_progressive():
+	index = jpeg.Jpeg(pillow_jpeg(40, 24, progressive=True)).build_index(checkpoint_interval=2)
+	assert all(len(scan['checkpoints'][0]) == 0 for scan in index.scans)
+
+def test_stale_index():
+	index = jpeg.Jpeg(pillow_jpeg(40, 24)).build_index()
+	with pytest.raises(jpeg.BadIndexError):
+		jpeg.Jpeg(pillow_jpeg(40, 24, quality=50), index=index)
+
+def test_bad_sidecar():
+	saved = jpeg.Jpeg(pillow_jpeg(40, 24)).build_index(checkpoint_interval=3).dumps()
+	with pytest.raises(jpeg.BadIndexError):
+		jpeg.JpegIndex.loads(b'JUNK' + saved[4:])
+	with pytest.raises(jpeg.BadIndexError):
+		jpeg.JpegIndex.loads(saved[:4] + b'\x63\x00' + saved[6:])
+	with pytest.raises(jpeg.BadIndexError):
+		jpeg.JpegIndex.loads(saved[:-1])
@@ -0,0 +1,259 @@
+import struct
+
+import pytest
+
+import jpeg
+from conftest import BACKENDS
+
+PREDICTORS = {
+		1: lambda ra, rb, rc: ra,
+		2: lambda ra, rb, rc: rb,
+		3: lambda ra, rb, rc: rc,
+		4: lambda ra, rb, rc: ra + rb - rc,
+		5: lambda ra, rb, rc: ra + ((rb - rc) >> 1),
+		6: lambda ra, rb, rc: rb + ((ra - rc) >> 1),
+		7: lambda ra, rb, rc: (ra + rb) >> 1,
+}
+
+# A width x height plane of precision bit samples, smooth with some noise, the same every run
+def sample_plane(width, height, precision, seed):
+	top = (1 << precision) - 1
+	plane = []
+	for y in range(height):
+		row = []
+		for x in range(width):
+			seed = (seed * 1103515245 + 12345) & 0x7fffffff
+			noise = (seed >> 8) & (top >> 3)
+			row.append(((x * 37 + y * 23) * top // 400 + noise) & top)
+		plane.append(row)
+	return plane
+
+# The differences a lossless encoder codes for plane, as spec H.1.2 predicts them
+#	first_rows are the rows that start a restart interval, which are predicted like the first
+def differences(plane, predictor, precision, point_transform, first_rows):
+	predict = PREDICTORS[predictor]
+	samples = [[s >> point_transform for s in row] for row in plane]
+	initial = 1 << (precision - point_transform - 1)
+	diffs = []
+	for y, row in enumerate(samples):
+		out = []
+		for x, sample in enumerate(row):
+			if y in first_rows:
+				prediction = initial if x == 0 else row[x - 1]
+			elif x == 0:
+				prediction = samples[y - 1][0]
+			else:
+				prediction = predict(row[x - 1], samples[y - 1][x], samples[y - 1][x - 1])
+			diff = (sample - prediction) & 0xffff
+			out.append(diff - 0x10000 if diff >= 0x8000 else diff)
+		diffs.append(out)
+	return diffs
+
+def category(diff):
+	return 16 if diff == -0x8000 else abs(diff).bit_length()
+
+# Huffman code diffs, a list of the differences in the order they are coded, with a table made
+#	for them; returns the DHT segment and the entropy-coded data, stuffed, with RSTn markers
+#	after every restart_every of them
+def encode_differences(diffs, restart_every):
+	frequencies = [0] * 256
+	for diff in diffs:
+		frequencies[category(diff)] += 1
+	counts, values = jpeg.optimal_huffman_table(frequencies)
+	codes = jpeg.JpegHuffman((counts, values)).encoding_table()
+	dht = b'\xff\xc4' + struct.pack('>HB', 19 + len(values), 0) + bytes(counts) + bytes(values)
+
+	data = bytearray()
+	bits = []
+	def flush():
+		bits.extend([1] * (-len(bits) % 8))
+		packed = bytes(int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+		data.extend(packed.replace(b'\xff', b'\xff\x00'))
+		del bits[:]
+	for n, diff in enumerate(diffs):
+		if restart_every and n and n % restart_every == 0:
+			flush()
+			data.extend(bytes([0xff, 0xd0 + (n // restart_every - 1) % 8]))
+		s = category(diff)
+		code, length = codes[s]
+		bits.extend(int(b) for b in format(code, '0%db' % length))
+		if 0 < s < 16:
+			extra = diff if diff > 0 else diff - 1
+			bits.extend(int(b) for b in format(extra & ((1 << s) - 1), '0%db' % s))
+	flush()
+	return dht, bytes(data)
+
+# A lossless (SOF3) file of width x height with components sampled factors, each plane as big
+#	as its component is coded, padding included; see coded_sizes()
+#	interleaved codes the components in one scan, otherwise each gets its own
+#	restart_rows puts a restart marker every that many MCU rows
+def lossless_jpeg(width, height, planes, factors, precision=8, predictor=1, point_transform=0,
+		interleaved=True, restart_rows=0):
+	out = bytearray(b'\xff\xd8')
+	sof = struct.pack('>BHHB', precision, height, width, len(planes))
+	for i, (h, v) in enumerate(factors):
+		sof += struct.pack('BBB', i + 1, (h << 4) | v, 0)
+	out += b'\xff\xc3' + struct.pack('>H', len(sof) + 2) + sof
+
+	max_h = max(h for h, v in factors)
+	max_v = max(v for h, v in factors)
+	mcus_x = -(-width // max_h)
+	scans = [list(range(len(planes)))] if interleaved and len(planes) > 1 else [[i] for i in range(len(planes))]
+	for components in scans:
+		# every v rows of each component make an MCU row of an interleaved scan
+		if len(components) > 1:
+			mcu_row_lines = [factors[c][1] for c in components]
+			mcus_per_row = mcus_x
+		else:
+			mcu_row_lines = [1]
+			mcus_per_row = len(planes[components[0]][0])
+		rows = len(planes[components[0]]) // mcu_row_lines[0]
+		first_rows = [set(range(0, len(planes[c]), (restart_rows or rows) * lines)) for c, lines in zip(components, mcu_row_lines)]
+		diffs = [differences(planes[c], predictor, precision, point_transform, first) for c, first in zip(components, first_rows)]
+
+		ordered = []
+		if len(components) > 1:
+			for mcu_y in range(rows):
+				for mcu_x in range(mcus_x):
+					for c, d in zip(components, diffs):
+						h, v = factors[c]
+						for y in range(v):
+							ordered.extend(d[mcu_y * v + y][mcu_x * h:(mcu_x + 1) * h])
+		else:
+			for row in diffs[0]:
+				ordered.extend(row)
+
+		restart_interval = restart_rows * mcus_per_row
+		if restart_rows:
+			out += b'\xff\xdd' + struct.pack('>HH', 4, restart_interval)
+		samples_per_mcu = sum(factors[c][0] * factors[c][1] for c in components) if len(components) > 1 else 1
+		dht, data = encode_differences(ordered, restart_interval * samples_per_mcu)
+		out += dht
+		sos = struct.pack('B', len(components)) + b''.join(struct.pack('BB', c + 1, 0) for c in components)
+		sos += struct.pack('BBB', predictor, 0, point_transform)
+		out += b'\xff\xda' + struct.pack('>H', len(sos) + 2) + sos + data
+	out += b'\xff\xd9'
+	return bytes(out)
+
+# How many samples across and down each component is coded as: an interleaved scan codes
+#	whole MCUs, a component in a scan of its own just its share of the image
+def coded_sizes(width, height, factors, interleaved):
+	max_h = max(h for h, v in factors)
+	max_v = max(v for h, v in factors)
+	if interleaved and len(factors) > 1:
+		mcus_x = -(-width // max_h)
+		mcus_y = -(-height // max_v)
+		return [(mcus_x * h, mcus_y * v) for h, v in factors]
+	return [(-(-width * h // max_h), -(-height * v // max_v)) for h, v in factors]
+
+# What decoding should give: each component's samples, less the bits the point transform
+#	dropped, replicated up to the image's size and interleaved
+def expected_pixels(width, height, planes, factors, point_transform):
+	max_h = max(h for h, v in factors)
+	max_v = max(v for h, v in factors)
+	pixels = []
+	for y in range(height):
+		for x in range(width):
+			for plane, (h, v) in zip(planes, factors):
+				pixels.append(plane[y * v // max_v][x * h // max_h] >> point_transform << point_transform)
+	return pixels
+
+def make(width, height, factors=((1, 1),), precision=8, interleaved=True, **options):
+	sizes = coded_sizes(width, height, factors, interleaved)
+	planes = [sample_plane(w, h, precision, i + 1) for i, (w, h) in enumerate(sizes)]
+	data = lossless_jpeg(width, height, planes, factors, precision, interleaved=interleaved, **options)
+	return data, expected_pixels(width, height, planes, factors, options.get('point_transform', 0))
+
+def samples(pixels, precision):
+	view = memoryview(pixels).cast('B')
+	return view.cast('H').tolist() if precision > 8 else view.tolist()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('predictor', range(1, 8))
+def test_predictors(backend, predictor):
+	data, expected = make(19, 13, predictor=predictor)
+	image = jpeg.Jpeg(data)
+	assert image.encoding_type.get('lossless')
+	assert samples(image.decode('L', backend=backend), 8) == expected
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('precision', [2, 8, 12, 16])
+@pytest.mark.parametrize('predictor', [1, 4, 6, 7])
+def test_precisions(backend, precision, predictor):
+	data, expected = make(17, 11, precision=precision, predictor=predictor)
+	assert samples(jpeg.Jpeg(data).decode('L', backend=backend), precision) == expected
+
+# A difference of exactly 32768 has category 16 and no extra bits
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_16_bit_extremes(backend):
+	plane = [[0, 0x8000, 0, 0xffff], [0xffff, 0x7fff, 0x8000, 1], [0, 0x8000, 0xffff, 0]]
+	data = lossless_jpeg(4, 3, [plane], [(1, 1)], 16)
+	assert samples(jpeg.Jpeg(data).decode('L', backend=backend), 16) == [s for row in plane for s in row]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('precision, point_transform', [(8, 2), (12, 3), (16, 5)])
+@pytest.mark.parametrize('predictor', [1, 5, 7])
+def test_point_transform(backend, precision, point_transform, predictor):
+	data, expected = make(15, 9, precision=precision, predictor=predictor, point_transform=point_transform)
+	assert samples(jpeg.Jpeg(data).decode('L', backend=backend), precision) == expected
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('factors', [((1, 1), (1, 1), (1, 1)), ((2, 2), (1, 1), (1, 1)), ((2, 1), (1, 1), (1, 1))],
+		ids=['444', '420', '422'])
+@pytest.mark.parametrize('interleaved', [True, False])
+@pytest.mark.parametrize('predictor', [1, 4, 7])
+def test_sampling(backend, factors, interleaved, predictor):
+	data, expected = make(23, 17, factors, interleaved=interleaved, predictor=predictor)
+	image = jpeg.Jpeg(data)
+	assert len(image.scans) == (1 if interleaved else 3)
+	assert samples(image.decode('RGB', backend=backend), 8) == expected
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('factors', [((1, 1),), ((2, 2), (1, 1), (1, 1)), ((2, 1), (1, 1), (1, 1))], ids=['gray', '420', '422'])
+@pytest.mark.parametrize('interleaved', [True, False])
+@pytest.mark.parametrize('restart_rows', [1, 3])
+def test_restart_intervals(backend, factors, interleaved, restart_rows):
+	data, expected = make(21, 19, factors, 12, interleaved, predictor=6, restart_rows=restart_rows)
+	image = jpeg.Jpeg(data)
+	assert all(len(scan['segments']) > 1 for scan in image.scans)
+	mode = 'L' if len(factors) == 1 else 'RGB'
+	assert samples(image.decode(mode, backend=backend), 12) == expected
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_region(backend):
+	data, expected = make(23, 17, ((2, 2), (1, 1), (1, 1)), predictor=5)
+	x, y, width, height = 5, 3, 11, 9
+	wanted = [expected[((y + row) * 23 + x) * 3 + i] for row in range(height) for i in range(width * 3)]
+	assert samples(jpeg.Jpeg(data).decode('RGB', backend=backend, region=(x, y, width, height)), 8) == wanted
+
+# Differences that take samples past the precision, which only a corrupt file has: the
+#	samples are kept modulo 2 ** precision rather than overflowing the output
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('predictor', [1, 2, 4])
+@pytest.mark.parametrize('precision, point_transform', [(8, 0), (8, 2), (12, 0)])
+def test_samples_past_the_precision(backend, predictor, precision, point_transform):
+	plane = sample_plane(13, 9, 16, 1)
+	data = lossless_jpeg(13, 9, [plane], [(1, 1)], precision, predictor, point_transform)
+	mask = (1 << (precision - point_transform)) - 1
+	expected = [(s >> point_transform & mask) << point_transform for row in plane for s in row]
+	assert samples(jpeg.Jpeg(data).decode('L', backend=backend), precision) == expected
+
+def test_unsupported():
+	data, expected = make(8, 8)
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode('L', scale=1 / 2)
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode('RGB')
+
+	# predictor 0 is only for the hierarchical mode
+	sos = data.index(b'\xff\xda')
+	predictor = sos + 2 + 2 + 1 + 2
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(data[:predictor] + b'\x00' + data[predictor + 1:]).decode('L')
+
+	# a restart interval has to be a whole number of rows for prediction to start over
+	plane = sample_plane(8, 8, 8, 1)
+	data = lossless_jpeg(8, 8, [plane], [(1, 1)], restart_rows=1)
+	dri = data.index(b'\xff\xdd')
+	with pytest.raises(jpeg.MarkerNotHandledError):
+		jpeg.Jpeg(data[:dri + 4] + b'\x00\x0c' + data[dri + 6:]).decode('L')
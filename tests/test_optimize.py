@@ -0,0 +1,65 @@
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+def scan_data(image, scan):
+	return bytes(image._buf[scan['offset']:scan['offset'] + scan['length']])
+
+def code_lengths(counts):
+	return [size for size, count in enumerate(counts, 1) for i in range(count)]
+
+@pytest.mark.parametrize('options', [
+		{'subsampling': 2},
+		{'subsampling': 0, 'restart_marker_blocks': 5},
+		{'mode': 'L', 'restart_marker_rows': 2},
+])
+def test_same_as_libjpeg_optimize(options):
+	data = pillow_jpeg(61, 45, **options)
+	optimized = b''.join(jpeg.Jpeg(data).optimize_huffman())
+	assert len(optimized) < len(data)
+
+	ours = jpeg.Jpeg(optimized)
+	libjpeg = jpeg.Jpeg(pillow_jpeg(61, 45, optimize=True, **options))
+	assert ours.restart_interval == jpeg.Jpeg(data).restart_interval
+	# libjpeg builds its tables the same way, so the entropy-coded data comes out the same
+	assert scan_data(ours, ours.scans[0]) == scan_data(libjpeg, libjpeg.scans[0])
+	assert [c.tolist() for c in ours.coefficients()] == [c.tolist() for c in jpeg.Jpeg(data).coefficients()]
+
+def test_old_tables_dropped():
+	data = pillow_jpeg(24, 16)
+	markers = [m for m, start, end in jpeg.Jpeg(b''.join(jpeg.Jpeg(data).optimize_huffman())).marker_segments()]
+	original = [m for m, start, end in jpeg.Jpeg(data).marker_segments() if m != 'DHT']
+	# one DHT segment, right before the scan it is for
+	assert markers.count('DHT') == 1 and markers.index('DHT') == markers.index('SOS') - 1
+	assert [m for m in markers if m != 'DHT'] == original
+
+def test_progressive_is_refused():
+	with pytest.raises(jpeg.MarkerNotHandledError):
+		b''.join(jpeg.Jpeg(pillow_jpeg(24, 16, progressive=True)).optimize_huffman())
+
+def test_optimal_table():
+	frequencies = [0] * 256
+	for symbol, count in ((0, 50), (1, 20), (5, 20), (7, 9), (200, 1)):
+		frequencies[symbol] = count
+	counts, values = jpeg.optimal_huffman_table(frequencies)
+	assert sorted(values) == [0, 1, 5, 7, 200]
+	lengths = dict(zip(values, code_lengths(counts)))
+	assert lengths[0] <= lengths[1] <= lengths[7] <= lengths[200]
+	# room is left for the reserved code, so no code is all 1 bits
+	assert sum(2 ** -n for n in lengths.values()) < 1
+	jpeg.JpegHuffman((counts, values))
+
+def test_code_lengths_limited_to_16_bits():
+	# Fibonacci frequencies make the deepest possible tree
+	frequencies = [0] * 256
+	a, b = 1, 1
+	for symbol in range(30):
+		frequencies[symbol] = a
+		a, b = b, a + b
+	counts, values = jpeg.optimal_huffman_table(frequencies)
+	assert len(counts) == 16 and sum(counts) == 30
+	assert sum(2 ** -n for n in code_lengths(counts)) < 1
+	lengths = dict(zip(values, code_lengths(counts)))
+	assert lengths[29] == min(lengths.values()) and max(lengths.values()) == 16
+	jpeg.JpegHuffman((counts, values))
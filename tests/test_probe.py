@@ -0,0 +1,60 @@
+import io
+import struct
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+# A file whose headers run well past Jpeg.PROBE_HEAD_SIZE, with a big COM segment up front
+def long_header_jpeg():
+	data = pillow_jpeg(40, 24)
+	comment = b'\xff\xfe' + struct.pack('>H', 60000) + bytes(59998)
+	return data[:2] + comment + data[2:]
+
+def check_info(info, width=40, height=24):
+	assert (info.image_width, info.image_height) == (width, height)
+	assert info.sample_precision == 8
+	# baseline: none of the encoding types apply
+	assert not any(info.encoding_type.values())
+	assert [c[0] for c in info.components] == [1, 2, 3]
+	assert info.components[0][1:3] == (2, 2)
+	assert info.is_jfif
+
+def test_probe_buffer():
+	data = pillow_jpeg(40, 24)
+	info = jpeg.Jpeg.probe(data)
+	check_info(info)
+	# the frame header is all that was read
+	sof = data.index(b'\xff\xc0')
+	assert info.header_size == sof + 2 + struct.unpack_from('>H', data, sof + 2)[0]
+
+def test_probe_path_and_file(tmp_path):
+	path = tmp_path / 'image.jpg'
+	path.write_bytes(pillow_jpeg(40, 24))
+	check_info(jpeg.Jpeg.probe(str(path)))
+	with open(path, 'rb') as f:
+		check_info(jpeg.Jpeg.probe(f))
+
+def test_probe_grows_its_read():
+	data = long_header_jpeg()
+	reads = []
+	class File(io.BytesIO):
+		def read(self, size=-1):
+			reads.append(size)
+			return super().read(size)
+	info = jpeg.Jpeg.probe(File(data))
+	check_info(info)
+	assert len(reads) > 1 and reads[0] == jpeg.Jpeg.PROBE_HEAD_SIZE
+	assert sum(reads) < len(data) + jpeg.Jpeg.PROBE_HEAD_SIZE * 2
+
+def test_probe_truncated_file():
+	data = pillow_jpeg(40, 24)
+	with pytest.raises(jpeg.TruncatedFileError):
+		jpeg.Jpeg.probe(io.BytesIO(data[:data.index(b'\xff\xc0') + 6]))
+
+def test_probe_not_a_jpeg():
+	with pytest.raises(jpeg.MarkerNotRecognizedError):
+		jpeg.Jpeg.probe(b'\x89PNG\r\n\x1a\n' + bytes(64))
+	with pytest.raises(jpeg.NotJpegFileError):
+		jpeg.Jpeg.probe(b'\xff\xe0\x00\x10JFIF\x00' + bytes(64))
@@ -0,0 +1,71 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg
+from test_lossless import make
+
+@pytest.fixture
+def data():
+	return pillow_jpeg(40, 24, subsampling=2)
+
+def test_markers(data):
+	profile = jpeg.JpegProfile()
+	image = jpeg.Jpeg(data, profile=profile)
+	markers = [m for m, start, end in image.marker_segments()]
+	assert set(profile.markers) == set(markers)
+	for marker, (calls, seconds, size) in profile.markers.items():
+		assert calls == markers.count(marker) and seconds >= 0
+	# the handlers move over everything but the two byte markers themselves, the SOS
+	#	handler over the entropy-coded data as well
+	assert sum(size for calls, seconds, size in profile.markers.values()) == len(data) - 2 * len(markers)
+	assert profile.markers['SOS'][2] > len(data) // 3
+	assert profile.stages == {}
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_stages(data, backend):
+	profile = jpeg.JpegProfile()
+	jpeg.Jpeg(data, profile=profile).decode(backend=backend)
+	assert sorted(profile.stages) == ['color', 'entropy', 'idct', 'upsample']
+	assert all(calls == 1 for calls, seconds in profile.stages.values())
+
+def test_callback(data):
+	seen = []
+	profile = jpeg.JpegProfile(lambda *measurement: seen.append(measurement))
+	jpeg.Jpeg(data, profile=profile).decode()
+	assert {(kind, name) for kind, name, seconds, size in seen} == \
+			{('marker', m) for m in profile.markers} | {('stage', s) for s in profile.stages}
+	for kind, name, seconds, size in seen:
+		assert (size is None) == (kind == 'stage')
+	stages = [(name, seconds) for kind, name, seconds, size in seen if kind == 'stage']
+	assert sum(seconds for name, seconds in stages) == pytest.approx(sum(s for c, s in profile.stages.values()))
+
+def test_shared_and_cleared(data):
+	profile = jpeg.JpegProfile()
+	jpeg.Jpeg(data, profile=profile).decode()
+	jpeg.Jpeg(data, profile=profile).decode()
+	assert profile.markers['SOF0'][0] == 2 and profile.stages['entropy'][0] == 2
+	result = profile.as_dict()
+	assert result['markers']['DHT']['calls'] == 8
+	assert set(result['stages']['idct']) == {'calls', 'seconds'}
+	profile.clear()
+	assert profile.as_dict() == {'markers': {}, 'stages': {}}
+
+def test_off_by_default(data):
+	image = jpeg.Jpeg(data)
+	assert image.profile is None
+	image.decode()
+
+# Lossless images have no IDCT, but undo the prediction instead
+def test_lossless_stages():
+	data, expected = make(16, 8)
+	profile = jpeg.JpegProfile()
+	jpeg.Jpeg(data, profile=profile).decode('L')
+	assert 'prediction' in profile.stages and 'entropy' in profile.stages
+	assert 'idct' not in profile.stages
+
+def test_stream_parser(data):
+	profile = jpeg.JpegProfile()
+	parser = jpeg.JpegStreamParser(profile)
+	for i in range(0, len(data), 100):
+		parser.feed(data[i:i + 100])
+	assert profile.markers['DQT'][0] == 2 and profile.markers['SOF0'][2] == 17
@@ -0,0 +1,53 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, pillow_decode, max_difference, as_bytes
+
+@pytest.mark.parametrize('subsampling', [0, 1, 2])
+def test_same_coefficients_as_sequential(subsampling):
+	progressive = jpeg.Jpeg(pillow_jpeg(61, 45, subsampling=subsampling, progressive=True))
+	sequential = jpeg.Jpeg(pillow_jpeg(61, 45, subsampling=subsampling))
+	assert progressive.encoding_type.get('progressive') and len(progressive.scans) > 1
+	for a, b in zip(progressive.coefficients(), sequential.coefficients()):
+		assert a.tolist() == b.tolist()
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+def test_matches_libjpeg(backend, mode):
+	data = pillow_jpeg(50, 38, mode=mode, progressive=True)
+	pixels = as_bytes(jpeg.Jpeg(data).decode(mode, backend=backend))
+	assert max_difference(pixels, pillow_decode(data, mode)) <= (1 if mode == 'L' else 3)
+
+def test_restart_intervals():
+	data = pillow_jpeg(64, 48, progressive=True, restart_marker_blocks=3)
+	assert jpeg.Jpeg(data).restart_interval == 3
+	assert max_difference(as_bytes(jpeg.Jpeg(data).decode()), pillow_decode(data)) <= 3
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_previews(backend):
+	data = pillow_jpeg(40, 24, progressive=True)
+	image = jpeg.Jpeg(data)
+	final = as_bytes(jpeg.Jpeg(data).decode(backend=backend))
+	previews = [(scan, as_bytes(pixels)) for scan, pixels in image.previews(backend=backend)]
+	assert [scan for scan, pixels in previews] == image.scans
+	# the first is from the DC values alone, and each scan brings it closer
+	errors = [sum(abs(u - v) for u, v in zip(pixels, final)) for scan, pixels in previews]
+	assert errors[0] > 0 and errors[-1] == 0
+	assert errors == sorted(errors, reverse=True)
+
+def test_decode_after_stopping_early():
+	data = pillow_jpeg(40, 24, progressive=True)
+	image = jpeg.Jpeg(data)
+	previews = image.previews()
+	next(previews)
+	next(previews)
+	previews.close()
+	assert image.scans_decoded == 2
+	assert as_bytes(image.decode()) == as_bytes(jpeg.Jpeg(data).decode())
+	assert image.scans_decoded == len(image.scans)
+
+def test_previews_reuse_out():
+	data = pillow_jpeg(16, 16, progressive=True)
+	out = bytearray(16 * 16 * 3)
+	for scan, pixels in jpeg.Jpeg(data).previews(out=out):
+		assert pixels is out
@@ -0,0 +1,54 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, as_bytes
+
+# The rectangle (x, y, width, height) of pixels out of a width pixels wide image
+def crop(pixels, width, channels, region):
+	x, y, w, h = region
+	return b''.join(pixels[((y + row) * width + x) * channels:((y + row) * width + x + w) * channels] for row in range(h))
+
+REGIONS = [(0, 0, 77, 53), (0, 0, 1, 1), (17, 9, 30, 20), (33, 40, 44, 13), (76, 52, 1, 1), (5, 31, 64, 7)]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('options', [
+		{'subsampling': 0},
+		{'subsampling': 2},
+		{'subsampling': 1, 'restart_marker_blocks': 2},
+		{'subsampling': 2, 'restart_marker_rows': 1},
+		{'subsampling': 2, 'progressive': True},
+])
+def test_crop_of_full_decode(backend, options):
+	data = pillow_jpeg(77, 53, **options)
+	full = as_bytes(jpeg.Jpeg(data).decode(backend=backend))
+	for region in REGIONS:
+		pixels = as_bytes(jpeg.Jpeg(data).decode(backend=backend, region=region))
+		assert pixels == crop(full, 77, 3, region), region
+
+def test_gray_and_scaled():
+	data = pillow_jpeg(77, 53, mode='L')
+	full = as_bytes(jpeg.Jpeg(data).decode('L'))
+	region = (20, 10, 40, 30)
+	assert as_bytes(jpeg.Jpeg(data).decode('L', region=region)) == crop(full, 77, 1, region)
+
+	data = pillow_jpeg(77, 53, subsampling=2)
+	half = as_bytes(jpeg.Jpeg(data).decode(scale=1 / 2))
+	region = (7, 5, 20, 15)
+	assert as_bytes(jpeg.Jpeg(data).decode(scale=1 / 2, region=region)) == crop(half, 39, 3, region)
+
+def test_after_full_decode():
+	data = pillow_jpeg(40, 24)
+	image = jpeg.Jpeg(data)
+	full = as_bytes(image.decode())
+	assert image.blocks is not None
+	assert as_bytes(image.decode(region=(3, 4, 20, 10))) == crop(full, 40, 3, (3, 4, 20, 10))
+
+def test_leaves_blocks_undecoded():
+	image = jpeg.Jpeg(pillow_jpeg(64, 64))
+	image.decode(region=(0, 0, 8, 8))
+	assert image.blocks is None
+
+@pytest.mark.parametrize('region', [(-1, 0, 4, 4), (0, 0, 0, 4), (0, 0, 41, 4), (38, 20, 4, 4)])
+def test_outside_image(region):
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(pillow_jpeg(40, 24)).decode(region=region)
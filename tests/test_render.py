@@ -0,0 +1,64 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, pillow_decode, max_difference, as_bytes
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('subsampling', [0, 1, 2])
+def test_matches_libjpeg(backend, subsampling):
+	data = pillow_jpeg(61, 45, subsampling=subsampling)
+	for mode, tolerance in (('L', 1), ('RGB', 3)):
+		pixels = as_bytes(jpeg.Jpeg(data).decode(mode, backend=backend))
+		expected = pillow_decode(data, mode)
+		assert max_difference(pixels, expected) <= tolerance
+		# libjpeg's smooth chroma upsampling differs from replication at a few edges only
+		assert sum(abs(u - v) for u, v in zip(pixels, expected)) / len(pixels) < 0.5
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_gray_and_cmyk(backend):
+	data = pillow_jpeg(33, 17, mode='L')
+	assert max_difference(as_bytes(jpeg.Jpeg(data).decode('L', backend=backend)), pillow_decode(data, 'L')) <= 1
+	rgb = as_bytes(jpeg.Jpeg(data).decode('RGB', backend=backend))
+	assert rgb[0::3] == rgb[1::3] == rgb[2::3] == as_bytes(jpeg.Jpeg(data).decode('L', backend=backend))
+
+	data = pillow_jpeg(33, 17, mode='CMYK')
+	assert max_difference(as_bytes(jpeg.Jpeg(data).decode('CMYK', backend=backend)), pillow_decode(data, 'CMYK')) <= 1
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_rgba(backend):
+	data = pillow_jpeg(20, 12)
+	rgba = as_bytes(jpeg.Jpeg(data).decode('RGBA', backend=backend))
+	rgb = as_bytes(jpeg.Jpeg(data).decode('RGB', backend=backend))
+	assert set(rgba[3::4]) == {255}
+	assert bytes(b for i, b in enumerate(rgba) if i % 4 != 3) == rgb
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_into_caller_buffer(backend):
+	data = pillow_jpeg(20, 12)
+	out = bytearray(20 * 12 * 3)
+	assert jpeg.Jpeg(data).decode('RGB', out, backend=backend) is out
+	assert bytes(out) == as_bytes(jpeg.Jpeg(data).decode('RGB', backend=backend))
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode('RGB', bytearray(20 * 12 * 3 - 1), backend=backend)
+
+def test_into_numpy_array():
+	numpy = pytest.importorskip('numpy')
+	data = pillow_jpeg(20, 12)
+	out = numpy.zeros((12, 20, 3), dtype=numpy.uint8)
+	jpeg.Jpeg(data).decode('RGB', out)
+	assert out.tobytes() == as_bytes(jpeg.Jpeg(data).decode('RGB', backend='python'))
+
+def test_backends_agree():
+	pytest.importorskip('numpy')
+	data = pillow_jpeg(61, 45, subsampling=2)
+	for mode in ('L', 'RGB'):
+		assert as_bytes(jpeg.Jpeg(data).decode(mode, backend='python')) == as_bytes(jpeg.Jpeg(data).decode(mode, backend='numpy'))
+
+def test_bad_modes():
+	data = pillow_jpeg(20, 12)
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode('P')
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode('CMYK')
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).decode(backend='fortran')
@@ -0,0 +1,56 @@
+import concurrent.futures
+import re
+
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, as_bytes
+
+# File offsets of the RSTn markers in data
+def restart_markers(data):
+	return [m.start() for m in re.finditer(b'\xff[\xd0-\xd7]', data)]
+
+def test_intervals():
+	data = pillow_jpeg(64, 48, restart_marker_blocks=3)
+	image = jpeg.Jpeg(data)
+	assert image.restart_interval == 3
+	scan = image.scans[0]
+	assert scan['restart_interval'] == 3
+	# 4 x 3 MCUs of 4:2:0 in intervals of 3
+	assert len(scan['segments']) == 4
+	assert len(restart_markers(data)) == 3
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_same_pixels_as_without_restarts(backend):
+	plain = pillow_jpeg(64, 48)
+	restarted = pillow_jpeg(64, 48, restart_marker_blocks=5)
+	expected = as_bytes(jpeg.Jpeg(plain).decode(backend=backend))
+	assert as_bytes(jpeg.Jpeg(restarted).decode(backend=backend)) == expected
+
+def test_parallel_decode():
+	data = pillow_jpeg(96, 64, restart_marker_blocks=2)
+	expected = as_bytes(jpeg.Jpeg(data).decode())
+	assert as_bytes(jpeg.Jpeg(data).decode(workers=2)) == expected
+	with concurrent.futures.ProcessPoolExecutor(2) as executor:
+		assert as_bytes(jpeg.Jpeg(data).decode(workers=executor)) == expected
+		# the executor is the caller's, and still usable
+		assert as_bytes(jpeg.Jpeg(data).decode(workers=executor, scale=1 / 2)) == as_bytes(jpeg.Jpeg(data).decode(scale=1 / 2))
+
+def test_restart_numbers_are_checked():
+	data = bytearray(pillow_jpeg(64, 48, restart_marker_blocks=3))
+	second = restart_markers(bytes(data))[1]
+	data[second + 1] = 0xd5
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(bytes(data))
+
+def test_dropped_restart_marker():
+	data = pillow_jpeg(64, 48, restart_marker_blocks=3)
+	for at in (restart_markers(data)[0], restart_markers(data)[-1]):
+		with pytest.raises(jpeg.BadFieldError):
+			jpeg.Jpeg(data[:at] + data[at + 2:])
+
+def test_restart_marker_without_interval():
+	data = pillow_jpeg(64, 48, restart_marker_blocks=3)
+	dri = data.index(b'\xff\xdd')
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(data[:dri] + data[dri + 6:])
@@ -0,0 +1,86 @@
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg, as_bytes
+
+def rewritten(image, **options):
+	views = image.rewrite(**options)
+	data = b''.join(views)
+	for view in views:
+		view.release()
+	return data
+
+def markers(data):
+	return [m for m, start, end in jpeg.Jpeg(data).marker_segments()]
+
+@pytest.fixture
+def data():
+	# with a comment, and an EXIF header after the JFIF one
+	plain = pillow_jpeg(40, 24, comment=b'hello')
+	exif = b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+	return plain[:20] + b'\xff\xe1' + bytes([0, len(exif) + 2]) + exif + plain[20:]
+
+def test_unchanged(data):
+	assert rewritten(jpeg.Jpeg(data)) == data
+
+def test_drop(data):
+	result = rewritten(jpeg.Jpeg(data), drop=['APP1', 'COM'])
+	assert 'APP1' not in markers(result) and 'COM' not in markers(result)
+	assert len(result) < len(data)
+	assert as_bytes(jpeg.Jpeg(result).decode()) == as_bytes(jpeg.Jpeg(data).decode())
+
+def test_replace(data):
+	result = rewritten(jpeg.Jpeg(data), replace={'COM': [b'one', b'two'], 'APP1': b'Exif\x00\x00'})
+	image = jpeg.Jpeg(result)
+	segments = [(m, result[start + 4:end]) for m, start, end in image.marker_segments() if m in ('COM', 'APP1')]
+	assert segments == [('APP1', b'Exif\x00\x00'), ('COM', b'one'), ('COM', b'two')]
+	assert markers(result).index('COM') == markers(data).index('COM')
+
+# A marker the file does not have goes in after the APPn segments at the start
+def test_add(data):
+	result = rewritten(jpeg.Jpeg(data), replace={'APP13': b'Photoshop 3.0\x00'})
+	found = markers(result)
+	assert found[:4] == ['SOI', 'APP0', 'APP1', 'APP13']
+	assert as_bytes(jpeg.Jpeg(result).decode()) == as_bytes(jpeg.Jpeg(data).decode())
+
+def test_zero_copy(data):
+	buf = bytearray(data)
+	image = jpeg.Jpeg.from_buffer(buf)
+	views = image.rewrite(drop=['COM'])
+	# the scan data is a view of the file, not a copy
+	assert max(len(view) for view in views) > len(data) // 2
+	assert all(view.obj is buf for view in views if len(view) > len(data) // 2)
+	for view in views:
+		view.release()
+	image.close()
+
+def test_stop_at_sof(data):
+	image = jpeg.Jpeg(data, stop_at='SOF')
+	result = rewritten(image, drop=['APP1'])
+	assert result == rewritten(jpeg.Jpeg(data), drop=['APP1'])
+
+# Data after EOI, as a motion photo's video or an MPF file's other images, goes through
+#	untouched, and without a copy
+def test_trailing_data_kept(data):
+	trailer = b'\xff\xd8 second image \xff\xd9 video'
+	assert rewritten(jpeg.Jpeg(data + trailer)) == data + trailer
+	result = rewritten(jpeg.Jpeg(data + trailer), drop=['COM'])
+	assert result.endswith(b'\xff\xd9' + trailer)
+	assert result == rewritten(jpeg.Jpeg(data), drop=['COM']) + trailer
+	buf = bytearray(data + trailer)
+	image = jpeg.Jpeg.from_buffer(buf)
+	views = image.rewrite(drop=['COM'])
+	assert views[-1].obj is buf and bytes(views[-1]).endswith(trailer)
+	for view in views:
+		view.release()
+	image.close()
+
+@pytest.mark.parametrize('options', [
+		{'drop': ['SOF0']},
+		{'drop': ['APP16']},
+		{'replace': {'DQT': b''}},
+		{'replace': {'COM': bytes(0x10000)}},
+])
+def test_bad_arguments(data, options):
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).rewrite(**options)
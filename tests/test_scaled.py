@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, max_difference, as_bytes
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('subsampling', [0, 2])
+@pytest.mark.parametrize('progressive', [False, True])
+@pytest.mark.parametrize('scale', [1 / 2, 1 / 4, 1 / 8])
+def test_partial_decode_matches_full_coefficients(backend, subsampling, progressive, scale):
+	data = pillow_jpeg(61, 45, subsampling=subsampling, progressive=progressive)
+	image = jpeg.Jpeg(data)
+	partial = as_bytes(image.decode('RGB', backend=backend, scale=scale))
+	# only what the reduced IDCTs use was decoded, and not kept
+	assert image.blocks is None
+
+	full = jpeg.Jpeg(data)
+	full.decode_scans()
+	assert as_bytes(full.decode('RGB', backend=backend, scale=scale)) == partial
+
+@pytest.mark.parametrize('subsampling', [0, 2])
+@pytest.mark.parametrize('progressive', [False, True])
+def test_eighth_scale_matches_libjpeg(subsampling, progressive):
+	Image = pytest.importorskip('PIL.Image')
+	data = pillow_jpeg(61, 45, subsampling=subsampling, progressive=progressive)
+	reference = Image.open(io.BytesIO(data))
+	reference.draft('RGB', (61 // 8, 45 // 8))
+	assert reference.size == (8, 6)
+
+	pixels = as_bytes(jpeg.Jpeg(data).decode('RGB', scale=1 / 8))
+	# both are the block averages; libjpeg upsamples the chroma smoothly
+	assert max_difference(pixels, reference.convert('RGB').tobytes()) <= (1 if subsampling == 0 else 2)
+
+def test_full_scale_after_scaled():
+	data = pillow_jpeg(40, 24)
+	image = jpeg.Jpeg(data)
+	image.decode('RGB', scale=1 / 8)
+	assert as_bytes(image.decode('RGB')) == as_bytes(jpeg.Jpeg(data).decode('RGB'))
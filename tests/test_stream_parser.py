@@ -0,0 +1,76 @@
+import struct
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+def feed_in_chunks(data, size):
+	parser = jpeg.JpegStreamParser()
+	events = []
+	for i in range(0, len(data), size):
+		events.extend(parser.feed(data[i:i + size]))
+	parser.close()
+	return parser, events
+
+@pytest.mark.parametrize('size', [1, 7, 100, 1 << 20])
+def test_events_do_not_depend_on_chunking(size):
+	data = pillow_jpeg(40, 24)
+	parser, events = feed_in_chunks(data, size)
+	kinds = [event for event, value in events]
+	assert kinds[-1] == 'end'
+	assert kinds.count('frame') == 1 and kinds.count('scan') == 1
+	assert kinds.index('frame') < kinds.index('scan')
+	# the headers before the scan are reported in file order
+	image = jpeg.Jpeg(data)
+	headers = [value for event, value in events if event == 'header']
+	assert headers == [m for m, start, end in image.marker_segments() if m not in ('SOI', 'EOI', 'SOS') and not m.startswith('SOF')]
+
+	info = dict(events)['frame']
+	assert (info.image_width, info.image_height) == (40, 24)
+	assert parser.scan_bytes == image.scans[0]['length']
+	assert parser.jpeg.scans[0]['offset'] == image.scans[0]['offset']
+
+def test_progressive_scans():
+	data = pillow_jpeg(40, 24, progressive=True)
+	parser, events = feed_in_chunks(data, 50)
+	assert len([e for e, v in events if e == 'scan']) == len(jpeg.Jpeg(data).scans)
+
+def test_frame_known_before_the_data():
+	data = pillow_jpeg(40, 24)
+	sof = data.index(b'\xff\xc0')
+	end = sof + 2 + struct.unpack_from('>H', data, sof + 2)[0]
+	parser = jpeg.JpegStreamParser()
+	assert 'frame' not in dict(parser.feed(data[:end - 1]))
+	info = dict(parser.feed(data[end - 1:end]))['frame']
+	assert info.header_size == end
+
+def test_not_a_jpeg_is_rejected_at_once():
+	parser = jpeg.JpegStreamParser()
+	with pytest.raises(jpeg.NotJpegFileError):
+		parser.feed(b'\xff\xe0\x00\x10')
+
+def test_scan_without_its_tables():
+	data = pillow_jpeg(40, 24)
+	dht = data.index(b'\xff\xc4')
+	length = struct.unpack_from('>H', data, dht + 2)[0]
+	parser = jpeg.JpegStreamParser()
+	with pytest.raises(jpeg.BadFieldError):
+		parser.feed(data[:dht] + data[dht + 2 + length:])
+
+def test_truncated_stream():
+	data = pillow_jpeg(40, 24)
+	parser = jpeg.JpegStreamParser()
+	parser.feed(data[:-10])
+	with pytest.raises(jpeg.TruncatedFileError):
+		parser.close()
+
+def test_done_and_end_offset():
+	data = pillow_jpeg(40, 24)
+	parser = jpeg.JpegStreamParser()
+	parser.feed(data[:-1])
+	assert not parser.done and parser.end_offset is None
+	# what follows the EOI is not part of the image
+	assert parser.feed(data[-1:] + b'trailing') == [('end', None)]
+	assert parser.done and parser.end_offset == len(data)
+	assert parser.feed(b'more') == []
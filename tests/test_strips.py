@@ -0,0 +1,41 @@
+import pytest
+
+import jpeg
+from conftest import BACKENDS, pillow_jpeg, as_bytes
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('options', [
+		{'subsampling': 0},
+		{'subsampling': 2},
+		{'subsampling': 1, 'restart_marker_blocks': 3},
+		{'subsampling': 2, 'progressive': True},
+])
+def test_strips_make_up_the_image(backend, options):
+	data = pillow_jpeg(45, 37, **options)
+	image = jpeg.Jpeg(data)
+	strips = list(image.strips(backend=backend))
+	strip_height = 8 * image.max_v_factor
+	assert [y for y, pixels in strips] == list(range(0, 37, strip_height))
+	assert b''.join(as_bytes(pixels) for y, pixels in strips) == as_bytes(jpeg.Jpeg(data).decode(backend=backend))
+
+@pytest.mark.parametrize('scale', [1 / 2, 1 / 8])
+def test_scaled_gray(scale):
+	data = pillow_jpeg(45, 37, mode='L')
+	pixels = b''.join(as_bytes(p) for y, p in jpeg.Jpeg(data).strips('L', scale=scale))
+	assert pixels == as_bytes(jpeg.Jpeg(data).decode('L', scale=scale))
+
+def test_component_planes():
+	data = pillow_jpeg(45, 37, subsampling=2)
+	image = jpeg.Jpeg(data)
+	rows = list(image.strips(None, backend='python'))
+	assert len(rows) == image.mcus_y
+	for y, planes in rows:
+		assert [len(plane) for plane in planes] == [c['blocks_w'] * 64 * c['v_factor'] for c in image.components]
+
+# A single scan is decoded as the strips are taken, not up front
+def test_streams_one_scan():
+	image = jpeg.Jpeg(pillow_jpeg(64, 64))
+	strips = image.strips()
+	next(strips)
+	assert image.blocks is None
+	strips.close()
@@ -0,0 +1,82 @@
+import struct
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg
+
+def segment(marker, payload):
+	return struct.pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+# Put segments straight after the SOI and JFIF APP0 header of a Pillow encoded image
+def with_headers(*segments):
+	data = pillow_jpeg(24, 16)
+	assert data[2:4] == b'\xff\xe0'
+	split = 4 + struct.unpack_from('>H', data, 4)[0]
+	return data[:split] + b''.join(segments) + data[split:]
+
+# An EXIF APP1 header whose IFD1 points at thumbnail
+def exif_segment(thumbnail, endian='<'):
+	tiff = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', 42, 8)
+	# IFD0 with no entries, then IFD1 with the thumbnail's offset and length
+	ifd1 = 8 + 2 + 4
+	tiff += struct.pack(endian + 'HI', 0, ifd1)
+	data_offset = ifd1 + 2 + 2 * 12 + 4
+	tiff += struct.pack(endian + 'H', 2)
+	tiff += struct.pack(endian + 'HHII', 0x0201, 4, 1, data_offset)
+	tiff += struct.pack(endian + 'HHII', 0x0202, 4, 1, len(thumbnail))
+	tiff += struct.pack(endian + 'I', 0) + thumbnail
+	return segment(0xe1, b'Exif\x00\x00' + tiff)
+
+def test_none():
+	assert jpeg.Jpeg(pillow_jpeg(24, 16)).embedded_thumbnail() is None
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_exif_thumbnail(endian):
+	thumbnail = pillow_jpeg(8, 8)
+	data = with_headers(exif_segment(thumbnail, endian))
+	with jpeg.Jpeg.from_buffer(data, stop_at='SOF') as image:
+		found = image.embedded_thumbnail()
+		assert (found.source, found.format) == ('EXIF', 'jpeg')
+		assert found.data.obj is data and found.data == thumbnail
+		assert jpeg.Jpeg.probe(found.data).image_width == 8
+		found.data.release()
+		assert image.exif is not None
+
+def test_jfif_rgb_thumbnail():
+	pixels = bytes(range(2 * 3 * 3))
+	data = pillow_jpeg(24, 16)
+	app0 = segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x03\x02' + pixels)
+	data = data[:2] + app0 + data[4 + struct.unpack_from('>H', data, 4)[0]:]
+	found = jpeg.Jpeg(data).embedded_thumbnail()
+	assert (found.source, found.format, found.width, found.height) == ('JFIF', 'rgb', 3, 2)
+	assert found.data == pixels
+
+def test_jfxx_thumbnails():
+	thumbnail = pillow_jpeg(8, 8)
+	palette = bytes(768) + bytes([1, 2, 3, 4])
+	data = with_headers(segment(0xe0, b'JFXX\x00\x11\x02\x02' + palette), segment(0xe0, b'JFXX\x00\x10' + thumbnail))
+	image = jpeg.Jpeg(data)
+	# the JPEG one is preferred
+	found = image.embedded_thumbnail()
+	assert (found.source, found.format) == ('JFXX', 'jpeg') and found.data == thumbnail
+	assert len(image.thumbnails) == 2
+	assert image.thumbnails[0].format == 'palette' and image.thumbnails[0].length == len(palette)
+
+def test_pick_source():
+	exif = pillow_jpeg(8, 8)
+	jfxx = pillow_jpeg(16, 8)
+	image = jpeg.Jpeg(with_headers(segment(0xe0, b'JFXX\x00\x10' + jfxx), exif_segment(exif)))
+	assert image.embedded_thumbnail().data == exif
+	assert image.embedded_thumbnail('JFXX').data == jfxx
+	assert image.embedded_thumbnail('JFIF') is None
+
+def test_malformed_exif_is_skipped():
+	data = with_headers(segment(0xe1, b'Exif\x00\x00II*\x00\xff\xff\xff\x7f'))
+	image = jpeg.Jpeg(data)
+	assert image.embedded_thumbnail() is None
+	assert image.image_width == 24
+
+def test_bad_jfxx_size():
+	with pytest.raises(jpeg.BadFieldError):
+		jpeg.Jpeg(with_headers(segment(0xe0, b'JFXX\x00\x13\x02\x02' + bytes(5))))
@@ -0,0 +1,103 @@
+import io
+import struct
+
+import pytest
+
+import jpeg
+from conftest import pillow_jpeg, max_difference
+
+# Our transforms as Pillow's transposes (Pillow rotates anticlockwise)
+PILLOW_TRANSPOSES = {
+		'flip_horizontal': 'FLIP_LEFT_RIGHT',
+		'flip_vertical': 'FLIP_TOP_BOTTOM',
+		'rotate_180': 'ROTATE_180',
+		'transpose': 'TRANSPOSE',
+		'rotate_90': 'ROTATE_270',
+		'rotate_270': 'ROTATE_90',
+		'transverse': 'TRANSVERSE',
+}
+
+def decoded(data, mode='RGB'):
+	Image = pytest.importorskip('PIL.Image')
+	image = jpeg.Jpeg(data)
+	return Image.frombytes(mode, (image.image_width, image.image_height), bytes(image.decode(mode)))
+
+def transposed(picture, operation):
+	Image = pytest.importorskip('PIL.Image')
+	return picture.transpose(getattr(Image.Transpose, PILLOW_TRANSPOSES[operation]))
+
+# The IDCT rounds the same way whichever way round a block is, so a transposed block can
+#	come out 1 off; flips only change the sign of some coefficients and come out exact
+def tolerance(operation):
+	return 1 if jpeg.TRANSFORMS[operation][0] else 0
+
+@pytest.mark.parametrize('operation', sorted(jpeg.TRANSFORMS))
+@pytest.mark.parametrize('mode, options', [('L', {}), ('RGB', {'subsampling': 0}), ('RGB', {'subsampling': 2})])
+def test_matches_transformed_pixels(operation, mode, options):
+	data = pillow_jpeg(48, 32, mode=mode, **options)
+	result = decoded(jpeg.Jpeg(data).transform(operation), mode)
+	expected = transposed(decoded(data, mode), operation)
+	assert result.size == expected.size
+	assert max_difference(result.tobytes(), expected.tobytes()) <= tolerance(operation)
+
+@pytest.mark.parametrize('operation, inverse', [
+		('flip_horizontal', 'flip_horizontal'),
+		('transpose', 'transpose'),
+		('rotate_90', 'rotate_270'),
+		('transverse', 'transverse'),
+])
+def test_coefficients_are_moved_losslessly(operation, inverse):
+	data = pillow_jpeg(48, 32, subsampling=2)
+	back = jpeg.Jpeg(jpeg.Jpeg(jpeg.Jpeg(data).transform(operation)).transform(inverse))
+	assert [c.tolist() for c in back.coefficients()] == [c.tolist() for c in jpeg.Jpeg(data).coefficients()]
+
+# A flip drops a partial MCU at the edge it would have to move, as jpegtran -trim does
+@pytest.mark.parametrize('operation', sorted(jpeg.TRANSFORMS))
+def test_trim(operation):
+	data = pillow_jpeg(45, 37, subsampling=2)
+	transpose, flip_x, flip_y = jpeg.TRANSFORMS[operation]
+	width = 32 if (flip_y if transpose else flip_x) else 45
+	height = 32 if (flip_x if transpose else flip_y) else 37
+
+	result = decoded(jpeg.Jpeg(data).transform(operation))
+	expected = transposed(decoded(data).crop((0, 0, width, height)), operation)
+	assert result.size == expected.size
+	assert max_difference(result.tobytes(), expected.tobytes()) <= tolerance(operation)
+
+def test_crop():
+	data = pillow_jpeg(64, 48, subsampling=2)
+	result = decoded(jpeg.Jpeg(data).transform(crop=(16, 16, 40, 30)))
+	assert result.tobytes() == decoded(data).crop((16, 16, 56, 46)).tobytes()
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).transform(crop=(8, 0, 16, 16))
+	with pytest.raises(ValueError):
+		jpeg.Jpeg(data).transform('rotate_45')
+
+# An APP1 header holding just an EXIF orientation
+def exif_orientation(orientation, endian):
+	tiff = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', 42, 8)
+	tiff += struct.pack(endian + 'HHHIHHI', 1, 0x0112, 3, 1, orientation, 0, 0)
+	payload = b'Exif\x00\x00' + tiff
+	return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+@pytest.mark.parametrize('orientation', range(1, 9))
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_auto_orient(orientation, endian):
+	Image = pytest.importorskip('PIL.Image')
+	ImageOps = pytest.importorskip('PIL.ImageOps')
+	plain = pillow_jpeg(48, 32)
+	data = plain[:2] + exif_orientation(orientation, endian) + plain[2:]
+	image = jpeg.Jpeg(data)
+	assert image.exif_orientation()[0] == orientation
+
+	upright = image.auto_orient()
+	if orientation == 1:
+		assert upright is None
+		return
+	assert jpeg.Jpeg(upright).exif_orientation()[0] == 1
+	# Pillow agrees on what each orientation means
+	stored = decoded(data)
+	stored.info['exif'] = exif_orientation(orientation, endian)[10:]
+	expected = ImageOps.exif_transpose(stored)
+	operation = jpeg.EXIF_ORIENTATIONS[orientation]
+	assert max_difference(decoded(upright).tobytes(), expected.tobytes()) <= tolerance(operation)